@@ -1,21 +1,91 @@
 import os
 import json
-from typing import Any, Dict
+import hashlib
+import shutil
+import time
+import uuid
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 import streamlit as st
 
-from openai import OpenAI
-
-from models import ExtractionSchema
+from cache import ExtractionCache, DEFAULT_CACHE_PATH
+from comparison import DEFAULT_COMPARE_FIELDS, comparison_rows, export_dir, sweep_exports, write_results_parts
+from context import pack_context
+from dedup import DEFAULT_DEDUP_PATH, DedupIndex
+from evidence_store import DEFAULT_STORE_PATH, EvidenceStore
+from extraction import DEFAULT_CASCADE_THRESHOLD
+from jobs import DEFAULT_JOBS_PATH, DEFAULT_WORKERS, JobQueue, WorkerPool
+from models import leaf_specs, schema_version
+from normalize import normalize_pages
+from scheduler import get_scheduler
+from search_index import DEFAULT_SEARCH_PATH, SearchIndex, parse_filter
+from telemetry import PROCESS, Telemetry, set_current
 from utils import (
-    extract_text_from_pdf,
-    chunk_text,
-    build_system_prompt,
-    build_user_prompt,
-    render_markdown_report
+    PdfLimitError,
+    estimate_tokens,
+    extract_pages_from_pdf,
+    render_markdown_report,
+    report_label,
 )
 
 st.set_page_config(page_title="Systematic Review Agent", page_icon="📚", layout="wide")
 
+@st.cache_resource
+def get_extraction_cache() -> ExtractionCache:
+    # One cache connection per server process, shared by every session
+    return ExtractionCache(DEFAULT_CACHE_PATH)
+
+@st.cache_resource
+def get_dedup_index() -> DedupIndex:
+    return DedupIndex(DEFAULT_DEDUP_PATH)
+
+@st.cache_resource
+def get_evidence_store() -> EvidenceStore:
+    return EvidenceStore(DEFAULT_STORE_PATH)
+
+@st.cache_resource
+def get_search_index() -> SearchIndex:
+    return SearchIndex(DEFAULT_SEARCH_PATH)
+
+@st.cache_resource
+def get_job_pool() -> WorkerPool:
+    # Shared by every session: a bounded number of extractions run at once, and jobs
+    # outlive reruns. With JOBS_EXTERNAL_WORKER=1 only `python jobs.py worker` runs them.
+    pool = WorkerPool(JobQueue(DEFAULT_JOBS_PATH), workers=DEFAULT_WORKERS, cache=get_extraction_cache(),
+                      dedup=get_dedup_index(), store=get_evidence_store(), search=get_search_index())
+    return pool if os.getenv("JOBS_EXTERNAL_WORKER") else pool.start()
+
+@st.cache_resource
+def sweep_old_exports() -> int:
+    # Once per server process: exports of sessions that ended without starting another
+    # comparison (those are removed when the next one starts)
+    return sweep_exports()
+
+sweep_old_exports()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def evidence_summary(store_version: Tuple[Tuple[str, int], ...]) -> Dict[str, Any]:
+    # Keyed by the store's parts, so reruns reuse the aggregates until new rows are flushed
+    return get_evidence_store().summary()
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def parse_pdf(digest: str, _upload: BinaryIO) -> List[str]:
+    # Keyed by the file digest only (underscore args are not hashed), so widget
+    # interactions rerun the script without re-parsing the same upload. Pages are parsed
+    # straight from the upload buffer (no copy), one at a time.
+    return extract_pages_from_pdf(_upload, workers=None)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def clean_up_text(digest: str, _pages: List[str], strip_back_matter: bool) -> Tuple[str, Dict[str, Any]]:
+    return normalize_pages(_pages, strip_back_matter)
+
+# One telemetry collector per browser session (feeds the process totals as well)
+if "telemetry" not in st.session_state:
+    st.session_state.telemetry = Telemetry(parent=PROCESS)
+set_current(st.session_state.telemetry)
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:12]
+    st.session_state.job_ids = []
+
 st.title("📚 Systematic Review Agent")
 st.caption("Analyze scientific articles and extract structured evidence using the OpenAI API.")
 
@@ -25,22 +95,69 @@ default_model = st.sidebar.text_input("OpenAI model", value=os.getenv("OPENAI_MO
 api_key = st.sidebar.text_input("OPENAI_API_KEY", type="password", value=os.getenv("OPENAI_API_KEY", ""))
 temperature = st.sidebar.slider("Temperature", 0.0, 1.0, 0.2, 0.1)
 max_output_tokens = st.sidebar.number_input("Max output tokens", min_value=256, max_value=200000, value=5000, step=256)
+context_budget = st.sidebar.number_input(
+    "Article token budget (0 = send full text)", min_value=0, max_value=200000, value=0, step=1000,
+    help="Send only the passages most relevant to each report section (BM25), within this many input tokens.")
+cascade_model = st.sidebar.text_input(
+    "Escalation model (optional)", value=os.getenv("OPENAI_CASCADE_MODEL", ""),
+    help="Run the model above first, then ask this stronger model again only for sections that came back mostly unknown.")
+cascade_threshold = st.sidebar.slider("Escalate sections with at least this fraction unknown", 0.0, 1.0,
+                                      DEFAULT_CASCADE_THRESHOLD, 0.05, disabled=not cascade_model.strip())
 
 st.sidebar.markdown("---")
 st.sidebar.write("**Output options**")
 download_as = st.sidebar.selectbox("Download format", ["JSON", "Markdown"])
+reviewer = st.sidebar.text_input("Reviewer name (optional)",
+                                 help="Jobs are listed under this name, so you can come back for the results later.")
+owner = reviewer.strip() or st.session_state.session_id
+
+with st.sidebar.expander("Rate limits"):
+    # 0 = no local budget; the scheduler still adapts to the provider's rate-limit headers
+    rpm_budget = st.number_input("Requests per minute", min_value=0, value=int(os.getenv("OPENAI_RPM", "0") or 0), step=10)
+    tpm_budget = st.number_input("Tokens per minute", min_value=0, value=int(os.getenv("OPENAI_TPM", "0") or 0), step=10000)
+    parallel_requests = st.number_input("Parallel requests", min_value=1, max_value=64,
+                                        value=int(os.getenv("OPENAI_MAX_CONCURRENCY", "8") or 8),
+                                        help="Model requests in flight at once; multi-article runs extract this many articles in parallel.")
+    if api_key:
+        sched_stats = get_scheduler(api_key, requests_per_minute=rpm_budget, tokens_per_minute=tpm_budget,
+                                    max_concurrency=parallel_requests).stats()
+        st.caption(f"In flight: {sched_stats['in_flight']} · queued: {sched_stats['queued']} · "
+                   f"concurrency: {sched_stats['concurrency']} · retries: {sched_stats['retries']} · "
+                   f"429s: {sched_stats['rate_limited']}")
+
+st.sidebar.markdown("---")
+use_cache = st.sidebar.checkbox("Reuse cached extractions", value=True,
+                                help="Identical article + model + prompt + schema returns the stored result at zero token cost.")
+if use_cache:
+    cache_stats = get_extraction_cache().stats()
+    st.sidebar.caption(f"Cache: {cache_stats['entries']} entries · {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+reuse_duplicates = st.sidebar.checkbox("Reuse extractions of near-duplicates", value=True,
+                                       help="An article that is a near-copy of one extracted before (preprint, re-upload) gets its stored result.")
+add_to_store = st.sidebar.checkbox("Add results to the evidence store", value=True,
+                                   help="Completed extractions become rows of the review's evidence table.")
 
 # Input section
 st.subheader("1) Provide your article")
 tab_pdf, tab_text = st.tabs(["Upload PDF", "Paste text"])
 
-article_text = ""
+article_pages: List[str] = []
+article_name = "pasted-text"
+# Several PDFs at once: (name, pages) per upload, extracted in parallel as a comparison run
+uploads: List[Tuple[str, List[str]]] = []
 
 with tab_pdf:
-    pdf_file = st.file_uploader("Upload a PDF file", type=["pdf"])
-    if pdf_file is not None:
-        with st.spinner("Reading PDF..."):
-            article_text = extract_text_from_pdf(pdf_file)
+    pdf_files = st.file_uploader("Upload PDF files", type=["pdf"], accept_multiple_files=True,
+                                 help="Drop several PDFs to extract them in parallel and compare the studies side by side.")
+    if pdf_files:
+        with st.spinner(f"Reading {len(pdf_files)} PDF(s)..."):
+            for pdf_file in pdf_files:
+                try:
+                    uploads.append((os.path.splitext(pdf_file.name)[0],
+                                    parse_pdf(hashlib.sha256(pdf_file.getbuffer()).hexdigest(), pdf_file)))
+                except PdfLimitError as e:
+                    st.error(f"{pdf_file.name}: {e}")
+        if len(uploads) == 1:
+            (article_name, article_pages), uploads = uploads[0], []
 
 with tab_text:
     text_input = st.text_area(
@@ -49,76 +166,345 @@ with tab_text:
         placeholder="Paste the scientific article text here..."
     )
     if text_input:
-        article_text = text_input
+        article_pages = text_input.split("\f")
+        article_name = "pasted-text"
+        uploads = []
+
+col_clean, col_back = st.columns([1, 1])
+with col_clean:
+    clean_text = st.checkbox("Clean up extracted text", value=True,
+                             help="Drop running headers/footers and page numbers, rejoin hyphenated words, collapse whitespace.")
+with col_back:
+    strip_back_matter = st.checkbox("Drop references and acknowledgements", value=True, disabled=not clean_text)
+
+def prepare_text(pages: List[str]) -> Tuple[str, Optional[Dict[str, Any]]]:
+    if not clean_text:
+        return "\n".join(pages).strip(), None
+    pages_digest = hashlib.sha256("\f".join(pages).encode("utf-8")).hexdigest()
+    return clean_up_text(pages_digest, pages, strip_back_matter)
+
+article_text = ""
+if article_pages:
+    article_text, cleanup = prepare_text(article_pages)
+    if cleanup and cleanup["saved_tokens"]:
+        st.caption(f"Text clean-up: {cleanup['raw_tokens']:,} → {cleanup['tokens']:,} estimated tokens "
+                   f"(−{cleanup['saved_pct']}%: {cleanup['boilerplate_lines']} header/footer lines, "
+                   f"{cleanup['dehyphenated']} hyphenations, {cleanup['back_matter_tokens']:,} tokens of back matter).")
+
+batch_articles: List[Tuple[str, str]] = []
+if uploads:
+    batch_tokens = batch_saved = 0
+    for name, pages in uploads:
+        text, cleanup = prepare_text(pages)
+        if not text:
+            st.warning(f"{name}: no text could be extracted.")
+            continue
+        batch_articles.append((name, text))
+        batch_tokens += estimate_tokens(text)
+        batch_saved += cleanup["saved_tokens"] if cleanup else 0
+    st.caption(f"{len(batch_articles)} articles ready · {batch_tokens:,} estimated tokens"
+               + (f" ({batch_saved:,} removed by the clean-up)." if batch_saved else "."))
 
 st.subheader("2) Run extraction")
-col1, col2 = st.columns([1, 1])
+col1, col2, col3 = st.columns([1, 1, 1])
 with col1:
     force_english = st.checkbox("Force output in English", value=True)
 with col2:
     allow_unknown = st.checkbox("Allow 'unknown' for missing fields", value=True)
+with col3:
+    sectioned = st.checkbox("Extract sections in parallel", value=False,
+                            help="One concurrent request per report section: lower latency, failed sections retried alone.")
+
+if article_text and context_budget:
+    packed_stats = pack_context(article_text, int(context_budget))[1]
+    st.caption(f"Context: keeping {packed_stats['kept_tokens']:,} of {packed_stats['total_tokens']:,} estimated tokens "
+               f"({packed_stats['discarded_tokens']:,} discarded, {packed_stats['passages_kept']}/{packed_stats['passages_total']} passages).")
+
+def make_article_id(name: str, text: str) -> str:
+    # Same article text -> same id, so a re-run replaces the study's row / index entry
+    return f"{name}-{hashlib.sha1(text.encode('utf-8')).hexdigest()[:8]}"
 
-run = st.button("Analyze Article", type="primary", disabled=(not api_key or not article_text))
+def find_duplicate(aid: str, text: str) -> Optional[Dict[str, Any]]:
+    return next((m for m in get_dedup_index().query(text) if m["doc_id"] != aid), None)
+
+article_id = ""
+duplicate = None
+if article_text:
+    article_id = make_article_id(article_name, article_text)
+    duplicate = find_duplicate(article_id, article_text)
+    if duplicate:
+        st.info(f"Near-duplicate of an article extracted before: {duplicate['source'] or duplicate['doc_id']} "
+                f"({duplicate['similarity']:.0%} similar)."
+                + (" Its extraction will be reused." if reuse_duplicates and duplicate["has_result"]
+                   and duplicate["schema_version"] == schema_version() and duplicate["model"] == default_model else ""))
+
+run = st.button(f"Analyze {len(batch_articles)} articles" if batch_articles else "Analyze Article", type="primary",
+                disabled=(not api_key or not (article_text or batch_articles)))
+if batch_articles:
+    st.caption(f"Articles are extracted up to {min(parallel_requests, get_job_pool().workers)} at a time "
+               f"(sidebar *Rate limits*; the server runs at most {get_job_pool().workers} jobs at once), "
+               f"within the request and token budgets set there.")
+
+def show_result(data: Dict[str, Any], key: str = "") -> None:
+    st.subheader("Result (structured)")
+    st.json(data, expanded=False)
+
+    st.subheader("Result (markdown report)")
+    md = render_markdown_report(data)
+    st.markdown(md)
+
+    if download_as == "JSON":
+        st.download_button("⬇️ Download JSON", data=json.dumps(data, indent=2),
+                           file_name="extraction.json", mime="application/json", key=f"dl-{key}")
+    else:
+        st.download_button("⬇️ Download Markdown", data=md,
+                           file_name="extraction.md", mime="text/markdown", key=f"dl-{key}")
+
+job_pool = get_job_pool()
 
 if run:
+    # Queued, not run inline: the job keeps going if the page reruns or is closed
+    get_scheduler(api_key, requests_per_minute=rpm_budget, tokens_per_minute=tpm_budget, max_concurrency=parallel_requests)
+    options = dict(
+        model=default_model,
+        temperature=temperature,
+        max_tokens=max_output_tokens,
+        force_english=force_english,
+        allow_unknown=allow_unknown,
+        context_budget=int(context_budget) or None,
+        sectioned=sectioned,
+        cascade_model=cascade_model.strip() or None,
+        cascade_threshold=cascade_threshold,
+    )
+
+    def submit(text: str, name: str, aid: str, dup: Optional[Dict[str, Any]]) -> Tuple[str, bool]:
+        extras = dict(article_id=aid, use_cache=use_cache, add_to_store=add_to_store, reuse_duplicates=reuse_duplicates,
+                      duplicate_of=dup["doc_id"] if dup else None)
+        job_id, coalesced = job_pool.submit(text, options, owner=owner, article_name=name, extras=extras, api_key=api_key)
+        if job_id not in st.session_state.job_ids:
+            st.session_state.job_ids.insert(0, job_id)
+        return job_id, coalesced
+
+    if batch_articles:
+        # Every article is queued at once; the shared worker pool (fixed size) runs them, and
+        # this key's scheduler keeps at most `parallel_requests` of their model calls in flight
+        batch_jobs = []
+        for name, text in batch_articles:
+            aid = make_article_id(name, text)
+            batch_jobs.append({"article": name, "job": submit(text, name, aid, find_duplicate(aid, text))[0]})
+        previous = st.session_state.get("comparison")
+        if previous:
+            # The previous comparison's export goes with it
+            shutil.rmtree(export_dir(previous["id"]), ignore_errors=True)
+        st.session_state.comparison = {"id": uuid.uuid4().hex[:12], "jobs": batch_jobs, "results": {}}
+    else:
+        job_id, coalesced = submit(article_text, article_name, article_id, duplicate)
+        st.session_state.active_job = job_id
+        if coalesced:
+            st.toast("The same extraction is already running; you'll get its result.")
+
+def show_job(job: Dict[str, Any]) -> None:
+    if job["status"] == "failed":
+        st.error(f"Error: {job['error']}")
+        return
+    if job["warning"]:
+        st.warning(job["warning"])
+    elif job["reused_from"]:
+        st.success("Reused the extraction of the near-duplicate.")
+    else:
+        st.success("Extraction complete!")
+    per_model = (job.get("telemetry") or {}).get("models") or {}
+    if len(per_model) > 1:
+        st.caption(" · ".join(f"{name}: {m['requests']} requests, {m['prompt_tokens']:,} in / "
+                              f"{m['completion_tokens']:,} out, ~${m['cost_usd']:.4f}" for name, m in per_model.items()))
+    show_result(job["result"] or {}, key=job["id"])
+
+@st.fragment(run_every=1.0)
+def active_job_panel() -> None:
+    # Polls the active job; the live report grows as the worker publishes partial output
+    job = job_pool.queue.get(st.session_state.active_job)
+    if job is None:
+        return
+    if job["status"] == "queued":
+        st.info(f"Queued (position {job['queue_position']})...")
+    elif job["status"] == "running":
+        st.info("Querying the model...")
+        if job["partial"]:
+            st.markdown(render_markdown_report(job["partial"]))
+    else:
+        # Finished: redraw the whole page once, without the polling fragment
+        st.session_state.finished_job = st.session_state.pop("active_job")
+        st.rerun()
+
+if st.session_state.get("active_job"):
+    active_job_panel()
+elif st.session_state.get("finished_job"):
+    finished = job_pool.queue.get(st.session_state.finished_job)
+    if finished is not None:
+        show_job(finished)
+
+def comparison_progress(comparison: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # One row per article; results of finished jobs are loaded once and kept in the session
+    progress = job_pool.queue.progress([j["job"] for j in comparison["jobs"]])
+    rows = []
+    for entry in comparison["jobs"]:
+        job = progress.get(entry["job"]) or {"status": "missing"}
+        if job["status"] == "done" and entry["job"] not in comparison["results"]:
+            comparison["results"][entry["job"]] = (job_pool.queue.get(entry["job"]) or {}).get("result") or {}
+        status = job["status"]
+        if status == "queued":
+            status = f"queued ({job['queue_position']})"
+        elif status == "done" and job.get("reused_from"):
+            status = "done (near-duplicate)"
+        seconds = job["finished_at"] - job["started_at"] if job.get("finished_at") and job.get("started_at") else None
+        rows.append({"article": entry["article"], "status": status,
+                     "seconds": round(seconds, 1) if seconds is not None else None,
+                     "note": job.get("error") or job.get("warning") or ""})
+    return rows
+
+def show_comparison_table(comparison: Dict[str, Any], fields: List[str]) -> None:
+    results = [(j["article"], comparison["results"][j["job"]]) for j in comparison["jobs"] if j["job"] in comparison["results"]]
+    if results:
+        st.dataframe(comparison_rows(results, fields), hide_index=True)
+
+@st.fragment(run_every=1.0)
+def comparison_panel() -> None:
+    # Polls every job of the run; finished studies join the comparison as they come in
+    comparison = st.session_state.comparison
+    rows = comparison_progress(comparison)
+    finished = sum(r["status"].startswith(("done", "failed", "missing")) for r in rows)
+    if finished == len(rows):
+        comparison["finished"] = True
+        st.rerun()
+    st.progress(finished / len(rows), text=f"{finished} of {len(rows)} articles finished")
+    st.dataframe(rows, hide_index=True)
+    show_comparison_table(comparison, list(DEFAULT_COMPARE_FIELDS))
+
+if st.session_state.get("comparison"):
+    comparison = st.session_state.comparison
+    st.subheader(f"Comparison of {len(comparison['jobs'])} articles")
+    if not comparison.get("finished"):
+        comparison_panel()
+    else:
+        rows = comparison_progress(comparison)
+        failed = [r for r in rows if r["status"] == "failed"]
+        st.caption(f"{len(rows) - len(failed)} of {len(rows)} articles extracted"
+                   + (f"; {len(failed)} failed." if failed else "."))
+        st.dataframe(rows, hide_index=True)
+        compare_fields = st.multiselect("Fields to compare", list(leaf_specs()), default=list(DEFAULT_COMPARE_FIELDS),
+                                        format_func=report_label)
+        show_comparison_table(comparison, compare_fields)
+        job_names = [(j["article"], j["job"]) for j in comparison["jobs"] if j["job"] in comparison["results"]]
+
+        # The export is written to disk one study at a time, in self-contained parts of
+        # about COMPARISON_EXPORT_PART_MB: a download is held in server memory whole, so only
+        # the part being downloaded is read, and only when its button is clicked
+        export = comparison.get("export")
+        export_key = [list(compare_fields), job_names]
+        if export is None or export["key"] != export_key:
+            if st.button("Prepare export (ZIP: JSON + Markdown per study, comparison CSV)", disabled=not job_names):
+                results = ((name, (job_pool.queue.get(job_id) or {}).get("result") or {}) for name, job_id in job_names)
+                with st.spinner("Writing the export…"):
+                    parts = write_results_parts(export_dir(comparison["id"]), results, compare_fields)
+                comparison["export"] = {"key": export_key, "parts": parts}
+                st.rerun()
+        else:
+            def read_part(path: str) -> bytes:
+                with open(path, "rb") as fh:
+                    return fh.read()
+
+            parts = export["parts"]
+            for i, (path, studies) in enumerate(parts, start=1):
+                label = "⬇️ Download all (ZIP)" if len(parts) == 1 else f"⬇️ Part {i} of {len(parts)} ({studies} studies)"
+                st.download_button(label, data=lambda path=path: read_part(path),
+                                   file_name="comparison.zip" if len(parts) == 1 else f"comparison-part{i}.zip",
+                                   mime="application/zip", key=f"export_part_{i}")
+
+st.subheader("3) Jobs")
+my_jobs = job_pool.queue.list_jobs(owner)
+if not my_jobs:
+    st.caption("No jobs yet. Results stay here after the page is closed" +
+               (" (under your reviewer name)." if reviewer.strip() else "; set a reviewer name to find them from another session."))
+else:
+    st.dataframe(
+        [{"job": j["id"], "article": j["article_name"], "status": j["status"], "model": j["options"].get("model"),
+          "submitted": time.strftime("%Y-%m-%d %H:%M", time.localtime(j["created_at"]))} for j in my_jobs],
+        hide_index=True,
+    )
+    done_jobs = {f"{j['article_name'] or j['id']} · {time.strftime('%Y-%m-%d %H:%M', time.localtime(j['created_at']))}": j["id"]
+                 for j in my_jobs if j["status"] in ("done", "failed")}
+    if done_jobs:
+        picked = st.selectbox("Open a past result", ["—"] + list(done_jobs))
+        if picked != "—":
+            show_job(job_pool.queue.get(done_jobs[picked]))
+
+st.subheader("4) Search processed articles")
+search_index = get_search_index()
+field_paths = list(leaf_specs())
+col_q, col_field, col_mention = st.columns([2, 1, 1])
+with col_q:
+    search_text = st.text_input("Words or \"phrases\" in the article text or answers",
+                                help="All words must match; OR, NOT and a trailing * (prefix) are supported.")
+with col_field:
+    search_field = st.selectbox("Field", ["—"] + field_paths)
+with col_mention:
+    field_text = st.text_input("Field mentions", disabled=search_field == "—",
+                               help="Full-text match within the selected field, e.g. white matter.")
+search_filter = st.text_input("Filter", placeholder="e.g. itt_analysis = yes, number_of_patients >= 10",
+                              help="Comma-separated field/value conditions: = and != on answers, < <= > >= on numbers.")
+if search_text.strip() or field_text.strip() or search_filter.strip():
     try:
-        client = OpenAI(api_key=api_key)
-
-        # Prompts
-        text_for_model = chunk_text(article_text)
-        system_prompt = build_system_prompt(force_english=force_english, allow_unknown=allow_unknown)
-        user_prompt = build_user_prompt(text_for_model)
-
-        # JSON Schema (STRICT) para Structured Outputs
-        schema = ExtractionSchema.json_schema()
-
-        with st.spinner("Querying the model..."):
-            resp = client.chat.completions.create(
-                model=default_model,
-                temperature=temperature,
-                max_tokens=max_output_tokens,  # Chat Completions usa max_tokens
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                ],
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "systematic_review_extraction",
-                        "schema": schema,
-                        "strict": True
-                    }
-                }
+        t0 = time.perf_counter()
+        hits = search_index.search(
+            search_text,
+            fields={search_field: field_text} if search_field != "—" and field_text.strip() else None,
+            where=[parse_filter(f) for f in search_filter.split(",") if f.strip()],
+            limit=50,
+        )
+        elapsed_ms = 1000 * (time.perf_counter() - t0)
+    except ValueError as e:
+        st.error(str(e))
+    else:
+        st.caption(f"{len(hits)} results · {elapsed_ms:.0f} ms · {len(search_index):,} articles indexed")
+        if hits:
+            st.dataframe(
+                [{"article": h["source"] or h["article_id"], "score": h["score"], "snippet": h["snippet"] or "",
+                  **{p.split(".")[-1]: v for p, v in h["fields"].items()}} for h in hits],
+                hide_index=True,
             )
 
-        content = resp.choices[0].message.content if resp and resp.choices else None
+# Drawn last so it includes the run that just finished
+with st.sidebar.expander("Session metrics"):
+    tel_summary = st.session_state.telemetry.summary()
+    # Model calls run in the job workers; their usage is stored with each job
+    for job_id in st.session_state.job_ids:
+        job_tel = (job_pool.queue.get(job_id) or {}).get("telemetry") or {}
+        for field in ("requests", "cache_hits", "prompt_tokens", "cached_tokens", "completion_tokens", "cost_usd"):
+            tel_summary[field] += job_tel.get(field, 0)
+    st.caption(f"Requests: {tel_summary['requests']} · cache hits: {tel_summary['cache_hits']}")
+    cache_rate = tel_summary["cached_tokens"] / tel_summary["prompt_tokens"] if tel_summary["prompt_tokens"] else 0.0
+    st.caption(f"Tokens: {tel_summary['prompt_tokens']:,} in ({tel_summary['cached_tokens']:,} cached, {cache_rate:.0%}) · "
+               f"{tel_summary['completion_tokens']:,} out · ~${tel_summary['cost_usd']:.4f}")
+    jobs_stats = job_pool.queue.stats()
+    st.caption(f"Jobs on this server: {jobs_stats.get('running', 0)} running · {jobs_stats.get('queued', 0)} queued")
+    if tel_summary["stages"]:
+        st.table([{"stage": name, "calls": v["count"], "total s": v["total_s"], "mean s": v["mean_s"]}
+                  for name, v in tel_summary["stages"].items()])
+    st.download_button("Prometheus metrics", data=PROCESS.prometheus_text(),
+                       file_name="metrics.prom", mime="text/plain")
 
-        if not content:
-            st.error("No structured output returned from the model.")
-        else:
-            try:
-                data = json.loads(content)
-            except Exception:
-                cleaned = content.strip().strip("`")
-                data = json.loads(cleaned)
-
-            st.success("Extraction complete!")
-            st.subheader("Result (structured)")
-            st.json(data, expanded=False)
-
-            st.subheader("Result (markdown report)")
-            md = render_markdown_report(data)
-            st.markdown(md)
-
-            if download_as == "JSON":
-                st.download_button("⬇️ Download JSON", data=json.dumps(data, indent=2),
-                                   file_name="extraction.json", mime="application/json")
-            else:
-                st.download_button("⬇️ Download Markdown", data=md,
-                                   file_name="extraction.md", mime="text/markdown")
-
-    except Exception as e:
-        st.error(f"Error: {e}")
+with st.sidebar.expander("Evidence store"):
+    store = get_evidence_store()
+    store_summary = evidence_summary(store.version())
+    st.caption(f"Studies: {store_summary['studies']} · patients (pooled): {store_summary['patients']['total']:,} "
+               f"from {store_summary['patients']['studies_reporting']} studies · "
+               f"unknown fields: {store_summary['unknown_fraction_mean']:.0%}")
+    if store_summary["designs"]:
+        st.table([{"design": design, "studies": n} for design, n in store_summary["designs"]])
+    if store_summary["studies"]:
+        # Built only when the button is clicked
+        st.download_button("Evidence table (CSV)", data=store.export_csv_bytes,
+                           file_name="evidence_table.csv", mime="text/csv")
 
 st.markdown("---")
 st.caption("App Developed by Dr Fernando Freua and AI Prompt by Dr Thiago Guimarães. Copyright 2025")
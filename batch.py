@@ -0,0 +1,425 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import ExtractionCache, DEFAULT_CACHE_PATH
+from dedup import DEFAULT_DEDUP_PATH, DEFAULT_THRESHOLD, DedupIndex
+from evidence_store import EvidenceStore
+from extraction import DEFAULT_CASCADE_THRESHOLD, answering_model, reusable_models, run_extraction
+from models import ExtractionSchema, schema_version
+from scheduler import get_scheduler
+from search_index import DEFAULT_SEARCH_PATH, SearchIndex
+from telemetry import PROCESS, Telemetry, current as current_telemetry, start_metrics_server, use_telemetry
+from normalize import normalize_pages, normalize_text
+from utils import iter_pdf_pages
+
+# Headless corpus mode: runs the same extraction as the Streamlit app over a whole
+# folder (or manifest) of PDFs / text files with several requests in flight.
+#
+#   python batch.py ./fulltexts -o ./run --concurrency 8
+#
+# Output layout:
+#   <out>/results/<article_id>.json   one extraction per article
+#   <out>/texts/<article_id>.txt      article text as sent for extraction
+#   <out>/schemas/<version>.json      schema each result was extracted with
+#   <out>/manifest.json               run manifest (status per article)
+#   <out>/manifest.jsonl              manifest changes since it was last written (one line each)
+# Re-running with the same output folder resumes and skips finished articles;
+# reextract.py brings finished results up to date after schema changes.
+
+ARTICLE_SUFFIXES = {".pdf", ".txt", ".md"}
+MANIFEST_NAME = "manifest.json"
+JOURNAL_NAME = "manifest.jsonl"
+RESULTS_DIR = "results"
+TEXTS_DIR = "texts"
+SCHEMAS_DIR = "schemas"
+
+def discover_articles(source: Optional[str] = None, manifest_file: Optional[str] = None) -> List[Path]:
+    paths: List[Path] = []
+    if source:
+        root = Path(source)
+        if root.is_file():
+            paths.append(root)
+        else:
+            paths.extend(p for p in sorted(root.rglob("*")) if p.is_file() and p.suffix.lower() in ARTICLE_SUFFIXES)
+    if manifest_file:
+        # One path per line; blank lines and '#' comments are ignored
+        base = Path(manifest_file).parent
+        for line in Path(manifest_file).read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            p = Path(line)
+            paths.append(p if p.is_absolute() else base / p)
+    return paths
+
+def article_root(source: Optional[str] = None, manifest_file: Optional[str] = None) -> Optional[Path]:
+    # Folder the article ids are relative to: the source folder (a single file's folder),
+    # else the folder of the --manifest list
+    if source:
+        root = Path(source)
+        return root if root.is_dir() else root.parent
+    return Path(manifest_file).parent if manifest_file else None
+
+def article_id(path: Path, root: Optional[Path] = None) -> str:
+    # Readable and stable across runs: sanitized file stem + short hash of the path relative
+    # to the input root, so the inputs can move without breaking resume (the resolved path
+    # when there is no root or the file lies outside it)
+    stem = re.sub(r"[^A-Za-z0-9_.-]+", "_", path.stem)[:80] or "article"
+    key = str(path.resolve())
+    if root is not None:
+        try:
+            key = path.resolve().relative_to(root.resolve()).as_posix()
+        except ValueError:
+            pass
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]
+    return f"{stem}-{digest}"
+
+def read_article(path: Path, normalize: bool = True, strip_back_matter: bool = True) -> Tuple[str, Optional[Dict[str, Any]]]:
+    # Article text plus the clean-up report (None when normalization is off)
+    if path.suffix.lower() == ".pdf":
+        # Pages stream from the file into the clean-up: memory does not grow with the PDF
+        pages = iter_pdf_pages(path)
+        if normalize:
+            return normalize_pages(pages, strip_back_matter)
+        return "\n".join(pages).strip(), None
+    text = path.read_text(encoding="utf-8", errors="replace").strip()
+    return normalize_text(text, strip_back_matter) if normalize else (text, None)
+
+def load_article_text(path: Path, normalize: bool = True) -> str:
+    return read_article(path, normalize)[0]
+
+def write_json_atomic(path: Path, data: Any) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+def save_schema_snapshot(out_dir: Path, schema: Optional[Dict[str, Any]] = None) -> str:
+    schema = schema or ExtractionSchema.json_schema()
+    version = schema_version(schema)
+    path = out_dir / SCHEMAS_DIR / f"{version}.json"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(path, schema)
+    return version
+
+class RunManifest:
+    # Thread-safe run manifest. Every state change is appended to the journal
+    # (manifest.jsonl) as one line, so an interrupted run can resume from it without
+    # rewriting the whole manifest per article; compact() folds the journal into
+    # manifest.json at the end of a run. Readers see both.
+
+    def __init__(self, out_dir: Path):
+        self.path = out_dir / MANIFEST_NAME
+        self.journal_path = out_dir / JOURNAL_NAME
+        self.lock = threading.Lock()
+        self.data: Dict[str, Any] = {"articles": {}}
+        self._journal = None
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.data.setdefault("articles", {})
+        if self.journal_path.exists():
+            with open(self.journal_path, encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # last line of a run killed mid-write
+                    self._apply(record)
+
+    @property
+    def articles(self) -> Dict[str, Dict[str, Any]]:
+        return self.data["articles"]
+
+    def is_done(self, aid: str, out_dir: Path) -> bool:
+        entry = self.articles.get(aid)
+        return bool(entry and entry.get("status") == "done" and (out_dir / entry["output"]).exists())
+
+    def update(self, aid: str, **fields: Any) -> None:
+        self._append({"article": aid, "fields": fields, "at": time.time()})
+
+    def set_run_info(self, **fields: Any) -> None:
+        self._append({"run": fields})
+
+    def compact(self) -> None:
+        # manifest.json with every change so far; the journal starts over
+        with self.lock:
+            write_json_atomic(self.path, self.data)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self.journal_path.unlink(missing_ok=True)
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        if "article" in record:
+            self.articles.setdefault(record["article"], {}).update(record["fields"])
+            self.data["updated_at"] = record["at"]
+        else:
+            self.data.update(record["run"])
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        with self.lock:
+            self._apply(record)
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._journal.flush()
+
+def process_article(
+    scheduler,
+    path: Path,
+    out_dir: Path,
+    options: Dict[str, Any],
+    cache: Optional[ExtractionCache] = None,
+    run_telemetry: Optional[Telemetry] = None,
+    store: Optional[EvidenceStore] = None,
+    dedup: Optional[DedupIndex] = None,
+    reuse_duplicates: bool = True,
+    normalize: bool = True,
+    strip_back_matter: bool = True,
+    search: Optional[SearchIndex] = None,
+    root: Optional[Path] = None,
+) -> Dict[str, Any]:
+    aid = article_id(path, root)
+    t0 = time.time()
+    # Per-article collector (forwards to the process totals): tokens, cost, stage timings
+    with use_telemetry(Telemetry(parent=run_telemetry or current_telemetry(), article=aid)) as tel:
+        text, cleanup = read_article(path, normalize, strip_back_matter)
+        if not text:
+            raise ValueError("No text could be extracted from the article.")
+        # Near-duplicate of an article seen before (this run or an earlier one)?
+        duplicate = dedup.check_and_add(aid, text, source=str(path)) if dedup is not None else None
+        # Only an extraction made with this run's models and the current schema is reused, so
+        # the model recorded with it stays true; any other is redone
+        version = schema_version()
+        data = (dedup.result(duplicate["doc_id"], schema_version=version, model=reusable_models(options))
+                if duplicate and reuse_duplicates else None)
+        reused, context, filled = data is not None, None, []
+        model = dedup.stored_result(duplicate["doc_id"])["model"] if reused else options["model"]
+        if data is None:
+            data, context, filled = run_extraction(scheduler, text, cache=cache, **options)
+            model = answering_model(options["model"], options.get("cascade_model"), filled)
+        if dedup is not None:
+            dedup.attach_result(aid, data, model=model, schema_version=version)
+    output = Path(RESULTS_DIR) / f"{aid}.json"
+    write_json_atomic(out_dir / output, data)
+    (out_dir / TEXTS_DIR / f"{aid}.txt").write_text(text, encoding="utf-8")
+    if store is not None:
+        store.add(aid, data, source=str(path), model=model)
+    if search is not None:
+        search.add(aid, data, text=text, source=str(path), model=model)
+    info = {"output": str(output), "text": str(Path(TEXTS_DIR) / f"{aid}.txt"), "chars": len(text),
+            "seconds": round(time.time() - t0, 3), "schema_version": version, "telemetry": tel.summary()}
+    if cleanup is not None:
+        info["normalization"] = cleanup
+    if duplicate:
+        info.update(duplicate_of=duplicate["doc_id"], similarity=duplicate["similarity"], reused_extraction=reused)
+    if context is not None:
+        info["context"] = context
+    if filled:
+        # Per-field provenance: these were answered by the cascade model, the rest by the first tier
+        info.update(model=model, cascade_filled=filled)
+    return info
+
+def run_corpus(
+    paths: List[Path],
+    out_dir: str,
+    scheduler,
+    concurrency: int = 4,
+    model: str = "gpt-4.1-mini",
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    sectioned: bool = False,
+    context_budget: Optional[int] = None,
+    cascade_model: Optional[str] = None,
+    cascade_threshold: float = DEFAULT_CASCADE_THRESHOLD,
+    cache: Optional[ExtractionCache] = None,
+    store: Optional[EvidenceStore] = None,
+    dedup: Optional[DedupIndex] = None,
+    reuse_duplicates: bool = True,
+    normalize: bool = True,
+    strip_back_matter: bool = True,
+    search: Optional[SearchIndex] = None,
+    root: Optional[Path] = None,
+    progress=None,
+) -> Dict[str, Any]:
+    out = Path(out_dir)
+    (out / RESULTS_DIR).mkdir(parents=True, exist_ok=True)
+    (out / TEXTS_DIR).mkdir(exist_ok=True)
+    save_schema_snapshot(out)
+    manifest = RunManifest(out)
+    options = dict(model=model, temperature=temperature, max_tokens=max_tokens,
+                   force_english=force_english, allow_unknown=allow_unknown, sectioned=sectioned,
+                   context_budget=context_budget, cascade_model=cascade_model, cascade_threshold=cascade_threshold)
+    previous = manifest.data.get("options") or {}
+    changed = sorted(k for k in {*previous, *options} if previous and previous.get(k) != options.get(k))
+    manifest.set_run_info(options=options, started_at=time.time(),
+                          text_normalization={"enabled": normalize, "strip_back_matter": strip_back_matter})
+
+    # Entries of runs from before the ids were relative to the input root match by source
+    legacy = {entry["source"]: aid for aid, entry in manifest.articles.items() if entry.get("source")}
+    pending = []
+    for p in paths:
+        aid = article_id(p, root)
+        if manifest.is_done(aid, out) or manifest.is_done(legacy.get(str(p), aid), out):
+            continue
+        manifest.update(aid, source=str(p), status="pending")
+        pending.append((aid, p))
+    if changed and len(pending) < len(paths):
+        warnings.warn(f"Resuming {out} with changed options ({', '.join(changed)}): the {len(paths) - len(pending)} "
+                      f"articles finished before keep their results; use a new output folder to redo them.",
+                      stacklevel=2)
+
+    counts = {"total": len(paths), "skipped": len(paths) - len(pending), "done": 0, "failed": 0,
+              "duplicates": 0, "reused": 0}
+    if changed:
+        counts["options_changed"] = changed
+    run_telemetry = Telemetry(parent=current_telemetry())
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {pool.submit(process_article, scheduler, p, out, options, cache, run_telemetry, store,
+                               dedup, reuse_duplicates, normalize, strip_back_matter, search, root): aid
+                   for aid, p in pending}
+        for fut in as_completed(futures):
+            aid = futures[fut]
+            try:
+                info = fut.result()
+                manifest.update(aid, status="done", error=None, finished_at=time.time(), **info)
+                counts["done"] += 1
+                counts["duplicates"] += int("duplicate_of" in info)
+                counts["reused"] += int(info.get("reused_extraction", False))
+            except Exception as e:
+                manifest.update(aid, status="failed", error=str(e), finished_at=time.time())
+                counts["failed"] += 1
+            if progress is not None:
+                progress(aid, manifest.articles[aid], counts)
+
+    if store is not None:
+        store.flush()
+    if hasattr(scheduler, "stats"):
+        counts["scheduler"] = scheduler.stats()
+    if cache is not None:
+        counts["cache"] = cache.stats()
+    counts["telemetry"] = run_telemetry.summary()
+    manifest.set_run_info(finished_at=time.time(), counts=counts)
+    manifest.compact()
+    return counts
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run structured extraction over a corpus of articles.")
+    parser.add_argument("source", nargs="?", help="Folder with PDF/text files, or a single file")
+    parser.add_argument("--manifest", help="Text file listing article paths, one per line")
+    parser.add_argument("-o", "--out", required=True, help="Output folder (re-use it to resume a run)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Requests in flight")
+    parser.add_argument("--rpm", type=float, default=None, help="Requests-per-minute budget (default: OPENAI_RPM)")
+    parser.add_argument("--tpm", type=float, default=None, help="Tokens-per-minute budget (default: OPENAI_TPM)")
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL", "gpt-4.1-mini"))
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--max-tokens", type=int, default=5000)
+    parser.add_argument("--keep-language", action="store_true", help="Do not force output in English")
+    parser.add_argument("--no-unknown", action="store_true", help="Leave missing fields blank instead of 'unknown'")
+    parser.add_argument("--sectioned", action="store_true", help="One concurrent request per schema section")
+    parser.add_argument("--context-budget", type=int, default=None,
+                        help="Send only the most relevant passages, within this many input tokens per request")
+    parser.add_argument("--cascade-model", default=None,
+                        help="Stronger model asked again for the fields --model left unknown (e.g. gpt-4.1)")
+    parser.add_argument("--cascade-threshold", type=float, default=DEFAULT_CASCADE_THRESHOLD,
+                        help="Escalate a section's unknown fields when at least this fraction of the section is unknown")
+    parser.add_argument("--raw-text", action="store_true",
+                        help="Send the extracted text as is (no header/footer, hyphenation or whitespace clean-up)")
+    parser.add_argument("--keep-back-matter", action="store_true",
+                        help="Keep reference lists and acknowledgements in the text")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Extraction cache (SQLite file)")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the model")
+    parser.add_argument("--dedup", choices=["reuse", "flag", "off"], default="reuse",
+                        help="Near-duplicates of already indexed articles: reuse their extraction, only flag them, or skip the check")
+    parser.add_argument("--dedup-index", default=DEFAULT_DEDUP_PATH, help="Near-duplicate index (SQLite file)")
+    parser.add_argument("--dedup-threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Estimated Jaccard similarity above which articles count as duplicates")
+    parser.add_argument("--store", help="Also append every result to this evidence store folder")
+    parser.add_argument("--search-index", default=DEFAULT_SEARCH_PATH, help="Search index to add every article to (SQLite file)")
+    parser.add_argument("--no-search-index", action="store_true", help="Do not index the articles for search")
+    parser.add_argument("--metrics-out", help="Write Prometheus-format metrics to this file at the end")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port during the run")
+    args = parser.parse_args(argv)
+
+    if not args.source and not args.manifest:
+        parser.error("provide a source folder/file or --manifest")
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        parser.error("OPENAI_API_KEY is not set")
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    paths = discover_articles(args.source, args.manifest)
+    if not paths:
+        print("No articles found.", file=sys.stderr)
+        return 1
+
+    def progress(aid: str, entry: Dict[str, Any], counts: Dict[str, int]) -> None:
+        finished = counts["done"] + counts["failed"]
+        pending = counts["total"] - counts["skipped"]
+        suffix = f" ({entry['error']})" if entry.get("status") == "failed" else ""
+        print(f"[{finished}/{pending}] {entry.get('status')}: {aid}{suffix}", flush=True)
+
+    counts = run_corpus(
+        paths,
+        args.out,
+        scheduler=get_scheduler(api_key, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                max_concurrency=args.concurrency),
+        concurrency=args.concurrency,
+        model=args.model,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        force_english=not args.keep_language,
+        allow_unknown=not args.no_unknown,
+        sectioned=args.sectioned,
+        context_budget=args.context_budget,
+        cascade_model=args.cascade_model,
+        cascade_threshold=args.cascade_threshold,
+        cache=None if args.no_cache else ExtractionCache(args.cache),
+        store=EvidenceStore(args.store) if args.store else None,
+        dedup=None if args.dedup == "off" else DedupIndex(args.dedup_index, threshold=args.dedup_threshold),
+        reuse_duplicates=args.dedup == "reuse",
+        normalize=not args.raw_text,
+        strip_back_matter=not args.keep_back_matter,
+        search=None if args.no_search_index else SearchIndex(args.search_index),
+        root=article_root(args.source, args.manifest),
+        progress=progress,
+    )
+    if args.metrics_out:
+        Path(args.metrics_out).write_text(PROCESS.prometheus_text(), encoding="utf-8")
+    print(f"Done: {counts['done']} extracted, {counts['skipped']} skipped, {counts['failed']} failed.")
+    print(f"Tokens: {counts['telemetry']['prompt_tokens']} in ({counts['telemetry']['cached_tokens']} from the prompt cache, "
+          f"{counts['telemetry']['prompt_cache_hit_rate']:.0%}) / {counts['telemetry']['completion_tokens']} out, "
+          f"~${counts['telemetry']['cost_usd']:.4f}.")
+    if counts["telemetry"]["text_raw_tokens"]:
+        print(f"Text clean-up: {counts['telemetry']['text_saved_tokens']} of {counts['telemetry']['text_raw_tokens']} "
+              f"estimated input tokens removed "
+              f"({100 * counts['telemetry']['text_saved_tokens'] / counts['telemetry']['text_raw_tokens']:.0f}%).")
+    if args.cascade_model:
+        for model, usage in counts["telemetry"]["models"].items():
+            print(f"  {model}: {usage['requests']} requests, {usage['prompt_tokens']} in / "
+                  f"{usage['completion_tokens']} out, ~${usage['cost_usd']:.4f}")
+        stages = counts["telemetry"]["stages"]
+        for stage in ("cascade_first_tier", "cascade_escalation"):
+            if stage in stages:
+                print(f"  {stage}: {stages[stage]['count']} calls, mean {stages[stage]['mean_s']}s")
+    if counts["duplicates"]:
+        print(f"Near-duplicates: {counts['duplicates']} flagged, {counts['reused']} reused an earlier extraction.")
+    if "cache" in counts:
+        print(f"Cache: {counts['cache']['hits']} hits, {counts['cache']['misses']} misses.")
+    return 0 if counts["failed"] == 0 else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
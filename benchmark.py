@@ -0,0 +1,346 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pypdf import PdfReader
+
+from batch import run_corpus
+from mock_server import sample_document, start_mock_server
+from models import compiled_schema
+from scheduler import RequestScheduler
+from normalize import normalize_pages
+from utils import estimate_tokens, extract_pages_from_pdf, extract_text_from_pdf, iter_pdf_pages, render_markdown_report
+
+# Reproducible end-to-end benchmarks: a synthetic corpus of scientific-looking PDFs and
+# the local mock server (mock_server.py) standing in for the chat-completions endpoint.
+#
+#   python benchmark.py --out bench_results.json
+#   python benchmark.py --quick --latency 0.2 --rate-limit-rate 0.05
+#
+# Measured: PDF parse throughput (pages/s, sequential and process pool), input tokens
+# removed by text clean-up (normalize.py), the memory ceiling of ingesting one large
+# image-heavy PDF (in memory vs streamed), end-to-end articles/min at several concurrency
+# levels, peak RSS of each phase and report rendering time. Every phase runs in a fresh
+# process so its peak RSS is its own. The results file is plain JSON with sorted keys, so two runs (e.g. before/after a commit) diff cleanly.
+
+DEFAULT_PAGES = (4, 12, 24, 48)
+DEFAULT_CONCURRENCY = (1, 4, 16)
+# File sizes (MB) of the image-heavy PDFs of the ingestion memory phase
+DEFAULT_INGEST_MB = (10, 50, 150)
+INGEST_PAGES = 40
+
+_WORDS = (
+    "patient patients treatment therapy mutation variant plasma serum level cohort follow-up months "
+    "improvement ataxia seizures neuropathy imaging white matter lesion onset baseline dose daily "
+    "supplementation outcome score significant randomized controlled trial retrospective analysis "
+    "clinical features examination symptoms diagnosis genetic sequencing laboratory findings"
+).split()
+_SECTIONS = ("Abstract", "Introduction", "Methods", "Results", "Discussion", "Conclusions", "References")
+
+# --- synthetic corpus -----------------------------------------------------------
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 18))]
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words)), f"{rng.randint(1, 90)}.{rng.randint(0, 9)} mg/kg")
+    return " ".join(words).capitalize() + "."
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def _wrap(text: str, width: int = 95) -> List[str]:
+    # Typeset-looking lines: long words crossing the margin are hyphenated
+    lines, line = [], ""
+    for word in text.split():
+        if len(line) + 1 + len(word) <= width:
+            line = f"{line} {word}" if line else word
+        elif len(word) >= 8 and width - len(line) >= 5:
+            cut = width - len(line) - 2
+            lines.append(f"{line} {word[:cut]}-")
+            line = word[cut:]
+        else:
+            lines.append(line)
+            line = word
+    return lines + [line] if line else lines
+
+def synthetic_article_lines(n_pages: int, rng: random.Random, lines_per_page: int = 55) -> List[List[str]]:
+    # Page-wrapped lines: title block, then the usual sections spread over the pages,
+    # ending with a reference list; every page carries a running header and a page number
+    lines = ["Long-term treatment outcomes in a rare neurometabolic disorder: a case series",
+             f"A. Author, B. Author, C. Author ({rng.randint(1995, 2024)})", ""]
+    body_lines = lines_per_page - 3
+    total = n_pages * body_lines
+    per_section = max(4, (total - len(lines)) // len(_SECTIONS) - 2)
+    for section in _SECTIONS:
+        lines += [section, ""]
+        body: List[str] = []
+        while len(body) < per_section:
+            if section == "References":
+                body.append(f"{len(body) + 1}. Author X, Author Y. {_sentence(rng)} J Neurol. {rng.randint(1990, 2024)}.")
+                continue
+            body += _wrap(" ".join(_sentence(rng) for _ in range(rng.randint(2, 5))))
+            body.append("")
+        lines += body[:per_section]
+    lines = lines[:total]
+    journal = f"Journal of Rare Neurometabolic Disease {rng.randint(2000, 2024)}; {rng.randint(1, 60)}: 101-{100 + n_pages}"
+    return [[journal, ""] + lines[i:i + body_lines] + [f"{i // body_lines + 1}"]
+            for i in range(0, len(lines), body_lines)]
+
+def make_pdf(pages: List[List[str]], image_bytes: int = 0, seed: int = 0) -> bytes:
+    # Minimal hand-written PDF (one Helvetica text stream per page): no dependency beyond
+    # the standard library, and pypdf extracts it like any text-layer article. With
+    # image_bytes every page also draws an uncompressed greyscale image of about that
+    # size (scanned figures / supplements: large files, little text).
+    per_page = 3 if image_bytes else 2
+    objs = ["<< /Type /Catalog /Pages 2 0 R >>",
+            "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{4 + per_page * i} 0 R" for i in range(len(pages))), len(pages)),
+            "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    rng = random.Random(seed)
+    width = 1024
+    height = max(1, image_bytes // width)
+    for i, lines in enumerate(pages):
+        content = "BT /F1 9 Tf 50 760 Td 12.5 TL " + " ".join(f"({_pdf_escape(l)}) '" for l in lines) + " ET"
+        xobject = ""
+        if image_bytes:
+            content += " q 512 0 0 384 50 50 cm /Im0 Do Q"
+            xobject = f" /XObject << /Im0 {6 + per_page * i} 0 R >>"
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                    f"/Resources << /Font << /F1 3 0 R >>{xobject} >> /Contents {5 + per_page * i} 0 R >>")
+        objs.append(f"<< /Length {len(content.encode('latin-1'))} >>\nstream\n{content}\nendstream")
+        if image_bytes:
+            pixels = rng.randbytes(width * height).decode("latin-1")
+            objs.append(f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceGray "
+                        f"/BitsPerComponent 8 /Length {width * height} >>\nstream\n{pixels}\nendstream")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objs):
+        offsets.append(len(out))
+        out += f"{i + 1} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode("ascii")
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode("ascii")
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii")
+    return bytes(out)
+
+def write_corpus(directory: Path, page_counts: Tuple[int, ...], articles_per_size: int, seed: int = 0) -> List[Path]:
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for n_pages in page_counts:
+        for k in range(articles_per_size):
+            path = directory / f"synthetic_{n_pages:03d}p_{k:02d}.pdf"
+            path.write_bytes(make_pdf(synthetic_article_lines(n_pages, rng)))
+            paths.append(path)
+    return paths
+
+# --- phases (each runs in its own process) -------------------------------------
+
+def _peak_rss_mb() -> float:
+    # VmHWM where there is /proc: ru_maxrss survives exec, so a spawned phase would
+    # start from the parent's peak. ru_maxrss is KiB on Linux, bytes on macOS.
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def bench_parse(paths: List[str], workers: Optional[int], repeat: int) -> Dict[str, Any]:
+    data = [Path(p).read_bytes() for p in paths]
+    pages = sum(len(PdfReader(io.BytesIO(d)).pages) for d in data)
+    best = float("inf")
+    parsed: List[List[str]] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        parsed = [extract_pages_from_pdf(io.BytesIO(d), workers=workers) for d in data]
+        best = min(best, time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    cleaned = [normalize_pages(p)[0] for p in parsed]
+    normalize_s = time.perf_counter() - t0
+    raw_tokens = sum(estimate_tokens("\n".join(p)) for p in parsed)
+    clean_tokens = sum(estimate_tokens(t) for t in cleaned)
+    return {"workers": workers or os.cpu_count(), "pages": pages, "chars": sum(len("\n".join(p)) for p in parsed),
+            "seconds": round(best, 4), "pages_per_s": round(pages / best, 1), "normalize_seconds": round(normalize_s, 4),
+            "raw_tokens": raw_tokens, "normalized_tokens": clean_tokens,
+            "tokens_saved_pct": round(100 * (raw_tokens - clean_tokens) / raw_tokens, 1) if raw_tokens else 0.0,
+            "peak_rss_mb": _peak_rss_mb()}
+
+def bench_ingest(path: str, streamed: bool) -> Dict[str, Any]:
+    # Memory ceiling of one upload: streamed = pages parsed lazily from the file straight
+    # into the text clean-up; otherwise the whole PDF is read into memory first (as an
+    # in-memory upload is) and every page's text is collected before joining
+    baseline = _peak_rss_mb()
+    t0 = time.perf_counter()
+    if streamed:
+        text = normalize_pages(iter_pdf_pages(path))[0]
+    else:
+        text = extract_text_from_pdf(io.BytesIO(Path(path).read_bytes()))
+    elapsed = time.perf_counter() - t0
+    peak = _peak_rss_mb()
+    return {"mode": "streamed" if streamed else "in_memory", "file_mb": round(os.path.getsize(path) / 2**20, 1),
+            "chars": len(text), "seconds": round(elapsed, 3), "peak_rss_mb": peak,
+            "rss_growth_mb": round(peak - baseline, 1)}
+
+def bench_end_to_end(paths: List[str], concurrency: int, mock: Dict[str, Any], sectioned: bool,
+                     context_budget: Optional[int]) -> Dict[str, Any]:
+    server, base_url = start_mock_server(**mock)
+    try:
+        scheduler = RequestScheduler(api_key="benchmark", base_url=base_url, max_concurrency=concurrency,
+                                     backoff_base=0.05, backoff_max=1.0)
+        with tempfile.TemporaryDirectory() as out_dir:
+            t0 = time.perf_counter()
+            counts = run_corpus([Path(p) for p in paths], out_dir, scheduler, concurrency=concurrency,
+                                sectioned=sectioned, context_budget=context_budget)
+            elapsed = time.perf_counter() - t0
+    finally:
+        server.shutdown()
+    sched = counts.get("scheduler", {})
+    tel = counts["telemetry"]
+    return {
+        "concurrency": concurrency,
+        "articles": counts["done"],
+        "failed": counts["failed"],
+        "seconds": round(elapsed, 3),
+        "articles_per_min": round(60 * counts["done"] / elapsed, 1) if elapsed else 0.0,
+        "requests": sched.get("requests", 0),
+        "retries": sched.get("retries", 0),
+        "rate_limited": sched.get("rate_limited", 0),
+        "prompt_tokens": tel["prompt_tokens"],
+        "cached_tokens": tel["cached_tokens"],
+        "prompt_cache_hit_rate": tel["prompt_cache_hit_rate"],
+        "completion_tokens": tel["completion_tokens"],
+        "model_wait_mean_s": tel["stages"].get("model_wait", {}).get("mean_s", 0.0),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+def bench_render(iterations: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    schema = compiled_schema()["schema"]
+    docs = [sample_document(schema, rng) for _ in range(20)]
+    t0 = time.perf_counter()
+    for i in range(iterations):
+        render_markdown_report(docs[i % len(docs)])
+    elapsed = time.perf_counter() - t0
+    return {"iterations": iterations, "seconds": round(elapsed, 4),
+            "mean_ms": round(1000 * elapsed / iterations, 3), "peak_rss_mb": _peak_rss_mb()}
+
+def _isolated(fn: Callable, *args: Any) -> Dict[str, Any]:
+    # Fresh interpreter per phase (spawn) so peak RSS and caches don't leak between phases
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+# --- driver ---------------------------------------------------------------------
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+def run_benchmarks(
+    page_counts: Tuple[int, ...] = DEFAULT_PAGES,
+    articles_per_size: int = 3,
+    concurrency_levels: Tuple[int, ...] = DEFAULT_CONCURRENCY,
+    mock: Optional[Dict[str, Any]] = None,
+    sectioned: bool = False,
+    context_budget: Optional[int] = None,
+    parse_repeat: int = 3,
+    render_iterations: int = 200,
+    ingest_mb: Tuple[int, ...] = DEFAULT_INGEST_MB,
+    seed: int = 0,
+    log=print,
+) -> Dict[str, Any]:
+    mock = {"seed": seed, **(mock or {})}
+    results: Dict[str, Any] = {
+        "meta": {"git_commit": _git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "started_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "config": {"page_counts": list(page_counts), "articles_per_size": articles_per_size,
+                   "concurrency_levels": list(concurrency_levels), "mock": mock, "sectioned": sectioned,
+                   "context_budget": context_budget, "ingest_mb": list(ingest_mb), "seed": seed},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [str(p) for p in write_corpus(Path(tmp) / "corpus", page_counts, articles_per_size, seed)]
+
+        results["parse"] = {}
+        for n_pages in page_counts:
+            subset = [p for p in paths if f"_{n_pages:03d}p_" in p]
+            for label, workers in (("sequential", 1), ("parallel", None)):
+                r = _isolated(bench_parse, subset, workers, parse_repeat)
+                results["parse"].setdefault(f"{n_pages}p", {})[label] = r
+                log(f"parse {n_pages:>3}p {label:<10} {r['pages_per_s']:>8} pages/s  "
+                    f"clean-up -{r['tokens_saved_pct']}% tokens  rss {r['peak_rss_mb']} MB")
+
+        results["ingest"] = []
+        for size_mb in ingest_mb:
+            path = Path(tmp) / f"scanned_{size_mb}mb.pdf"
+            path.write_bytes(make_pdf(synthetic_article_lines(INGEST_PAGES, random.Random(seed)),
+                                      image_bytes=size_mb * 2**20 // INGEST_PAGES, seed=seed))
+            for streamed in (False, True):
+                r = _isolated(bench_ingest, str(path), streamed)
+                results["ingest"].append(r)
+                log(f"ingest {r['file_mb']:>6} MB {r['mode']:<10} +{r['rss_growth_mb']} MB rss  {r['seconds']}s")
+            path.unlink()
+
+        results["end_to_end"] = []
+        for c in concurrency_levels:
+            r = _isolated(bench_end_to_end, paths, c, mock, sectioned, context_budget)
+            results["end_to_end"].append(r)
+            log(f"e2e  concurrency {c:>3} {r['articles_per_min']:>8} articles/min  "
+                f"429s {r['rate_limited']}  rss {r['peak_rss_mb']} MB")
+
+        results["render"] = _isolated(bench_render, render_iterations, seed)
+        log(f"render {results['render']['mean_ms']} ms/report")
+    return results
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark PDF parsing, end-to-end extraction and rendering "
+                                                 "against a local mock chat-completions server.")
+    parser.add_argument("--out", default="bench_results.json", help="Machine-readable results file (JSON)")
+    parser.add_argument("--pages", type=int, nargs="+", default=list(DEFAULT_PAGES), help="Page counts of the synthetic PDFs")
+    parser.add_argument("--articles-per-size", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY))
+    parser.add_argument("--sectioned", action="store_true", help="Benchmark per-section extraction")
+    parser.add_argument("--context-budget", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock: seconds before a completion starts")
+    parser.add_argument("--tokens-per-second", type=float, default=None, help="Mock: output speed")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="Mock: 429 beyond this many in flight")
+    parser.add_argument("--rpm", type=int, default=None, help="Mock: 429 beyond this many requests per minute")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Mock: fraction of requests answered with 429")
+    parser.add_argument("--ingest-mb", type=int, nargs="+", default=list(DEFAULT_INGEST_MB),
+                        help="File sizes (MB) of the image-heavy PDFs used to measure ingestion memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="Small corpus and few repeats (smoke run)")
+    args = parser.parse_args(argv)
+
+    pages, per_size, repeat, render_iterations = tuple(args.pages), args.articles_per_size, 3, 200
+    ingest_mb = tuple(args.ingest_mb)
+    if args.quick:
+        pages, per_size, repeat, render_iterations, ingest_mb = (2, 20), 1, 1, 50, (5, 20)
+    mock = {"latency": args.latency, "tokens_per_second": args.tokens_per_second,
+            "max_concurrent": args.max_concurrent, "rpm": args.rpm, "rate_limit_rate": args.rate_limit_rate}
+    results = run_benchmarks(pages, per_size, tuple(args.concurrency), mock, args.sectioned, args.context_budget,
+                             repeat, render_iterations, ingest_mb, args.seed)
+    with open(args.out, "w", encoding="utf-8") as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+    print(f"Results written to {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,369 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from batch import RESULTS_DIR, article_id, article_root, discover_articles, load_article_text, write_json_atomic
+from cache import ExtractionCache, DEFAULT_CACHE_PATH
+from extraction import build_messages, build_response_format, extraction_cache_key, parse_json_content
+from models import ExtractionSchema
+from scheduler import get_scheduler
+from telemetry import current as current_telemetry
+from utils import render_markdown_report
+
+# Offline bulk mode on the provider Batch API: cheaper and outside the synchronous rate
+# limits, at the price of a completion window of up to 24h. Meant for overnight runs.
+#
+#   python bulk.py run ./fulltexts -o ./bulk          # compile + submit + poll + ingest (+ retries)
+#   python bulk.py compile ./fulltexts -o ./bulk      # only build bulk/requests.jsonl
+#   python bulk.py submit -o ./bulk                   # submit compiled/failed lines
+#   python bulk.py wait -o ./bulk                     # poll open batches and ingest their results
+#   python bulk.py status -o ./bulk
+#
+# State lives in <out>/bulk_state.json, so every step can be re-run after an interruption.
+# Results use the same layout as batch.py: <out>/results/<article_id>.json (+ .md).
+# Point OPENAI_BASE_URL at mock_server.py to exercise the whole cycle locally.
+
+STATE_NAME = "bulk_state.json"
+REQUESTS_NAME = "requests.jsonl"
+BATCHES_DIR = "batches"
+ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+BATCH_DISCOUNT = 0.5
+
+# Provider limits per batch input file
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BYTES_PER_BATCH = 190 * 1024 * 1024
+
+class BulkState:
+    def __init__(self, out_dir: Path):
+        self.out_dir = out_dir
+        self.path = out_dir / STATE_NAME
+        self.data: Dict[str, Any] = {"articles": {}, "batches": []}
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+
+    @property
+    def articles(self) -> Dict[str, Dict[str, Any]]:
+        return self.data["articles"]
+
+    @property
+    def batches(self) -> List[Dict[str, Any]]:
+        return self.data["batches"]
+
+    def save(self) -> None:
+        self.data["updated_at"] = time.time()
+        write_json_atomic(self.path, self.data)
+
+    def counts(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for entry in self.articles.values():
+            out[entry["status"]] = out.get(entry["status"], 0) + 1
+        return out
+
+def _write_result(out_dir: Path, aid: str, data: Dict[str, Any]) -> str:
+    output = Path(RESULTS_DIR) / f"{aid}.json"
+    write_json_atomic(out_dir / output, data)
+    (out_dir / output.with_suffix(".md")).write_text(render_markdown_report(data), encoding="utf-8")
+    return str(output)
+
+def compile_requests(
+    paths: List[Path],
+    out_dir: str,
+    model: str = "gpt-4.1-mini",
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    context_budget: Optional[int] = None,
+    cache: Optional[ExtractionCache] = None,
+    root: Optional[Path] = None,
+) -> Dict[str, int]:
+    # One request line per article, in the same format the synchronous path sends.
+    # Articles already done (or already in the extraction cache) are not compiled again.
+    out = Path(out_dir)
+    (out / RESULTS_DIR).mkdir(parents=True, exist_ok=True)
+    state = BulkState(out)
+    options = dict(model=model, temperature=temperature, max_tokens=max_tokens, force_english=force_english,
+                   allow_unknown=allow_unknown, context_budget=context_budget)
+    state.data["options"] = options
+    schema = ExtractionSchema.json_schema()
+    response_format = build_response_format(schema)
+
+    counts = {"compiled": 0, "cached": 0, "skipped": 0, "failed": 0}
+    with open(out / REQUESTS_NAME, "a", encoding="utf-8") as fh:
+        for p in paths:
+            aid = article_id(p, root)
+            entry = state.articles.get(aid)
+            if entry and entry["status"] in ("compiled", "submitted", "done"):
+                counts["skipped"] += 1
+                continue
+            try:
+                text = load_article_text(p)
+                if not text:
+                    raise ValueError("No text could be extracted from the article.")
+            except Exception as e:
+                state.articles[aid] = {"source": str(p), "status": "unreadable", "error": str(e), "attempts": 0}
+                counts["failed"] += 1
+                continue
+
+            messages = build_messages(text, force_english, allow_unknown, context_budget)
+            key = extraction_cache_key(messages, model, temperature, max_tokens, schema)
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None:
+                output = _write_result(out, aid, cached)
+                state.articles[aid] = {"source": str(p), "status": "done", "output": output, "attempts": 0, "cached": True}
+                counts["cached"] += 1
+                continue
+
+            line = {
+                "custom_id": aid,
+                "method": "POST",
+                "url": ENDPOINT,
+                "body": {
+                    "model": model,
+                    "temperature": temperature,
+                    "max_tokens": max_tokens,
+                    "messages": messages,
+                    "response_format": response_format,
+                },
+            }
+            fh.write(json.dumps(line, ensure_ascii=False) + "\n")
+            state.articles[aid] = {"source": str(p), "status": "compiled", "cache_key": key, "attempts": 0}
+            counts["compiled"] += 1
+    state.save()
+    return counts
+
+def _iter_request_lines(out: Path, wanted: set) -> Iterator[str]:
+    # Streams requests.jsonl; a re-compiled article keeps only its most recent line
+    latest: Dict[str, int] = {}
+    with open(out / REQUESTS_NAME, encoding="utf-8") as fh:
+        for offset, line in enumerate(fh):
+            cid = json.loads(line)["custom_id"]
+            if cid in wanted:
+                latest[cid] = offset
+    keep = set(latest.values())
+    with open(out / REQUESTS_NAME, encoding="utf-8") as fh:
+        for offset, line in enumerate(fh):
+            if offset in keep:
+                yield line
+
+def submit_pending(client, out_dir: str, max_attempts: int = 3) -> List[str]:
+    # Submits every compiled line plus failed lines that still have attempts left;
+    # a partially failed batch therefore only resends its failed lines.
+    out = Path(out_dir)
+    state = BulkState(out)
+    wanted = {aid for aid, e in state.articles.items()
+              if e["status"] == "compiled" or (e["status"] == "failed" and e.get("attempts", 0) < max_attempts)}
+    if not wanted:
+        return []
+    (out / BATCHES_DIR).mkdir(exist_ok=True)
+
+    submitted: List[str] = []
+    part: List[str] = []
+    size = 0
+
+    def flush() -> None:
+        nonlocal part, size
+        if not part:
+            return
+        index = len(state.batches)
+        input_path = out / BATCHES_DIR / f"input-{index:04d}.jsonl"
+        input_path.write_text("".join(part), encoding="utf-8")
+        with open(input_path, "rb") as fh:
+            file_obj = client.files.create(file=fh, purpose="batch")
+        batch = client.batches.create(input_file_id=file_obj.id, endpoint=ENDPOINT, completion_window="24h")
+        ids = [json.loads(line)["custom_id"] for line in part]
+        state.batches.append({"id": batch.id, "input": str(input_path.relative_to(out)), "file_id": file_obj.id,
+                              "status": batch.status, "custom_ids": ids, "ingested": False,
+                              "submitted_at": time.time()})
+        for aid in ids:
+            entry = state.articles[aid]
+            entry.update(status="submitted", batch_id=batch.id, attempts=entry.get("attempts", 0) + 1)
+        state.save()
+        submitted.append(batch.id)
+        part, size = [], 0
+
+    for line in _iter_request_lines(out, wanted):
+        if part and (len(part) >= MAX_REQUESTS_PER_BATCH or size + len(line) > MAX_BYTES_PER_BATCH):
+            flush()
+        part.append(line)
+        size += len(line.encode("utf-8"))
+    flush()
+    return submitted
+
+def wait_for_batch(client, batch_id: str, initial_delay: float = 5.0, max_delay: float = 300.0, timeout: Optional[float] = None):
+    # Exponential backoff with jitter between status checks
+    delay = initial_delay
+    started = time.time()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        if timeout is not None and time.time() - started > timeout:
+            raise TimeoutError(f"Batch {batch_id} still '{batch.status}' after {timeout:.0f}s")
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(max_delay, delay * 2)
+
+def _iter_file_lines(client, file_id: str) -> Iterator[str]:
+    with client.files.with_streaming_response.content(file_id) as resp:
+        for line in resp.iter_lines():
+            if line.strip():
+                yield line
+
+def ingest_batch(client, out_dir: str, batch, cache: Optional[ExtractionCache] = None) -> Dict[str, int]:
+    # Streams the output and error files into per-article JSON + Markdown; any line of
+    # the batch that is in neither file (expired, cancelled) is marked failed.
+    out = Path(out_dir)
+    state = BulkState(out)
+    record = next(b for b in state.batches if b["id"] == batch.id)
+    model = state.data.get("options", {}).get("model", "")
+    pending = set(record["custom_ids"])
+    counts = {"done": 0, "failed": 0}
+
+    def fail(aid: str, error: str) -> None:
+        state.articles[aid].update(status="failed", error=error)
+        pending.discard(aid)
+        counts["failed"] += 1
+
+    if batch.output_file_id:
+        for line in _iter_file_lines(client, batch.output_file_id):
+            item = json.loads(line)
+            aid = item["custom_id"]
+            if aid not in pending:
+                continue
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                fail(aid, json.dumps(item.get("error") or response.get("body")))
+                continue
+            try:
+                body = response["body"]
+                data = parse_json_content(body["choices"][0]["message"]["content"])
+            except Exception as e:
+                fail(aid, f"Unparseable output: {e}")
+                continue
+            output = _write_result(out, aid, data)
+            state.articles[aid].update(status="done", output=output, error=None, usage=body.get("usage"))
+            # Batch API requests are billed at half price; no per-call latency to report
+            current_telemetry().record_completion(body.get("model", model), body.get("usage"), None,
+                                                  discount=BATCH_DISCOUNT, article=aid, batch_id=batch.id)
+            if cache is not None and state.articles[aid].get("cache_key"):
+                cache.put(state.articles[aid]["cache_key"], data, model=model)
+            pending.discard(aid)
+            counts["done"] += 1
+
+    if batch.error_file_id:
+        for line in _iter_file_lines(client, batch.error_file_id):
+            item = json.loads(line)
+            if item["custom_id"] in pending:
+                error = item.get("error") or (item.get("response") or {}).get("body")
+                fail(item["custom_id"], json.dumps(error))
+
+    for aid in list(pending):
+        fail(aid, f"Batch ended with status '{batch.status}' without a result for this line")
+
+    request_counts = getattr(batch, "request_counts", None)
+    record.update(status=batch.status, ingested=True,
+                  request_counts=request_counts.model_dump() if request_counts is not None else None)
+    state.save()
+    return counts
+
+def wait_and_ingest(client, out_dir: str, cache: Optional[ExtractionCache] = None, **wait_options: Any) -> Dict[str, int]:
+    totals = {"done": 0, "failed": 0}
+    for record in BulkState(Path(out_dir)).batches:
+        if record["ingested"]:
+            continue
+        batch = wait_for_batch(client, record["id"], **wait_options)
+        for k, v in ingest_batch(client, out_dir, batch, cache=cache).items():
+            totals[k] += v
+    return totals
+
+def run_bulk(
+    client,
+    paths: List[Path],
+    out_dir: str,
+    max_attempts: int = 3,
+    cache: Optional[ExtractionCache] = None,
+    wait_options: Optional[Dict[str, Any]] = None,
+    log=print,
+    **options: Any,
+) -> Dict[str, int]:
+    counts = compile_requests(paths, out_dir, cache=cache, **options)
+    log(f"Compiled {counts['compiled']} requests ({counts['cached']} from cache, {counts['skipped']} already handled, "
+        f"{counts['failed']} unreadable).")
+    # Finish anything submitted by an interrupted earlier run first
+    wait_and_ingest(client, out_dir, cache=cache, **(wait_options or {}))
+    while True:
+        batch_ids = submit_pending(client, out_dir, max_attempts=max_attempts)
+        if not batch_ids:
+            break
+        log(f"Submitted {len(batch_ids)} batch(es): {', '.join(batch_ids)}")
+        totals = wait_and_ingest(client, out_dir, cache=cache, **(wait_options or {}))
+        log(f"Ingested: {totals['done']} done, {totals['failed']} failed.")
+    return BulkState(Path(out_dir)).counts()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline bulk extraction through the provider Batch API.")
+    parser.add_argument("command", choices=["run", "compile", "submit", "wait", "status"])
+    parser.add_argument("source", nargs="?", help="Folder with PDF/text files, or a single file (run/compile)")
+    parser.add_argument("--manifest", help="Text file listing article paths, one per line")
+    parser.add_argument("-o", "--out", required=True, help="Bulk working folder (re-use it to resume)")
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL", "gpt-4.1-mini"))
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--max-tokens", type=int, default=5000)
+    parser.add_argument("--keep-language", action="store_true", help="Do not force output in English")
+    parser.add_argument("--no-unknown", action="store_true", help="Leave missing fields blank instead of 'unknown'")
+    parser.add_argument("--context-budget", type=int, default=None,
+                        help="Send only the most relevant passages, within this many input tokens per request")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Submissions per article before giving up")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="First status poll delay (seconds)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Extraction cache (SQLite file)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or fill the extraction cache")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        state = BulkState(Path(args.out))
+        print(json.dumps({"articles": state.counts(),
+                          "batches": [{k: b.get(k) for k in ("id", "status", "ingested")} for b in state.batches]},
+                         indent=2))
+        return 0
+
+    if args.command in ("run", "compile") and not args.source and not args.manifest:
+        parser.error("provide a source folder/file or --manifest")
+    if args.command != "compile" and not os.getenv("OPENAI_API_KEY"):
+        parser.error("OPENAI_API_KEY is not set")
+
+    cache = None if args.no_cache else ExtractionCache(args.cache)
+    options = dict(model=args.model, temperature=args.temperature, max_tokens=args.max_tokens,
+                   force_english=not args.keep_language, allow_unknown=not args.no_unknown,
+                   context_budget=args.context_budget)
+    wait_options = {"initial_delay": args.poll_interval}
+
+    if args.command == "compile":
+        counts = compile_requests(discover_articles(args.source, args.manifest), args.out, cache=cache,
+                                  root=article_root(args.source, args.manifest), **options)
+        print(json.dumps(counts))
+        return 0
+
+    # Reuse the process-wide pooled client for the file / batch endpoints
+    client = get_scheduler().client
+    if args.command == "submit":
+        print("\n".join(submit_pending(client, args.out, max_attempts=args.max_attempts)) or "Nothing to submit.")
+        return 0
+    if args.command == "wait":
+        print(json.dumps(wait_and_ingest(client, args.out, cache=cache, **wait_options)))
+        return 0
+
+    counts = run_bulk(client, discover_articles(args.source, args.manifest), args.out,
+                      max_attempts=args.max_attempts, cache=cache, wait_options=wait_options,
+                      root=article_root(args.source, args.manifest), **options)
+    print(f"Done: {json.dumps(counts)}")
+    return 0 if set(counts) <= {"done"} else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
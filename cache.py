@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Content-addressed, on-disk cache of extraction results.
+# The key covers everything that can change the model output: normalized article text,
+# model, temperature, max tokens, prompt text and the JSON schema. Changing any of them
+# yields a new key, so stale entries are never served; they simply age out via eviction.
+
+DEFAULT_CACHE_PATH = os.getenv("EXTRACTION_CACHE_PATH", os.path.join(".cache", "extractions.sqlite"))
+
+def normalize_article_text(text: str) -> str:
+    # Whitespace-only differences (re-extracted PDFs, pasted text) must not miss the cache
+    return re.sub(r"\s+", " ", text).strip()
+
+def make_cache_key(article_text: str, **request: Any) -> str:
+    payload = {"article_text": normalize_article_text(article_text), **request}
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class ExtractionCache:
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_entries: Optional[int] = 10_000,
+        max_bytes: Optional[int] = 512 * 1024 * 1024,
+        max_age_days: Optional[float] = 90,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS extractions (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                data TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_accessed ON extractions(accessed_at)")
+        self.evict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT data, created_at FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row is not None and self._expired(row[1], now):
+                self._conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE extractions SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, data: Dict[str, Any], model: str = "") -> None:
+        blob = json.dumps(data, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, model, data, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, blob, len(blob), now, now),
+            )
+        self.evict()
+
+    def evict(self) -> int:
+        # Age limit first, then least-recently-used entries until under the count/size limits
+        removed = 0
+        with self._lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += self._conn.execute("DELETE FROM extractions WHERE created_at < ?", (cutoff,)).rowcount
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions").fetchone()
+            if (self.max_entries is not None and count > self.max_entries) or (self.max_bytes is not None and total > self.max_bytes):
+                rows = self._conn.execute("SELECT key, size FROM extractions ORDER BY accessed_at ASC").fetchall()
+                doomed = []
+                for key, size in rows:
+                    if (self.max_entries is None or count <= self.max_entries) and (self.max_bytes is None or total <= self.max_bytes):
+                        break
+                    doomed.append((key,))
+                    count -= 1
+                    total -= size
+                self._conn.executemany("DELETE FROM extractions WHERE key = ?", doomed)
+                removed += len(doomed)
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM extractions")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "bytes": total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.max_age_days is not None and created_at < now - self.max_age_days * 86400
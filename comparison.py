@@ -0,0 +1,166 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from utils import render_markdown_report, report_label
+
+# Side-by-side comparison of several studies' extractions, and the combined export: one
+# ZIP with <study>.json and <study>.md per study plus comparison.csv. The ZIP is written
+# to disk entry by entry from an iterable of results, so only one study is held in
+# memory at a time whatever the number of articles. The app splits it into parts of about
+# COMPARISON_EXPORT_PART_MB each (self-contained archives), since a download is held in
+# memory whole.
+#
+#   python comparison.py ./run -o comparison.zip      # finished articles of a batch.py run
+
+DEFAULT_EXPORT_DIR = os.getenv("COMPARISON_EXPORT_DIR", os.path.join(".cache", "exports"))
+EXPORT_PART_BYTES = int(os.getenv("COMPARISON_EXPORT_PART_MB", "50")) * 2**20
+# Exports left behind by sessions that ended are removed after this long
+EXPORT_MAX_AGE = 24 * 3600
+DEFAULT_COMPARE_FIELDS = (
+    "study_information.study",
+    "study_information.design",
+    "study_information.number_of_patients",
+    "study_information.country",
+    "intervention_and_duration.intervention",
+    "intervention_and_duration.duration_or_replacement_time",
+    "outcomes.result_magnitude_significance",
+    "evidence_frameworks.grade_system",
+)
+
+Result = Tuple[str, Dict[str, Any]]
+
+def field_value(data: Dict[str, Any], path: str) -> Any:
+    node: Any = data
+    for key in path.split("."):
+        node = node.get(key) if isinstance(node, dict) else None
+    return node
+
+def comparison_row(name: str, data: Dict[str, Any], fields: Sequence[str] = DEFAULT_COMPARE_FIELDS) -> Dict[str, Any]:
+    # {"article": name, <field label>: answer, ...}
+    row: Dict[str, Any] = {"article": name}
+    for path in fields:
+        value = field_value(data, path)
+        row[report_label(path)] = "—" if value is None else value
+    return row
+
+def comparison_rows(results: Iterable[Result], fields: Sequence[str] = DEFAULT_COMPARE_FIELDS) -> List[Dict[str, Any]]:
+    return [comparison_row(name, data, fields) for name, data in results]
+
+def _file_stem(name: str, seen: Dict[str, int]) -> str:
+    # Safe, unique file name inside the archive (the same PDF name may occur twice)
+    stem = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)[:80].strip("._") or "article"
+    seen[stem] = seen.get(stem, 0) + 1
+    return stem if seen[stem] == 1 else f"{stem}-{seen[stem]}"
+
+def export_dir(export_id: str, base_dir: str = DEFAULT_EXPORT_DIR) -> str:
+    # One folder per comparison, rewritten by each export and removed with the comparison
+    return os.path.join(base_dir, f"comparison-{export_id}")
+
+def sweep_exports(base_dir: str = DEFAULT_EXPORT_DIR, max_age: float = EXPORT_MAX_AGE) -> int:
+    # Removes exports older than max_age; returns how many
+    if not os.path.isdir(base_dir):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(base_dir):
+        if entry.stat().st_mtime < cutoff:
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+            removed += 1
+    return removed
+
+def _add_study(zf: zipfile.ZipFile, name: str, data: Dict[str, Any], seen: Dict[str, int]) -> None:
+    stem = _file_stem(name, seen)
+    zf.writestr(f"{stem}.json", json.dumps(data, indent=2, ensure_ascii=False))
+    zf.writestr(f"{stem}.md", render_markdown_report(data))
+
+def _add_table(zf: zipfile.ZipFile, rows: List[Dict[str, Any]], fields: Sequence[str]) -> None:
+    with zf.open("comparison.csv", "w") as raw, io.TextIOWrapper(raw, encoding="utf-8", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=["article", *(report_label(p) for p in fields)])
+        writer.writeheader()
+        writer.writerows(rows)
+
+def write_results_zip(dest: str, results: Iterable[Result], fields: Sequence[str] = DEFAULT_COMPARE_FIELDS) -> int:
+    # Written to a temporary name and renamed, so a reader never sees a half-written archive.
+    # Returns the number of studies.
+    tmp = f"{dest}.tmp"
+    if os.path.dirname(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    rows = []
+    seen: Dict[str, int] = {}
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, data in results:
+            _add_study(zf, name, data, seen)
+            rows.append(comparison_row(name, data, fields))
+        _add_table(zf, rows, fields)
+    os.replace(tmp, dest)
+    return len(rows)
+
+def write_results_parts(
+    dest_dir: str,
+    results: Iterable[Result],
+    fields: Sequence[str] = DEFAULT_COMPARE_FIELDS,
+    part_bytes: int = EXPORT_PART_BYTES,
+) -> List[Tuple[str, int]]:
+    # The same export as archives of about part_bytes each (a study is never split), each
+    # with the comparison.csv of its own studies. Replaces earlier parts in dest_dir.
+    # Returns [(path, number of studies)].
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.makedirs(dest_dir)
+    results = iter(results)
+    pending = next(results, None)
+    parts: List[Tuple[str, int]] = []
+    while pending is not None or not parts:
+        path = os.path.join(dest_dir, f"comparison-part{len(parts) + 1}.zip")
+        rows = []
+        seen: Dict[str, int] = {}
+        with open(f"{path}.tmp", "wb") as fh:
+            with zipfile.ZipFile(fh, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                while pending is not None:
+                    name, data = pending
+                    _add_study(zf, name, data, seen)
+                    rows.append(comparison_row(name, data, fields))
+                    pending = next(results, None)
+                    if fh.tell() >= part_bytes:
+                        break
+                _add_table(zf, rows, fields)
+        os.replace(f"{path}.tmp", path)
+        parts.append((path, len(rows)))
+    return parts
+
+def iter_run_results(out_dir: str) -> Iterator[Result]:
+    # (name, extraction) for the finished articles of a batch.py output folder, read lazily
+    from batch import RunManifest
+
+    out = Path(out_dir)
+    for aid, entry in RunManifest(out).articles.items():
+        if entry.get("status") != "done" or not (out / entry.get("output", "")).is_file():
+            continue
+        name = Path(entry["source"]).stem if entry.get("source") else aid
+        yield name, json.loads((out / entry["output"]).read_text(encoding="utf-8"))
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Combined comparison export of a batch run.")
+    parser.add_argument("run", help="Output folder of a batch.py run")
+    parser.add_argument("-o", "--out", default="comparison.zip", help="ZIP file to write")
+    parser.add_argument("--field", action="append", default=None, metavar="PATH",
+                        help="Field of the comparison table (repeatable; default: design, N, intervention, GRADE...)")
+    args = parser.parse_args(argv)
+    count = write_results_zip(args.out, iter_run_results(args.run), args.field or DEFAULT_COMPARE_FIELDS)
+    print(f"{count} studies written to {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,258 @@
+import math
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from models import compiled_schema, section_names
+from telemetry import timed
+from utils import estimate_tokens
+
+# Relevance-based context packing (replacement for the blind truncation in chunk_text).
+# The article is split into passages, indexed with BM25, and for each schema section the
+# best-matching passages are kept within a token budget. Title/abstract passages are
+# always kept (author, year, design usually live there); reference lists and
+# acknowledgements are never sent.
+
+PASSAGE_CHARS = 1200
+HEAD_TOKENS = 600
+OMISSION_MARK = "[...]"
+
+# Domain vocabulary on top of the field names, so sections find the passages that
+# actually report them (results tables, methods, supplementary material...)
+SECTION_HINTS: Dict[str, str] = {
+    "study_information": "author year study design randomized controlled trial cohort case series report "
+                         "retrospective prospective patients controls enrolled included participants country center",
+    "patient_demographics": "age years old onset mean median range sex male female family history pedigree "
+                            "consanguinity consanguineous siblings demographic baseline characteristics",
+    "intervention_and_duration": "treatment therapy treated dose dosage mg kg daily administered supplementation "
+                                 "replacement duration months weeks follow-up started initiated",
+    "outcomes": "outcome primary secondary endpoint result improvement improved worsened significant "
+                "p-value confidence interval score scale change baseline efficacy response",
+    "diagnostic_and_imaging_tests": "mutation gene variant molecular genetic sequencing biochemical plasma serum level "
+                                    "blood laboratory mri ct imaging scan white matter atrophy emg nerve conduction "
+                                    "electroneuromyography eeg electroencephalogram",
+    "clinical_features": "symptoms signs clinical features phenotype examination neurological ataxia seizures "
+                         "epilepsy cognitive intellectual disability developmental delay dystonia spasticity "
+                         "neuropathy reflexes dysarthria dysphagia gait nystagmus hearing vision",
+    "methodological_quality": "protocol intention-to-treat itt per-protocol missing data dropout lost follow-up "
+                              "randomization allocation concealment blinding bias deviations conflict interest "
+                              "funding sponsor limitations selective reporting",
+    "evidence_frameworks": "grade pico prisma cochrane risk bias quality evidence certainty inclusion exclusion "
+                           "criteria population intervention comparison outcome",
+    "study_summary": "conclusion conclusions summary we found findings abstract objective",
+}
+
+_HEADING = re.compile(
+    r"^\s*(?:\d+(?:\.\d+)*\.?\s*)?(abstract|summary|background|introduction|methods?|materials and methods|patients and methods|"
+    r"results?|discussion|conclusions?|limitations|tables?|figures?|supplementary(?: material| data)?|appendix|"
+    r"case (?:report|presentation|description)s?|references|bibliography|literature cited|acknowledge?ments?|"
+    r"funding|conflicts? of interest|disclosures?)\s*:?\s*$",
+    re.IGNORECASE,
+)
+_DROP_HEADINGS = re.compile(r"^(references|bibliography|literature cited|acknowledge?ments?)$", re.IGNORECASE)
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were which with "
+    "we our their there these those than then also not no yes".split()
+)
+
+def tokenize(text: str) -> List[str]:
+    terms = []
+    for w in _WORD.findall(text.lower()):
+        if len(w) < 2 or w in _STOPWORDS:
+            continue
+        # Very light stemming so "patients"/"patient" and "seizures"/"seizure" match
+        if len(w) > 4 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        terms.append(w)
+    return terms
+
+class Passage:
+    __slots__ = ("index", "text", "heading", "tokens")
+
+    def __init__(self, index: int, text: str, heading: str):
+        self.index = index
+        self.text = text
+        self.heading = heading
+        self.tokens = estimate_tokens(text)
+
+def split_line(line: str, limit: int) -> List[str]:
+    # A line longer than `limit` (text extracted without line breaks) in pieces of at most
+    # `limit` characters: at sentence ends where possible, else at a space, else anywhere
+    if len(line) <= limit:
+        return [line]
+    pieces: List[str] = []
+    buf = ""
+    for sentence in _SENTENCE_END.split(line):
+        while len(sentence) > limit:
+            cut = sentence.rfind(" ", 0, limit + 1)
+            cut = cut if cut > limit // 2 else limit
+            if buf:
+                pieces.append(buf)
+                buf = ""
+            pieces.append(sentence[:cut].rstrip())
+            sentence = sentence[cut:].lstrip()
+        if buf and len(buf) + 1 + len(sentence) > limit:
+            pieces.append(buf)
+            buf = ""
+        buf = f"{buf} {sentence}" if buf else sentence
+    if buf:
+        pieces.append(buf)
+    return pieces
+
+def segment_article(text: str, passage_chars: int = PASSAGE_CHARS) -> List[Passage]:
+    # Paragraph-ish passages: split at headings and blank lines, merge short lines up to
+    # ~passage_chars, preferring to break after a sentence end.
+    passages: List[Passage] = []
+    heading = ""
+    buf: List[str] = []
+    size = 0
+
+    def flush() -> None:
+        nonlocal buf, size
+        chunk = "\n".join(buf).strip()
+        if chunk:
+            passages.append(Passage(len(passages), chunk, heading))
+        buf, size = [], 0
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        m = _HEADING.match(stripped) if len(stripped) < 60 else None
+        if m:
+            flush()
+            heading = m.group(1).lower()
+            buf, size = [stripped], len(stripped)
+            continue
+        if not stripped:
+            if size >= passage_chars // 2:
+                flush()
+            continue
+        for piece in split_line(stripped, passage_chars):
+            buf.append(piece)
+            size += len(piece) + 1
+            if (size >= passage_chars and piece.endswith((".", ":", ";"))) or size >= 2 * passage_chars:
+                flush()
+    flush()
+    return passages
+
+class BM25Index:
+    def __init__(self, docs: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.n = len(docs)
+        self.lengths = [len(d) for d in docs]
+        self.avg_len = (sum(self.lengths) / self.n) if self.n else 0.0
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for i, d in enumerate(docs):
+            for term, tf in Counter(d).items():
+                self.postings[term].append((i, tf))
+        self.idf = {
+            term: math.log(1 + (self.n - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in self.postings.items()
+        }
+
+    def scores(self, query: List[str]) -> Dict[int, float]:
+        # Only documents sharing at least one term are touched (inverted index)
+        out: Dict[int, float] = defaultdict(float)
+        for term, qtf in Counter(query).items():
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / (self.avg_len or 1))
+                out[i] += qtf * idf * tf * (self.k1 + 1) / (tf + norm)
+        return out
+
+@lru_cache(maxsize=None)
+def section_query(section: str) -> Tuple[str, ...]:
+    spec = compiled_schema()["schema"]["properties"][section]
+    words = [section.replace("_", " "), SECTION_HINTS.get(section, "")]
+    for field, field_spec in spec.get("properties", {}).items():
+        words.append(field.replace("_", " "))
+        words.append(field_spec.get("description", ""))
+    return tuple(tokenize(" ".join(words)))
+
+class ContextBuilder:
+    def __init__(self, article_text: str, passage_chars: int = PASSAGE_CHARS):
+        self.text = article_text
+        self.passages = segment_article(article_text, passage_chars)
+        self.total_tokens = estimate_tokens(article_text)
+        # Reference lists / acknowledgements stay out of the index entirely
+        self.candidates = [p for p in self.passages if not _DROP_HEADINGS.match(p.heading)]
+        self.index = BM25Index([tokenize(p.text) for p in self.candidates])
+
+    def rank(self, section: str) -> List[Passage]:
+        scores = self.index.scores(list(section_query(section)))
+        order = sorted(scores, key=lambda i: -scores[i])
+        return [self.candidates[i] for i in order]
+
+    def pack(self, token_budget: int, sections: Optional[List[str]] = None) -> Tuple[str, Dict[str, Any]]:
+        # Passages for the given sections (all sections by default) within token_budget,
+        # returned in document order. Round-robin over the sections' rankings so every
+        # section gets its best passages before any section gets its second best.
+        sections = sections or section_names()
+        if self.total_tokens <= token_budget:
+            return self.text, self._stats(self.passages, token_budget)
+
+        chosen: Dict[int, Passage] = {}
+        used = 0
+        for p in self.candidates:
+            if used + p.tokens > min(HEAD_TOKENS, token_budget):
+                break
+            chosen[p.index] = p
+            used += p.tokens
+
+        rankings = [self.rank(s) for s in sections]
+        cursors = [0] * len(rankings)
+        progressing = True
+        while progressing:
+            progressing = False
+            for r, ranking in enumerate(rankings):
+                while cursors[r] < len(ranking):
+                    p = ranking[cursors[r]]
+                    cursors[r] += 1
+                    if p.index in chosen:
+                        continue
+                    if used + p.tokens <= token_budget:
+                        chosen[p.index] = p
+                        used += p.tokens
+                        progressing = True
+                        break
+        if not chosen and self.candidates and token_budget > 0:
+            # Not even one passage fits: send the head of the best one rather than nothing
+            best = next((ranking[0] for ranking in rankings if ranking), self.candidates[0])
+            chosen[best.index] = Passage(best.index, best.text[:4 * token_budget].rstrip(), best.heading)
+
+        kept = [chosen[i] for i in sorted(chosen)]
+        parts: List[str] = []
+        prev = -1
+        for p in kept:
+            if p.index != prev + 1:
+                parts.append(OMISSION_MARK)
+            parts.append(p.text)
+            prev = p.index
+        if prev != len(self.passages) - 1:
+            parts.append(OMISSION_MARK)
+        return "\n\n".join(parts), self._stats(kept, token_budget)
+
+    def _stats(self, kept: List[Passage], token_budget: int) -> Dict[str, Any]:
+        kept_tokens = sum(p.tokens for p in kept)
+        return {
+            "token_budget": token_budget,
+            "total_tokens": self.total_tokens,
+            "kept_tokens": kept_tokens,
+            "discarded_tokens": max(0, self.total_tokens - kept_tokens),
+            "passages_kept": len(kept),
+            "passages_total": len(self.passages),
+        }
+
+@lru_cache(maxsize=8)
+def _builder(article_text: str) -> ContextBuilder:
+    # Sectioned extraction packs the same article once per section; index it once
+    return ContextBuilder(article_text)
+
+@timed("context_pack")
+def pack_context(article_text: str, token_budget: int, sections: Optional[List[str]] = None) -> Tuple[str, Dict[str, Any]]:
+    return _builder(article_text).pack(token_budget, sections)
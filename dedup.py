@@ -0,0 +1,277 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# Near-duplicate detection ahead of extraction (preprint vs published version, PDFs with
+# and without supplements, re-uploads).
+# - Each article's text becomes a set of word 5-gram shingles, summarised by a MinHash
+#   signature (NUM_PERM 32-bit minima); equal-position agreement estimates Jaccard.
+# - Signatures are split into LSH bands; documents sharing any band bucket are candidates,
+#   so a lookup is a handful of indexed SQLite reads, not a scan of the corpus.
+# - The index persists (DEDUP_INDEX_PATH, default .cache/dedup.sqlite) together with the
+#   extraction of each indexed article, so a later near-duplicate can reuse it.
+
+DEFAULT_DEDUP_PATH = os.getenv("DEDUP_INDEX_PATH", os.path.join(".cache", "dedup.sqlite"))
+DEFAULT_THRESHOLD = 0.85
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+_PRIME = np.uint64(4294967311)  # smallest prime above 2**32: a*x + b stays below 2**64
+_MULT = np.uint64(0x100000001B3)
+_WORD = re.compile(r"[a-z0-9]+")
+_CHUNK = 4096
+
+def lsh_bands(threshold: float, num_perm: int = NUM_PERM) -> Tuple[int, int]:
+    # (bands, rows) whose S-curve midpoint (1/bands)**(1/rows) lies just below the
+    # threshold: pairs at the threshold are almost always candidates, distant ones rarely
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if bands and (1 / bands) ** (1 / rows) <= threshold - 0.1:
+            best = (bands, rows)
+    return best
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    # Unique 32-bit hashes of word `size`-grams (lower-cased alphanumeric words)
+    words = _WORD.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    vocab: Dict[str, int] = {}
+    ids = np.fromiter((vocab.setdefault(w, zlib.crc32(w.encode("utf-8"))) for w in words), dtype=np.uint64, count=len(words))
+    size = min(size, len(ids))
+    h = np.zeros(len(ids) - size + 1, dtype=np.uint64)
+    for j in range(size):
+        h = h * _MULT + ids[j:len(ids) - size + 1 + j]
+    return np.unique((h >> np.uint64(32)) ^ (h & np.uint64(0xFFFFFFFF)))
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 2**32 - 1, size=num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.randint(0, 2**32 - 1, size=num_perm, dtype=np.uint64)[:, None]
+        self.num_perm = num_perm
+
+    def signature(self, shingles: np.ndarray) -> Optional[np.ndarray]:
+        if not len(shingles):
+            return None
+        sig = np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        # Chunked so a 100-page article doesn't build a num_perm x n_shingles matrix at once
+        for i in range(0, len(shingles), _CHUNK):
+            x = shingles[i:i + _CHUNK][None, :]
+            sig = np.minimum(sig, ((self.a * x + self.b) % _PRIME).min(axis=1))
+        return sig.astype(np.uint32)
+
+class DedupIndex:
+    def __init__(
+        self,
+        path: str = DEFAULT_DEDUP_PATH,
+        threshold: float = DEFAULT_THRESHOLD,
+        num_perm: int = NUM_PERM,
+        shingle_size: int = SHINGLE_SIZE,
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self.flagged = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # One small transaction per article: without this every insert waits for an fsync
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                source TEXT,
+                signature BLOB NOT NULL,
+                result TEXT,
+                model TEXT,
+                schema_version TEXT,
+                added_at REAL NOT NULL
+            )"""
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(documents)")}
+        if "schema_version" not in columns:
+            # Indexes from before results carried their schema version: those are never reused
+            self._conn.execute("ALTER TABLE documents ADD COLUMN schema_version TEXT")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (bucket INTEGER NOT NULL, doc_id TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_bucket ON buckets(bucket)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_doc ON buckets(doc_id)")
+        self._check_params()
+
+    def _check_params(self) -> None:
+        # Bucket keys depend on the banding chosen when the index was created; later runs
+        # keep that banding (a different threshold only changes the similarity cut-off)
+        params = {"num_perm": self.hasher.num_perm, "bands": self.bands, "rows": self.rows,
+                  "shingle_size": self.shingle_size}
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if row is None:
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('params', ?)", (json.dumps(params),))
+            return
+        stored = json.loads(row[0])
+        if stored["num_perm"] != params["num_perm"] or stored["shingle_size"] != params["shingle_size"]:
+            raise ValueError(f"Dedup index {self.path} was built with {stored}; this run uses {params}. "
+                             "Use a new index file.")
+        self.bands, self.rows = stored["bands"], stored["rows"]
+
+    # --- signatures -------------------------------------------------------------
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        return self.hasher.signature(shingle_hashes(text, self.shingle_size))
+
+    def _bucket_keys(self, sig: np.ndarray) -> List[int]:
+        keys = []
+        for band in range(self.bands):
+            chunk = sig[band * self.rows:(band + 1) * self.rows].tobytes()
+            digest = hashlib.blake2b(band.to_bytes(2, "little") + chunk, digest_size=8).digest()
+            keys.append(int.from_bytes(digest, "little", signed=True))
+        return keys
+
+    # --- lookups ----------------------------------------------------------------
+
+    def _query(self, sig: np.ndarray, threshold: float, exclude: Optional[str] = None) -> List[Dict[str, Any]]:
+        keys = self._bucket_keys(sig)
+        rows = self._conn.execute(
+            f"SELECT DISTINCT d.doc_id, d.source, d.signature, d.result IS NOT NULL, d.model, d.schema_version FROM buckets b "
+            f"JOIN documents d ON d.doc_id = b.doc_id WHERE b.bucket IN ({','.join('?' * len(keys))})",
+            keys,
+        ).fetchall()
+        matches = []
+        for doc_id, source, blob, has_result, model, version in rows:
+            if doc_id == exclude:
+                continue
+            similarity = float(np.mean(np.frombuffer(blob, dtype=np.uint32) == sig))
+            if similarity >= threshold:
+                matches.append({"doc_id": doc_id, "source": source, "similarity": round(similarity, 4),
+                                "has_result": bool(has_result), "model": model, "schema_version": version})
+        return sorted(matches, key=lambda m: -m["similarity"])
+
+    def query(self, text: str, threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        # Indexed documents whose estimated Jaccard similarity is >= threshold, best first
+        sig = self.signature(text)
+        if sig is None:
+            return []
+        with self._lock:
+            return self._query(sig, self.threshold if threshold is None else threshold)
+
+    def check_and_add(self, doc_id: str, text: str, source: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # Best near-duplicate already indexed (None if there is none), then indexes this
+        # document; one lock so two copies processed concurrently can't both miss
+        sig = self.signature(text)
+        if sig is None:
+            return None
+        with self._lock:
+            matches = self._query(sig, self.threshold, exclude=doc_id)
+            self._add(doc_id, sig, source)
+            if matches:
+                self.flagged += 1
+        return matches[0] if matches else None
+
+    def add(self, doc_id: str, text: str, source: Optional[str] = None) -> bool:
+        sig = self.signature(text)
+        if sig is None:
+            return False
+        with self._lock:
+            self._add(doc_id, sig, source)
+        return True
+
+    def _add(self, doc_id: str, sig: np.ndarray, source: Optional[str]) -> None:
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.execute("DELETE FROM buckets WHERE doc_id = ?", (doc_id,))
+            # Keeps a stored result if the document is re-indexed with the same text
+            self._conn.execute(
+                """INSERT INTO documents (doc_id, source, signature, added_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(doc_id) DO UPDATE SET source = excluded.source,
+                   result = CASE WHEN signature = excluded.signature THEN result END,
+                   signature = excluded.signature, added_at = excluded.added_at""",
+                (doc_id, source, sig.tobytes(), time.time()),
+            )
+            self._conn.executemany("INSERT INTO buckets (bucket, doc_id) VALUES (?, ?)",
+                                   [(k, doc_id) for k in self._bucket_keys(sig)])
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    # --- stored extractions -----------------------------------------------------
+
+    def attach_result(self, doc_id: str, data: Dict[str, Any], model: str = "",
+                      schema_version: Optional[str] = None) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE documents SET result = ?, model = ?, schema_version = ? WHERE doc_id = ?",
+                               (json.dumps(data, ensure_ascii=False), model, schema_version, doc_id))
+
+    def stored_result(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        # {"data", "model", "schema_version"} of the stored extraction, None if there is none
+        with self._lock:
+            row = self._conn.execute("SELECT result, model, schema_version FROM documents WHERE doc_id = ?",
+                                     (doc_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return {"data": json.loads(row[0]), "model": row[1], "schema_version": row[2]}
+
+    def result(self, doc_id: str, schema_version: Optional[str] = None,
+               model: Union[str, Sequence[str], None] = None) -> Optional[Dict[str, Any]]:
+        # The stored extraction; with schema_version / model (or one of several models),
+        # only if it was made with them
+        stored = self.stored_result(doc_id)
+        if stored is None or (schema_version is not None and stored["schema_version"] != schema_version):
+            return None
+        if model is not None and stored["model"] not in ((model,) if isinstance(model, str) else tuple(model)):
+            return None
+        return stored["data"]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count, with_result = self._conn.execute(
+                "SELECT COUNT(*), COUNT(result) FROM documents").fetchone()
+        return {"documents": count, "with_result": with_result, "flagged": self.flagged,
+                "threshold": self.threshold, "bands": self.bands, "rows": self.rows}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from batch import article_id, article_root, discover_articles, load_article_text
+
+    parser = argparse.ArgumentParser(description="Find near-duplicate articles (MinHash/LSH).")
+    parser.add_argument("source", help="Folder with PDF/text files, or a single file")
+    parser.add_argument("--index", default=DEFAULT_DEDUP_PATH, help="Dedup index (SQLite file)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Estimated Jaccard similarity")
+    parser.add_argument("--add", action="store_true", help="Also add the articles to the index")
+    args = parser.parse_args(argv)
+
+    index = DedupIndex(args.index, threshold=args.threshold)
+    root = article_root(args.source)
+    for path in discover_articles(args.source):
+        aid = article_id(path, root)
+        text = load_article_text(path)
+        t0 = time.perf_counter()
+        if args.add:
+            match = index.check_and_add(aid, text, source=str(path))
+            matches = [match] if match else []
+        else:
+            matches = [m for m in index.query(text) if m["doc_id"] != aid]
+        elapsed_ms = 1000 * (time.perf_counter() - t0)
+        found = ", ".join(f"{m['doc_id']} ({m['similarity']:.0%})" for m in matches) or "no near-duplicates"
+        print(f"{aid}: {found} [{elapsed_ms:.1f} ms]")
+    print(json.dumps(index.stats()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from models import leaf_specs
+
+# Columnar evidence store: every extraction flattened into one typed row with a column
+# per schema leaf ("study_information.number_of_patients", ...), kept as Parquet parts
+# in one folder so appending never rewrites earlier data.
+#
+#   python evidence_store.py ingest ./run/results ./bulk/results --store ./evidence
+#   python evidence_store.py summary --store ./evidence
+#   python evidence_store.py export evidence_table.xlsx --store ./evidence
+#
+# Re-ingesting an article adds a newer row; reads keep the latest row per article_id.
+# Queries and exports work on Arrow columns (pyarrow.compute), never on per-study dicts.
+
+DEFAULT_STORE_PATH = os.getenv("EVIDENCE_STORE_PATH", os.path.join(".cache", "evidence"))
+ROWS_PER_PART = 500
+UNKNOWN = "unknown"
+# Suffix of the int64 companion column of integer-or-string fields ("12" -> 12, "unknown" -> null)
+NUMERIC_SUFFIX = "__n"
+META_FIELDS = [
+    pa.field("article_id", pa.string()),
+    pa.field("source", pa.string()),
+    pa.field("model", pa.string()),
+    pa.field("extracted_at", pa.timestamp("ms", tz="UTC")),
+]
+
+def leaf_paths(schema: Optional[Dict[str, Any]] = None) -> List[Tuple[str, Any]]:
+    # [(dotted path, JSON type)] for every non-object property, in schema order
+    return [(path, spec.get("type")) for path, spec in leaf_specs(schema).items()]
+
+def _is_numeric(json_type: Any) -> bool:
+    types = json_type if isinstance(json_type, list) else [json_type]
+    return "integer" in types or "number" in types
+
+def arrow_schema(schema: Optional[Dict[str, Any]] = None) -> pa.Schema:
+    fields = list(META_FIELDS)
+    for path, json_type in leaf_paths(schema):
+        # The verbatim answer is always kept (as text) so the evidence table shows what the
+        # model reported; numeric leaves get a typed companion column for aggregation.
+        fields.append(pa.field(path, pa.string()))
+        if _is_numeric(json_type):
+            fields.append(pa.field(path + NUMERIC_SUFFIX, pa.int64()))
+    return pa.schema(fields)
+
+def _to_int(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        digits = value.strip().replace(",", "")
+        if digits.isdigit():
+            return int(digits)
+    return None
+
+def _lookup(data: Dict[str, Any], path: str) -> Any:
+    node: Any = data
+    for key in path.split("."):
+        if not isinstance(node, dict):
+            return None
+        node = node.get(key)
+    return node
+
+def flatten_document(data: Dict[str, Any], leaves: Optional[List[Tuple[str, Any]]] = None) -> Dict[str, Any]:
+    # Nested extraction -> {dotted leaf path: value}; missing leaves become None
+    row: Dict[str, Any] = {}
+    for path, json_type in leaves or leaf_paths():
+        value = _lookup(data, path)
+        if value is None or isinstance(value, str):
+            row[path] = value
+        else:
+            row[path] = json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+        if _is_numeric(json_type):
+            row[path + NUMERIC_SUFFIX] = _to_int(value)
+    return row
+
+class EvidenceStore:
+    # Thread-safe: rows are buffered and written as one Parquet part per flush
+    # (every ROWS_PER_PART rows, or explicitly), so concurrent batch workers can add.
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, rows_per_part: int = ROWS_PER_PART):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.rows_per_part = rows_per_part
+        self.schema = arrow_schema()
+        self._leaves = leaf_paths()
+        self._lock = threading.Lock()
+        self._buffer: List[Dict[str, Any]] = []
+
+    # --- writing ----------------------------------------------------------------
+
+    def add(self, article_id: str, data: Dict[str, Any], source: Optional[str] = None,
+            model: Optional[str] = None, extracted_at: Optional[float] = None) -> None:
+        row = {"article_id": article_id, "source": source, "model": model,
+               "extracted_at": int(1000 * (extracted_at if extracted_at is not None else time.time())),
+               **flatten_document(data, self._leaves)}
+        with self._lock:
+            self._buffer.append(row)
+            if len(self._buffer) >= self.rows_per_part:
+                self._flush_locked()
+
+    def flush(self) -> int:
+        with self._lock:
+            return self._flush_locked()
+
+    def _flush_locked(self) -> int:
+        if not self._buffer:
+            return 0
+        table = pa.Table.from_pylist(self._buffer, schema=self.schema)
+        name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp = self.path / (name + ".tmp")
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, self.path / name)
+        self._buffer = []
+        return table.num_rows
+
+    def ingest_results(self, folder: str, model: Optional[str] = None) -> int:
+        # Result files written by batch.py / bulk.py (<article_id>.json); the file's mtime
+        # stands in for the extraction time
+        count = 0
+        for path in sorted(Path(folder).glob("*.json")):
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            if isinstance(data, dict):
+                self.add(path.stem, data, source=str(path), model=model, extracted_at=path.stat().st_mtime)
+                count += 1
+        self.flush()
+        return count
+
+    def compact(self) -> int:
+        # Rewrites the store as a single part holding only the latest row per article
+        with self._lock:
+            self._flush_locked()
+            old = self._parts()
+            table = self.table()
+            if not old:
+                return 0
+            self._buffer = table.to_pylist()
+            self._flush_locked()
+            for part in old:
+                part.unlink()
+            return table.num_rows
+
+    # --- reading ----------------------------------------------------------------
+
+    def _parts(self) -> List[Path]:
+        return sorted(self.path.glob("part-*.parquet"))
+
+    def version(self) -> Tuple[Tuple[str, int], ...]:
+        # (name, mtime) of every part: changes whenever a flush or compact changes what is read
+        return tuple((p.name, p.stat().st_mtime_ns) for p in self._parts())
+
+    def dataset(self) -> ds.Dataset:
+        return ds.dataset([str(p) for p in self._parts()], schema=self.schema, format="parquet")
+
+    def table(self, columns: Optional[List[str]] = None) -> pa.Table:
+        # Latest row per article_id, as an Arrow table (optionally only some columns)
+        wanted = None if columns is None else list(dict.fromkeys(["article_id", "extracted_at", *columns]))
+        table = self.dataset().to_table(columns=wanted)
+        if table.num_rows:
+            table = table.take(pc.sort_indices(table, [("article_id", "ascending"), ("extracted_at", "descending")]))
+            ids = table["article_id"]
+            first = pc.invert(pc.equal(ids.slice(1), ids.slice(0, len(ids) - 1)).fill_null(False))
+            table = table.filter(pa.concat_arrays([pa.array([True]), first.combine_chunks()]))
+        return table if columns is None else table.select(columns)
+
+    def __len__(self) -> int:
+        return self.table(["article_id"]).num_rows
+
+    # --- queries ----------------------------------------------------------------
+
+    def pooled_count(self, column: str = "study_information.number_of_patients") -> Dict[str, Any]:
+        # Sum of a numeric leaf across studies, plus how many studies reported it
+        values = self.table([column + NUMERIC_SUFFIX]).column(0)
+        return {"total": pc.sum(values).as_py() or 0, "studies_reporting": len(values) - values.null_count,
+                "studies": len(values)}
+
+    def distribution(self, column: str = "study_information.design") -> List[Tuple[str, int]]:
+        # Value counts of a text leaf (trimmed, lower-cased), most frequent first
+        values = pc.utf8_lower(pc.utf8_trim_whitespace(self.table([column]).column(0)))
+        counts = pc.value_counts(values.fill_null(UNKNOWN)).to_pylist()
+        return sorted(((c["values"], c["counts"]) for c in counts), key=lambda x: -x[1])
+
+    def unknown_fraction(self) -> Dict[str, float]:
+        # Fraction of studies whose answer is "unknown" or missing, per leaf column
+        table = self.table([path for path, _ in self._leaves])
+        if not table.num_rows:
+            return {}
+        out = {}
+        for name in table.column_names:
+            col = pc.utf8_lower(pc.utf8_trim_whitespace(table[name]))
+            unknown = pc.or_(pc.equal(col, UNKNOWN), pc.equal(col, "")).fill_null(True)
+            out[name] = round(pc.sum(unknown).as_py() / table.num_rows, 4)
+        return out
+
+    def summary(self) -> Dict[str, Any]:
+        unknown = self.unknown_fraction()
+        return {
+            "studies": len(self),
+            "parts": len(self._parts()),
+            "patients": self.pooled_count("study_information.number_of_patients"),
+            "controls": self.pooled_count("study_information.number_of_controls"),
+            "designs": self.distribution("study_information.design")[:10],
+            "unknown_fraction_mean": round(sum(unknown.values()) / len(unknown), 4) if unknown else 0.0,
+            "most_unknown": sorted(unknown.items(), key=lambda x: -x[1])[:10],
+        }
+
+    # --- export -----------------------------------------------------------------
+
+    def evidence_table(self, columns: Optional[List[str]] = None) -> pa.Table:
+        # One row per study: article id and the verbatim leaf answers (no companion columns)
+        columns = columns or ["article_id", "source", "model", "extracted_at", *[p for p, _ in self._leaves]]
+        return self.table(columns)
+
+    def export(self, out_path: str, columns: Optional[List[str]] = None) -> int:
+        # .csv written straight from Arrow; .xlsx through pandas (needs openpyxl)
+        table = self.evidence_table(columns)
+        if out_path.lower().endswith(".xlsx"):
+            try:
+                import openpyxl  # noqa: F401
+            except ImportError as e:
+                raise RuntimeError("XLSX export needs openpyxl (pip install openpyxl); use .csv instead.") from e
+            df = table.to_pandas()
+            if "extracted_at" in df:
+                df["extracted_at"] = df["extracted_at"].dt.tz_localize(None)
+            df.to_excel(out_path, index=False, sheet_name="evidence")
+        else:
+            pacsv.write_csv(table, out_path)
+        return table.num_rows
+
+    def export_csv_bytes(self, columns: Optional[List[str]] = None) -> bytes:
+        sink = pa.BufferOutputStream()
+        pacsv.write_csv(self.evidence_table(columns), sink)
+        return sink.getvalue().to_pybytes()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Columnar evidence store over extraction results.")
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH, help="Store folder (Parquet parts)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_ingest = sub.add_parser("ingest", help="Add result folders (<article_id>.json files) to the store")
+    p_ingest.add_argument("folders", nargs="+")
+    p_ingest.add_argument("--model", default=None, help="Model recorded for these rows")
+    sub.add_parser("summary", help="Pooled counts, design distribution, unknown rate per field")
+    p_export = sub.add_parser("export", help="Write the evidence table (.csv or .xlsx)")
+    p_export.add_argument("out")
+    p_export.add_argument("--columns", nargs="+", default=None, help="Leaf columns to export (default: all)")
+    sub.add_parser("compact", help="Merge parts, keeping the latest row per article")
+    args = parser.parse_args(argv)
+
+    store = EvidenceStore(args.store)
+    if args.command == "ingest":
+        for folder in args.folders:
+            print(f"{folder}: {store.ingest_results(folder, model=args.model)} results added")
+    elif args.command == "summary":
+        print(json.dumps(store.summary(), indent=2))
+    elif args.command == "export":
+        columns = ["article_id", *args.columns] if args.columns else None
+        print(f"{store.export(args.out, columns)} studies written to {args.out}")
+    elif args.command == "compact":
+        print(f"{store.compact()} studies kept")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from contextvars import copy_context
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from cache import ExtractionCache, make_cache_key
+from context import pack_context
+from jsonstream import IncrementalJSONParser, parse_json_document
+from models import ExtractionSchema, leaf_specs, merge_documents, schema_version, subschema
+from telemetry import current as current_telemetry, timed
+from utils import chunk_text, build_system_prompt, build_user_prompt
+
+# Shared request path for the Streamlit app and the headless batch runner.
+# `scheduler` is a scheduler.RequestScheduler (rate limits, retries, pooled client).
+
+SCHEMA_NAME = "systematic_review_extraction"
+# Answers that count as "not found" when deciding what to escalate in a model cascade
+UNKNOWN_ANSWERS = frozenset({"", "unknown", "not reported", "not stated", "n/a", "na", "none reported"})
+DEFAULT_CASCADE_THRESHOLD = 0.25
+
+def prepare_article_text(
+    article_text: str,
+    context_budget: Optional[int] = None,
+    sections: Optional[List[str]] = None,
+) -> str:
+    # With a token budget, send the most relevant passages (context.py); otherwise the
+    # legacy head-of-text truncation
+    if context_budget:
+        return pack_context(article_text, context_budget, sections)[0]
+    return chunk_text(article_text)
+
+def build_messages(
+    article_text: str,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    context_budget: Optional[int] = None,
+    sections: Optional[List[str]] = None,
+) -> List[Dict[str, str]]:
+    return _messages(prepare_article_text(article_text, context_budget, sections), force_english, allow_unknown)
+
+def _messages(prepared_text: str, force_english: bool, allow_unknown: bool) -> List[Dict[str, str]]:
+    system_prompt = build_system_prompt(force_english=force_english, allow_unknown=allow_unknown)
+    user_prompt = build_user_prompt(prepared_text)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+def build_response_format(schema: Dict[str, Any], name: str = SCHEMA_NAME) -> Dict[str, Any]:
+    # JSON Schema (STRICT) for Structured Outputs
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "schema": schema,
+            "strict": True
+        }
+    }
+
+@timed("json_parse")
+def parse_json_content(content: str) -> Dict[str, Any]:
+    # Tolerates code fences / surrounding text; raises TruncatedOutputError (with the
+    # partial document) when the output was cut off, e.g. by max_tokens
+    return parse_json_document(content)
+
+def extraction_cache_key(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    schema: Dict[str, Any],
+) -> str:
+    # The user message carries the article text (normalized by make_cache_key), the system
+    # message the prompt flags; any change to either, the model settings or the schema
+    # produces a new key. The schema enters as its hash (precomputed for the full schema).
+    return make_cache_key(
+        messages[-1]["content"],
+        system_prompt=messages[0]["content"],
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        schema=schema_version(schema),
+    )
+
+class SectionExtractionError(RuntimeError):
+    # Raised when some sections still fail after their retries; carries what did succeed
+    def __init__(self, failed: Dict[str, str], partial: Dict[str, Any]):
+        super().__init__("Extraction failed for section(s): " + ", ".join(f"{k} ({v})" for k, v in failed.items()))
+        self.failed = failed
+        self.partial = partial
+
+def _complete(
+    scheduler,
+    messages: List[Dict[str, str]],
+    schema: Dict[str, Any],
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    name: str = SCHEMA_NAME,
+) -> Dict[str, Any]:
+    resp = scheduler.create(
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,  # Chat Completions usa max_tokens
+        messages=messages,
+        response_format=build_response_format(schema, name=name)
+    )
+
+    content = resp.choices[0].message.content if resp and resp.choices else None
+    if not content:
+        raise ValueError("No structured output returned from the model.")
+    return parse_json_content(content)
+
+def _cached_complete(
+    scheduler,
+    messages: List[Dict[str, str]],
+    schema: Dict[str, Any],
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    cache: Optional[ExtractionCache] = None,
+    name: str = SCHEMA_NAME,
+) -> Dict[str, Any]:
+    key = None
+    if cache is not None:
+        key = extraction_cache_key(messages, model, temperature, max_tokens, schema)
+        cached = cache.get(key)
+        if cached is not None:
+            current_telemetry().incr("cache_hits_total")
+            return cached
+    data = _complete(scheduler, messages, schema, model, temperature, max_tokens, name=name)
+    if cache is not None:
+        cache.put(key, data, model=model)
+    return data
+
+def run_sectioned_extraction(
+    scheduler,
+    article_text: str,
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    cache: Optional[ExtractionCache] = None,
+    context_budget: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    retries: int = 2,
+    on_section: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    # One request per top-level section, all in flight at once. Without a context budget
+    # every section sees the same messages (identical prompt prefix); with one, each
+    # section gets the passages most relevant to it. Latency approaches that of the
+    # slowest section, and a failing section is retried on its own.
+    schemas = ExtractionSchema.section_schemas()
+
+    def extract_section(section: str) -> Any:
+        messages = build_messages(article_text, force_english, allow_unknown, context_budget, [section])
+        last_error: Optional[Exception] = None
+        for _ in range(retries + 1):
+            try:
+                data = _cached_complete(
+                    scheduler, messages, schemas[section], model, temperature, max_tokens,
+                    cache=cache, name=f"{SCHEMA_NAME}_{section}",
+                )
+                return data[section]
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    results: Dict[str, Any] = {}
+    failed: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(schemas)) as pool:
+        # Each worker runs in a copy of the caller's context so calls land in its telemetry
+        futures = {pool.submit(copy_context().run, extract_section, name): name for name in schemas}
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                results[name] = fut.result()
+            except Exception as e:
+                failed[name] = str(e)
+                continue
+            if on_section is not None:
+                on_section(name, _in_schema_order(results, schemas))
+    merged = _in_schema_order(results, schemas)
+    if failed:
+        raise SectionExtractionError(failed, merged)
+    # Same key order as the full schema, i.e. the shape render_markdown_report expects
+    return merged
+
+def _in_schema_order(results: Dict[str, Any], schemas: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: results[name] for name in schemas if name in results}
+
+def stream_extraction(
+    scheduler,
+    article_text: str,
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    cache: Optional[ExtractionCache] = None,
+    context_budget: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    # Streams the completion and yields the (live, growing) document every time a field
+    # or section is completed. The last yielded value is the full document. If the output
+    # is cut off (max_tokens), TruncatedOutputError is raised with the partial document.
+    schema = ExtractionSchema.json_schema()
+    messages = build_messages(article_text, force_english, allow_unknown, context_budget)
+    key = None
+    if cache is not None:
+        key = extraction_cache_key(messages, model, temperature, max_tokens, schema)
+        cached = cache.get(key)
+        if cached is not None:
+            current_telemetry().incr("cache_hits_total")
+            yield cached
+            return
+
+    stream = scheduler.create(
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        messages=messages,
+        response_format=build_response_format(schema),
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parser = IncrementalJSONParser()
+    parse_seconds = 0.0
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        t0 = time.perf_counter()
+        completed = parser.feed(delta)
+        parse_seconds += time.perf_counter() - t0
+        if completed and parser.document is not None:
+            yield parser.document
+
+    current_telemetry().observe_stage("json_parse", parse_seconds, stream=True)
+    if parser.document is None:
+        raise ValueError("No structured output returned from the model.")
+    data = parser.close()
+    if cache is not None:
+        cache.put(key, data, model=model)
+
+def run_extraction(
+    scheduler,
+    article_text: str,
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    cache: Optional[ExtractionCache] = None,
+    context_budget: Optional[int] = None,
+    sectioned: bool = False,
+    cascade_model: Optional[str] = None,
+    cascade_threshold: float = DEFAULT_CASCADE_THRESHOLD,
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]], List[str]]:
+    # (extraction, context packing stats, fields answered by the cascade model). The stats
+    # describe the passages sent in the single request; None without a context budget or
+    # when sectioned (each section packs its own passages). With a cascade, the first
+    # (cheap) tier is timed separately.
+    context = None
+    with current_telemetry().stage("cascade_first_tier") if cascade_model else nullcontext():
+        if sectioned:
+            data = run_sectioned_extraction(
+                scheduler, article_text, model, temperature, max_tokens, force_english, allow_unknown,
+                cache=cache, context_budget=context_budget,
+            )
+        else:
+            if context_budget:
+                text, context = pack_context(article_text, context_budget)
+            else:
+                text = prepare_article_text(article_text)
+            data = _cached_complete(
+                scheduler, _messages(text, force_english, allow_unknown),
+                ExtractionSchema.json_schema(), model, temperature, max_tokens, cache=cache,
+            )
+    filled: List[str] = []
+    if cascade_model:
+        data, filled = escalate_unknowns(
+            scheduler, article_text, data, cascade_model, cascade_threshold, temperature=temperature,
+            max_tokens=max_tokens, force_english=force_english, allow_unknown=allow_unknown, cache=cache,
+            context_budget=context_budget,
+        )
+    return data, context, filled
+
+def run_field_extraction(
+    scheduler,
+    article_text: str,
+    paths: List[str],
+    model: str,
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    cache: Optional[ExtractionCache] = None,
+    context_budget: Optional[int] = None,
+) -> Dict[str, Any]:
+    # Asks only for the given leaves ("section.field") through a strict sub-schema; with a
+    # context budget only the passages relevant to their sections are sent
+    schema = subschema(paths)
+    messages = build_messages(article_text, force_english, allow_unknown, context_budget, sections=list(schema["properties"]))
+    return _cached_complete(scheduler, messages, schema, model, temperature, max_tokens, cache=cache,
+                            name=f"{SCHEMA_NAME}_fields")
+
+def is_unknown(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and value.strip().lower().rstrip(".") in UNKNOWN_ANSWERS)
+
+def escalation_paths(data: Dict[str, Any], threshold: float = DEFAULT_CASCADE_THRESHOLD) -> List[str]:
+    # Unknown leaves of every section in which at least `threshold` of the fields came back
+    # unknown (top-level string fields such as study_summary count as their own section)
+    by_section: Dict[str, List[str]] = {}
+    unknown: Dict[str, List[str]] = {}
+    for path in leaf_specs():
+        section = path.split(".", 1)[0]
+        by_section.setdefault(section, []).append(path)
+        node: Any = data
+        for key in path.split("."):
+            node = node.get(key) if isinstance(node, dict) else None
+        if is_unknown(node):
+            unknown.setdefault(section, []).append(path)
+    return [p for section, paths in unknown.items()
+            if len(paths) / len(by_section[section]) >= threshold for p in paths]
+
+def escalate_unknowns(
+    scheduler,
+    article_text: str,
+    data: Dict[str, Any],
+    model: str,
+    threshold: float = DEFAULT_CASCADE_THRESHOLD,
+    temperature: float = 0.2,
+    max_tokens: int = 5000,
+    force_english: bool = True,
+    allow_unknown: bool = True,
+    cache: Optional[ExtractionCache] = None,
+    context_budget: Optional[int] = None,
+) -> Tuple[Dict[str, Any], List[str]]:
+    # Second tier of the cascade: one request to the stronger `model` for just the fields the
+    # first model left unknown; only real answers replace the first tier's. Returns the
+    # merged document and the fields the stronger model answered.
+    paths = escalation_paths(data, threshold)
+    if not paths:
+        return data, []
+    tel = current_telemetry()
+    with tel.stage("cascade_escalation"):
+        update = run_field_extraction(scheduler, article_text, paths, model, temperature, max_tokens,
+                                      force_english, allow_unknown, cache=cache, context_budget=context_budget)
+    filled = _drop_unknowns(update)
+    filled_paths = [p for p in paths if _has_leaf(filled, p)]
+    tel.incr("cascade_escalated_fields_total", len(paths))
+    tel.incr("cascade_filled_fields_total", len(filled_paths))
+    tel.event("cascade", model=model, escalated=len(paths), filled=len(filled_paths))
+    return merge_documents(data, filled), filled_paths
+
+def answering_model(model: str, cascade_model: Optional[str], cascade_filled: List[str]) -> str:
+    # The model recorded with a result: the strongest one that answered any field, i.e. the
+    # cascade model once it filled something
+    return cascade_model if cascade_model and cascade_filled else model
+
+def reusable_models(options: Dict[str, Any]) -> Tuple[str, ...]:
+    # Recorded models of a stored result that a request with these options may reuse: its
+    # own model, or with a cascade also the cascade model (a result the cascade completed)
+    return tuple(dict.fromkeys(m for m in (options["model"], options.get("cascade_model")) if m))
+
+def _drop_unknowns(update: Dict[str, Any]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for key, value in update.items():
+        if isinstance(value, dict):
+            value = _drop_unknowns(value)
+            if value:
+                out[key] = value
+        elif not is_unknown(value):
+            out[key] = value
+    return out
+
+def _has_leaf(doc: Dict[str, Any], path: str) -> bool:
+    node: Any = doc
+    for key in path.split("."):
+        if not isinstance(node, dict) or key not in node:
+            return False
+        node = node[key]
+    return not isinstance(node, dict)
@@ -0,0 +1,466 @@
+import argparse
+import bisect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from cache import DEFAULT_CACHE_PATH, ExtractionCache, make_cache_key
+from dedup import DedupIndex
+from evidence_store import EvidenceStore
+from extraction import (
+    DEFAULT_CASCADE_THRESHOLD,
+    answering_model,
+    escalate_unknowns,
+    reusable_models,
+    run_sectioned_extraction,
+    stream_extraction,
+)
+from jsonstream import TruncatedOutputError
+from models import schema_version
+from scheduler import get_scheduler
+from search_index import SearchIndex
+from telemetry import PROCESS, Telemetry, current as current_telemetry, use_telemetry
+
+# Background extraction jobs: a persistent job table (SQLite) and a worker pool that runs
+# outside the Streamlit script, so a run survives reruns/reloads and every session shares
+# a bounded number of model calls.
+# - submit() coalesces identical requests (same article text + extraction options) that
+#   are still queued or running into one job; each submitter is recorded as an owner.
+# - Workers claim the oldest queued job, write the live partial document while the
+#   model streams, and store the result (or error) on the job row. Every pool beats for
+#   its running jobs (whatever phase they are in) and puts jobs whose worker went silent,
+#   e.g. after a crash, back in the queue.
+# - The app starts an in-process pool (JOBS_WORKERS threads); `python jobs.py worker`
+#   runs a standalone one against the same table (set JOBS_EXTERNAL_WORKER=1 for the app).
+
+DEFAULT_JOBS_PATH = os.getenv("JOBS_DB_PATH", os.path.join(".cache", "jobs.sqlite"))
+# Fixed server-side cap on jobs running at once, whatever a session asks for; each
+# submitter's own parallelism is bounded by its scheduler's max_concurrency
+DEFAULT_WORKERS = int(os.getenv("JOBS_WORKERS", "8"))
+# Running jobs get a heartbeat this often; one whose worker stopped beating for
+# STALE_AFTER is put back in the queue
+HEARTBEAT_INTERVAL = 30.0
+STALE_AFTER = 4 * HEARTBEAT_INTERVAL
+PARTIAL_INTERVAL = 1.0
+ACTIVE = ("queued", "running")
+# Extras that change what a job does (cache, duplicate reuse, evidence store), so they are
+# part of the coalescing key; the others (article id) only label the result
+COALESCE_EXTRAS = ("use_cache", "add_to_store", "reuse_duplicates", "duplicate_of")
+TRUNCATED_WARNING = ("The model reached the max output tokens limit before finishing; the result is partial. "
+                     "Increase 'Max output tokens' for a complete extraction.")
+
+_COLUMNS = ("id", "status", "article_name", "options", "extras", "result", "partial", "error", "warning",
+            "reused_from", "telemetry", "created_at", "started_at", "heartbeat_at", "finished_at", "attempts")
+
+class JobQueue:
+    def __init__(self, path: str = DEFAULT_JOBS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        # Set on submit so in-process workers wake up without waiting for the next poll
+        self.wakeup = threading.Event()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                coalesce_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                article_name TEXT,
+                article_text TEXT NOT NULL,
+                options TEXT NOT NULL,
+                extras TEXT NOT NULL,
+                result TEXT,
+                partial TEXT,
+                error TEXT,
+                warning TEXT,
+                reused_from TEXT,
+                telemetry TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                heartbeat_at REAL,
+                finished_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS job_owners (
+                job_id TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                submitted_at REAL NOT NULL,
+                PRIMARY KEY (job_id, owner)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs(coalesce_key, status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_job_owners_owner ON job_owners(owner, submitted_at)")
+
+    # --- submitting -------------------------------------------------------------
+
+    def submit(
+        self,
+        article_text: str,
+        options: Dict[str, Any],
+        owner: str,
+        article_name: str = "",
+        extras: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, bool]:
+        # (job id, coalesced): an identical request still queued/running is shared
+        key = make_cache_key(article_text, **options,
+                             extras={k: (extras or {}).get(k) for k in COALESCE_EXTRAS})
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE coalesce_key = ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                    (key, *ACTIVE),
+                ).fetchone()
+                coalesced = row is not None
+                job_id = row[0] if coalesced else uuid.uuid4().hex[:12]
+                if not coalesced:
+                    self._conn.execute(
+                        """INSERT INTO jobs (id, coalesce_key, status, article_name, article_text, options, extras, created_at)
+                           VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)""",
+                        (job_id, key, article_name, article_text, json.dumps(options), json.dumps(extras or {}), now),
+                    )
+                self._conn.execute("INSERT OR IGNORE INTO job_owners (job_id, owner, submitted_at) VALUES (?, ?, ?)",
+                                   (job_id, owner, now))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.wakeup.set()
+        return job_id, coalesced
+
+    # --- worker side ------------------------------------------------------------
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        # Oldest queued job -> running; BEGIN IMMEDIATE so two workers (threads or
+        # processes) never claim the same job
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        """UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?,
+                           attempts = attempts + 1 WHERE id = ?""", (now, now, row[0]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row[0], with_text=True) if row is not None else None
+
+    def update_partial(self, job_id: str, partial: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET partial = ?, heartbeat_at = ? WHERE id = ?",
+                               (json.dumps(partial, ensure_ascii=False), time.time(), job_id))
+
+    def finish(self, job_id: str, result: Dict[str, Any], warning: Optional[str] = None,
+               reused_from: Optional[str] = None, telemetry: Optional[Dict[str, Any]] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                """UPDATE jobs SET status = 'done', result = ?, partial = NULL, error = NULL, warning = ?,
+                   reused_from = ?, telemetry = ?, finished_at = ? WHERE id = ?""",
+                (json.dumps(result, ensure_ascii=False), warning, reused_from,
+                 json.dumps(telemetry) if telemetry else None, time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str, telemetry: Optional[Dict[str, Any]] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, telemetry = ?, finished_at = ? WHERE id = ?",
+                (error, json.dumps(telemetry) if telemetry else None, time.time(), job_id),
+            )
+
+    def requeue(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ? AND status = 'running'", (job_id,))
+
+    def touch(self, job_ids: List[str]) -> None:
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND id IN ({','.join('?' * len(job_ids))})",
+                [time.time(), *job_ids])
+
+    def requeue_stale(self, older_than: float = STALE_AFTER) -> int:
+        cutoff = time.time() - older_than
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND heartbeat_at < ?", (cutoff,)).rowcount
+
+    # --- reading ----------------------------------------------------------------
+
+    def _row(self, row: Tuple, columns: Tuple[str, ...]) -> Dict[str, Any]:
+        job = dict(zip(columns, row))
+        for name in ("options", "extras", "result", "partial", "telemetry"):
+            if job.get(name) is not None:
+                job[name] = json.loads(job[name])
+        return job
+
+    def get(self, job_id: str, with_text: bool = False) -> Optional[Dict[str, Any]]:
+        columns = _COLUMNS + (("article_text",) if with_text else ())
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(columns)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = self._row(row, columns)
+            if job["status"] == "queued":
+                job["queue_position"] = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (job["created_at"],)
+                ).fetchone()[0] + 1
+        return job
+
+    def progress(self, job_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        # Status of many jobs in one query, without the (large) result documents; for
+        # polling a multi-article run
+        columns = ("id", "status", "article_name", "error", "warning", "reused_from", "created_at", "started_at",
+                   "finished_at")
+        if not job_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(columns)} FROM jobs WHERE id IN ({','.join('?' * len(job_ids))})", job_ids
+            ).fetchall()
+            queued = [r[0] for r in self._conn.execute(
+                "SELECT created_at FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall()]
+        out = {}
+        for row in rows:
+            job = self._row(row, columns)
+            if job["status"] == "queued":
+                job["queue_position"] = bisect.bisect_left(queued, job["created_at"]) + 1
+            out[job["id"]] = job
+        return out
+
+    def list_jobs(self, owner: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        # Most recent first; without the (large) result documents
+        columns = ("id", "status", "article_name", "options", "error", "warning", "reused_from",
+                   "created_at", "finished_at")
+        select = ", ".join(f"j.{c}" for c in columns)
+        with self._lock:
+            if owner is None:
+                rows = self._conn.execute(f"SELECT {select} FROM jobs j ORDER BY j.created_at DESC LIMIT ?",
+                                          (limit,)).fetchall()
+            else:
+                rows = self._conn.execute(
+                    f"SELECT {select} FROM jobs j JOIN job_owners o ON o.job_id = j.id WHERE o.owner = ? "
+                    f"ORDER BY o.submitted_at DESC LIMIT ?", (owner, limit)).fetchall()
+        return [self._row(r, columns) for r in rows]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+class WorkerPool:
+    # Threads that run queued jobs. API keys typed into the app are kept in memory only,
+    # per job; jobs without one (e.g. after a restart) use OPENAI_API_KEY.
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        workers: int = DEFAULT_WORKERS,
+        cache: Optional[ExtractionCache] = None,
+        dedup: Optional[DedupIndex] = None,
+        store: Optional[EvidenceStore] = None,
+        search: Optional[SearchIndex] = None,
+        poll_interval: float = 1.0,
+        scheduler_for: Callable[[Optional[str]], Any] = get_scheduler,
+    ):
+        self.queue = queue
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.dedup = dedup
+        self.store = store
+        self.search = search
+        self.poll_interval = poll_interval
+        self.scheduler_for = scheduler_for
+        self.api_keys: Dict[str, str] = {}
+        self.running: Dict[str, str] = {}
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, article_text: str, options: Dict[str, Any], owner: str, article_name: str = "",
+               extras: Optional[Dict[str, Any]] = None, api_key: Optional[str] = None) -> Tuple[str, bool]:
+        job_id, coalesced = self.queue.submit(article_text, options, owner, article_name, extras)
+        if api_key:
+            self.api_keys.setdefault(job_id, api_key)
+        return job_id, coalesced
+
+    def start(self) -> "WorkerPool":
+        self.queue.requeue_stale()
+        self._spawn(self.workers)
+        threading.Thread(target=self._maintain, name="job-heartbeat", daemon=True).start()
+        return self
+
+    def _maintain(self) -> None:
+        # Heartbeats for the jobs running here, then jobs whose worker went silent (another
+        # process, or this one before a restart) back to the queue
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.queue.touch(list(self.running))
+                self.queue.requeue_stale()
+            except sqlite3.Error:
+                continue  # database busy: next round
+
+    def _spawn(self, count: int) -> None:
+        for _ in range(count):
+            t = threading.Thread(target=self._loop, name=f"job-worker-{len(self._threads)}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self.queue.wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+        # Jobs interrupted mid-call go back to the queue for the next worker
+        for job_id in list(self.running):
+            self.queue.requeue(job_id)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self.queue.wakeup.wait(self.poll_interval)
+                self.queue.wakeup.clear()
+                continue
+            self.running[job["id"]] = threading.current_thread().name
+            try:
+                self.run_job(job)
+            finally:
+                self.running.pop(job["id"], None)
+
+    def run_job(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        options, extras = job["options"], job["extras"]
+        text = job["article_text"]
+        last_update = 0.0
+
+        def publish(partial: Dict[str, Any]) -> None:
+            # Throttled: the UI polls about once a second
+            nonlocal last_update
+            if time.time() - last_update >= PARTIAL_INTERVAL:
+                self.queue.update_partial(job_id, partial)
+                last_update = time.time()
+
+        with use_telemetry(Telemetry(parent=PROCESS, job=job_id)) as tel:
+            try:
+                data, warning, reused_from, model = None, None, None, options["model"]
+                duplicate = extras.get("duplicate_of")
+                if duplicate and extras.get("reuse_duplicates") and self.dedup is not None:
+                    # Not if the duplicate was extracted with other models or an older schema
+                    data = self.dedup.result(duplicate, schema_version=schema_version(), model=reusable_models(options))
+                    if data is not None:
+                        reused_from, model = duplicate, self.dedup.stored_result(duplicate)["model"]
+                if data is None:
+                    cache = self.cache if extras.get("use_cache", True) else None
+                    data, truncated, filled = self._extract(self.api_keys.get(job_id), text, options, cache, publish)
+                    warning = TRUNCATED_WARNING if truncated else None
+                    model = answering_model(options["model"], options.get("cascade_model"), filled)
+                if warning is None:
+                    self._record(job, text, data, model)
+                # else the partial document stays on the job row only: it is not indexed for
+                # duplicate reuse, the evidence store or search (batch.py fails such articles)
+                self.queue.finish(job_id, data, warning=warning, reused_from=reused_from, telemetry=tel.summary())
+            except Exception as e:
+                self.queue.fail(job_id, str(e), telemetry=tel.summary())
+            finally:
+                self.api_keys.pop(job_id, None)
+
+    def _extract(self, api_key: Optional[str], text: str, options: Dict[str, Any], cache: Optional[ExtractionCache],
+                 publish: Callable[[Dict[str, Any]], None]) -> Tuple[Dict[str, Any], bool, List[str]]:
+        # (extraction, truncated, fields answered by the cascade model): a streamed output cut
+        # off by max_tokens gives its partial document
+        scheduler = self.scheduler_for(api_key)
+        options = dict(options)
+        cascade_model = options.pop("cascade_model", None)
+        cascade_threshold = options.pop("cascade_threshold", DEFAULT_CASCADE_THRESHOLD)
+        sectioned = options.pop("sectioned", False)
+        with current_telemetry().stage("cascade_first_tier") if cascade_model else nullcontext():
+            if sectioned:
+                data = run_sectioned_extraction(scheduler, text, cache=cache, **options,
+                                                on_section=lambda name, partial: publish(partial))
+            else:
+                data = {}
+                try:
+                    for data in stream_extraction(scheduler, text, cache=cache, **options):
+                        publish(data)
+                except TruncatedOutputError as e:
+                    return e.partial or {}, True, []
+        filled: List[str] = []
+        if cascade_model:
+            publish(data)
+            data, filled = escalate_unknowns(scheduler, text, data, cascade_model, cascade_threshold, cache=cache,
+                                             **{k: v for k, v in options.items() if k != "model"})
+        return data, False, filled
+
+    def _record(self, job: Dict[str, Any], text: str, data: Dict[str, Any], model: str) -> None:
+        # Completed extractions feed the near-duplicate index, the evidence store and search
+        doc_id = job["extras"].get("article_id") or job["id"]
+        if self.dedup is not None and self.dedup.add(doc_id, text, source=job["article_name"]):
+            self.dedup.attach_result(doc_id, data, model=model, schema_version=schema_version())
+        if self.store is not None and job["extras"].get("add_to_store"):
+            self.store.add(doc_id, data, source=job["article_name"], model=model)
+            self.store.flush()
+        if self.search is not None:
+            self.search.add(doc_id, data, text=text, source=job["article_name"], model=model)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from dedup import DEFAULT_DEDUP_PATH
+    from evidence_store import DEFAULT_STORE_PATH
+    from search_index import DEFAULT_SEARCH_PATH
+
+    parser = argparse.ArgumentParser(description="Background extraction jobs.")
+    parser.add_argument("--db", default=DEFAULT_JOBS_PATH, help="Job table (SQLite file)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_worker = sub.add_parser("worker", help="Run a standalone worker pool (uses OPENAI_API_KEY)")
+    p_worker.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS)
+    p_worker.add_argument("--no-cache", action="store_true")
+    p_list = sub.add_parser("list", help="Recent jobs")
+    p_list.add_argument("--owner", default=None)
+    p_list.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    queue = JobQueue(args.db)
+    if args.command == "list":
+        for job in queue.list_jobs(args.owner, args.limit):
+            created = time.strftime("%Y-%m-%d %H:%M", time.localtime(job["created_at"]))
+            print(f"{job['id']}  {job['status']:<8} {created}  {job['article_name'] or '-'}"
+                  + (f"  ({job['error']})" if job["error"] else ""))
+        print(json.dumps(queue.stats()))
+        return 0
+
+    if not os.getenv("OPENAI_API_KEY"):
+        parser.error("OPENAI_API_KEY is not set")
+    pool = WorkerPool(
+        queue,
+        workers=args.workers,
+        cache=None if args.no_cache else ExtractionCache(DEFAULT_CACHE_PATH),
+        dedup=DedupIndex(DEFAULT_DEDUP_PATH),
+        store=EvidenceStore(DEFAULT_STORE_PATH),
+        search=SearchIndex(DEFAULT_SEARCH_PATH),
+    ).start()
+    print(f"{pool.workers} workers on {args.db}; Ctrl+C to stop.", flush=True)
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(queue.stats()), flush=True)
+    except KeyboardInterrupt:
+        pool.stop(timeout=1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
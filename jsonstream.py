@@ -0,0 +1,158 @@
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+# Incremental JSON parser for streamed Structured Outputs.
+# Feed it completion deltas as they arrive; every call returns the values that became
+# complete (path, value), and `document` always holds the part of the document parsed
+# so far (containers are attached as soon as they open, scalars once they close).
+# Anything before the first '{' / '[' (e.g. a ```json fence) and after the root value
+# is ignored, and output cut off by max_tokens leaves a usable partial document.
+
+Path = Tuple[Any, ...]
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_LITERAL_END = re.compile(r'[\s,}\]]')
+_LITERAL_START = set("-0123456789tfn")
+
+class TruncatedOutputError(ValueError):
+    # The model output ended before the root JSON value was closed
+    def __init__(self, partial: Any):
+        super().__init__("Model output was truncated before the JSON document was complete.")
+        self.partial = partial
+
+class _Frame:
+    __slots__ = ("container", "path", "key")
+
+    def __init__(self, container: Any, path: Path):
+        self.container = container
+        self.path = path
+        self.key: Optional[str] = None
+
+class IncrementalJSONParser:
+    def __init__(self):
+        self.document: Any = None
+        self.done = False
+        self._started = False
+        self._stack: List[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        self._string: List[str] = []
+        self._literal: List[str] = []
+
+    def feed(self, chunk: str) -> List[Tuple[Path, Any]]:
+        completed: List[Tuple[Path, Any]] = []
+        i, n = 0, len(chunk)
+        while i < n and not self.done:
+            if self._in_string:
+                if self._escape:
+                    self._string.append(chunk[i])
+                    self._escape = False
+                    i += 1
+                    continue
+                m = _STRING_SPECIAL.search(chunk, i)
+                if m is None:
+                    self._string.append(chunk[i:])
+                    break
+                j = m.start()
+                self._string.append(chunk[i:j])
+                i = j + 1
+                if chunk[j] == "\\":
+                    self._string.append("\\")
+                    self._escape = True
+                else:
+                    self._in_string = False
+                    self._close_string(completed)
+                continue
+
+            if self._literal:
+                m = _LITERAL_END.search(chunk, i)
+                if m is None:
+                    self._literal.append(chunk[i:])
+                    break
+                self._literal.append(chunk[i:m.start()])
+                i = m.start()
+                self._close_literal(completed)
+                continue
+
+            c = chunk[i]
+            if not self._started:
+                # Skip fences / chatter until the root container opens
+                if c not in "{[":
+                    i += 1
+                    continue
+                self._started = True
+            if c in " \t\r\n:,":
+                pass
+            elif c == '"':
+                self._in_string = True
+                self._string = []
+            elif c == "{":
+                self._open({})
+            elif c == "[":
+                self._open([])
+            elif c in "}]":
+                frame = self._stack.pop()
+                completed.append((frame.path, frame.container))
+                if not self._stack:
+                    self.done = True
+            elif c in _LITERAL_START:
+                self._literal = [c]
+            else:
+                raise ValueError(f"Unexpected character {c!r} in JSON output")
+            i += 1
+        return completed
+
+    def close(self) -> Any:
+        # Call once the stream has ended: returns the complete document, or raises
+        # TruncatedOutputError carrying the partial one.
+        if not self.done:
+            raise TruncatedOutputError(self.document)
+        return self.document
+
+    @property
+    def pending_key(self) -> Optional[Path]:
+        # Path of the value currently being streamed, if any (useful for progress display)
+        if not self._stack:
+            return None
+        top = self._stack[-1]
+        if isinstance(top.container, dict):
+            return top.path + (top.key,) if top.key is not None else None
+        return top.path + (len(top.container),)
+
+    def _open(self, container: Any) -> None:
+        path = self._attach(container)
+        self._stack.append(_Frame(container, path))
+
+    def _attach(self, value: Any) -> Path:
+        if not self._stack:
+            self.document = value
+            return ()
+        top = self._stack[-1]
+        if isinstance(top.container, dict):
+            key = top.key
+            top.container[key] = value
+            top.key = None
+            return top.path + (key,)
+        top.container.append(value)
+        return top.path + (len(top.container) - 1,)
+
+    def _close_string(self, completed: List[Tuple[Path, Any]]) -> None:
+        value = json.loads('"' + "".join(self._string) + '"')
+        self._string = []
+        top = self._stack[-1] if self._stack else None
+        if top is not None and isinstance(top.container, dict) and top.key is None:
+            top.key = value
+            return
+        completed.append((self._attach(value), value))
+
+    def _close_literal(self, completed: List[Tuple[Path, Any]]) -> None:
+        value = json.loads("".join(self._literal))
+        self._literal = []
+        completed.append((self._attach(value), value))
+
+def parse_json_document(content: str) -> Any:
+    # One-shot parse with the same tolerance as the streaming path (fences, trailing text)
+    parser = IncrementalJSONParser()
+    parser.feed(content)
+    return parser.close()
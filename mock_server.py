@@ -0,0 +1,369 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+# Local stand-in for the OpenAI endpoints this tool uses, so the bulk (Batch API) mode
+# can be exercised end to end without an API key or spending tokens:
+#
+#   python mock_server.py --port 8765 --fail-rate 0.1
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=test python bulk.py run ./fulltexts -o ./bulk
+#
+# Emulated: POST /v1/chat/completions (plain and streamed), POST /v1/files,
+# GET /v1/files/{id}/content, POST /v1/batches, GET /v1/batches/{id}.
+# Every request gets a schema-valid document built from its response_format schema.
+# --fail-rate makes that fraction of batch lines fail so resubmission can be tested;
+# --latency / --tokens-per-second / --max-concurrent / --rpm / --rate-limit-rate shape the
+# synchronous endpoint (benchmarks, 429 handling), which also sends x-ratelimit-* headers.
+# The synchronous endpoint also emulates provider prompt caching: a prompt whose first
+# 1024+ tokens (in 128-token steps) match an earlier prompt reports them as cached_tokens.
+
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+PROMPT_CACHE_MAX_ENTRIES = 200_000
+
+def sample_document(schema: Dict[str, Any], rng: Optional[random.Random] = None) -> Any:
+    rng = rng or random.Random(0)
+    kind = schema.get("type")
+    if kind == "object":
+        return {k: sample_document(v, rng) for k, v in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [sample_document(schema.get("items", {}), rng)]
+    if kind == "integer" or (isinstance(kind, list) and "integer" in kind):
+        return rng.randint(1, 200)
+    return rng.choice(["unknown", "not reported", "reported in the article"])
+
+def prompt_prefix_keys(messages: List[Dict[str, Any]]) -> List[Tuple[int, str]]:
+    # (tokens, digest) of every cacheable prefix of the prompt, shortest first (~4 chars/token)
+    prompt = "".join(f"{m.get('role')}\n{m.get('content') or ''}\n" for m in messages)
+    digest = hashlib.sha1()
+    keys = []
+    done = 0
+    for tokens in range(PROMPT_CACHE_MIN_TOKENS, len(prompt) // 4 + 1, PROMPT_CACHE_STEP_TOKENS):
+        digest.update(prompt[done:4 * tokens].encode("utf-8"))
+        done = 4 * tokens
+        keys.append((tokens, digest.hexdigest()))
+    return keys
+
+def chat_completion(body: Dict[str, Any], rng: random.Random, cached_tokens: int = 0) -> Dict[str, Any]:
+    # A complete chat.completion object whose content matches the request's strict schema
+    schema = body.get("response_format", {}).get("json_schema", {}).get("schema", {"type": "object"})
+    content = json.dumps(sample_document(schema, rng))
+    prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+    prompt_tokens = prompt_chars // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)},
+        },
+    }
+
+class MockState:
+    def __init__(
+        self,
+        fail_rate: float = 0.0,
+        batch_delay: float = 0.5,
+        seed: int = 0,
+        latency: float = 0.0,
+        tokens_per_second: Optional[float] = None,
+        max_concurrent: Optional[int] = None,
+        rpm: Optional[int] = None,
+        rate_limit_rate: float = 0.0,
+    ):
+        self.fail_rate = fail_rate
+        self.batch_delay = batch_delay
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.max_concurrent = max_concurrent
+        self.rpm = rpm
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.in_flight = 0
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.stats = {"requests": 0, "rate_limited": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self.prompt_cache: set = set()
+
+    def admit(self) -> Tuple[bool, Dict[str, str]]:
+        # Rate limiting for the synchronous endpoint: per-minute window, concurrency cap and
+        # random 429 injection. Returns (admitted, x-ratelimit-* headers).
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start, self.window_requests = now, 0
+            reset = 60 - (now - self.window_start)
+            limited = (
+                (self.rpm is not None and self.window_requests >= self.rpm)
+                or (self.max_concurrent is not None and self.in_flight >= self.max_concurrent)
+                or self.rng.random() < self.rate_limit_rate
+            )
+            if not limited:
+                self.window_requests += 1
+                self.in_flight += 1
+            self.stats["requests"] += 1
+            self.stats["rate_limited"] += int(limited)
+            headers = {"x-ratelimit-reset-requests": f"{reset:.3f}s"}
+            if self.rpm is not None:
+                headers["x-ratelimit-limit-requests"] = str(self.rpm)
+                headers["x-ratelimit-remaining-requests"] = str(max(0, self.rpm - self.window_requests))
+            return not limited, headers
+
+    def done(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def cached_prefix_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        # Longest prefix seen in an earlier prompt; this prompt's prefixes are cached in turn
+        keys = prompt_prefix_keys(messages)
+        with self.lock:
+            cached = max((tokens for tokens, key in keys if key in self.prompt_cache), default=0)
+            if len(self.prompt_cache) > PROMPT_CACHE_MAX_ENTRIES:
+                self.prompt_cache.clear()
+            self.prompt_cache.update(key for _, key in keys)
+        return cached
+
+    def completion_rng(self) -> random.Random:
+        with self.lock:
+            return random.Random(self.rng.random())
+
+    def add_file(self, data: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        meta = {
+            "id": f"file-{uuid.uuid4().hex[:24]}",
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.lock:
+            self.files[meta["id"]] = {"meta": meta, "data": data}
+        return meta
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": body.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": body.get("metadata"),
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self._process_batch, args=(batch["id"],), daemon=True).start()
+        return batch
+
+    def _process_batch(self, batch_id: str) -> None:
+        batch = self.batches[batch_id]
+        time.sleep(self.batch_delay / 2)
+        batch["status"] = "in_progress"
+        lines = self.files[batch["input_file_id"]]["data"].decode("utf-8").splitlines()
+        out, err = [], []
+        for line in lines:
+            if not line.strip():
+                continue
+            req = json.loads(line)
+            with self.lock:
+                failed = self.rng.random() < self.fail_rate
+                rng = random.Random(self.rng.random())
+            record = {"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": req["custom_id"], "error": None}
+            if failed:
+                record["response"] = {"status_code": 500, "request_id": uuid.uuid4().hex,
+                                      "body": {"error": {"message": "Injected failure", "type": "server_error"}}}
+                err.append(record)
+            else:
+                record["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                      "body": chat_completion(req["body"], rng)}
+                out.append(record)
+        time.sleep(self.batch_delay / 2)
+        if out:
+            batch["output_file_id"] = self.add_file(
+                "".join(json.dumps(r) + "\n" for r in out).encode("utf-8"), "output.jsonl", "batch_output")["id"]
+        if err:
+            batch["error_file_id"] = self.add_file(
+                "".join(json.dumps(r) + "\n" for r in err).encode("utf-8"), "errors.jsonl", "batch_output")["id"]
+        batch["request_counts"] = {"total": len(out) + len(err), "completed": len(out), "failed": len(err)}
+        batch["completed_at"] = int(time.time())
+        batch["status"] = "completed"
+
+class MockHandler(BaseHTTPRequestHandler):
+    state: MockState  # set on the server-specific subclass
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(self, payload: Any, status: int = 200) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self) -> None:
+        self._send_json({"error": {"message": f"Unknown route {self.path}", "type": "invalid_request_error"}}, 404)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self) -> None:
+        m = re.fullmatch(r"/v1/batches/([\w-]+)", self.path)
+        if m and m.group(1) in self.state.batches:
+            return self._send_json(self.state.batches[m.group(1)])
+        m = re.fullmatch(r"/v1/files/([\w-]+)/content", self.path)
+        if m and m.group(1) in self.state.files:
+            data = self.state.files[m.group(1)]["data"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self._not_found()
+
+    def _chat_completions(self) -> None:
+        body = json.loads(self._read_body())
+        admitted, headers = self.state.admit()
+        if not admitted:
+            payload = json.dumps({"error": {"message": "Rate limit reached (mock)", "type": "requests",
+                                            "code": "rate_limit_exceeded"}}).encode("utf-8")
+            self.send_response(429)
+            for k, v in {**headers, "retry-after": "0.05", "Content-Type": "application/json"}.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        try:
+            cached_tokens = self.state.cached_prefix_tokens(body.get("messages", []))
+            completion = chat_completion(body, self.state.completion_rng(), cached_tokens)
+            with self.state.lock:
+                self.state.stats["prompt_tokens"] += completion["usage"]["prompt_tokens"]
+                self.state.stats["cached_tokens"] += completion["usage"]["prompt_tokens_details"]["cached_tokens"]
+            time.sleep(self.state.latency)
+            if body.get("stream"):
+                self._stream_completion(completion, headers, include_usage=bool((body.get("stream_options") or {}).get("include_usage")))
+                return
+            if self.state.tokens_per_second:
+                time.sleep(completion["usage"]["completion_tokens"] / self.state.tokens_per_second)
+            payload = json.dumps(completion).encode("utf-8")
+            self.send_response(200)
+            for k, v in {**headers, "Content-Type": "application/json"}.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        finally:
+            self.state.done()
+
+    def _stream_completion(self, completion: Dict[str, Any], headers: Dict[str, str], include_usage: bool) -> None:
+        # Server-sent events, ~4 tokens (16 chars) per chunk, paced by tokens_per_second
+        self.send_response(200)
+        for k, v in {**headers, "Content-Type": "text/event-stream", "Cache-Control": "no-cache"}.items():
+            self.send_header(k, v)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        content = completion["choices"][0]["message"]["content"]
+        base = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                "model": completion["model"]}
+        pause = (4 / self.state.tokens_per_second) if self.state.tokens_per_second else 0.0
+
+        def send(chunk: Dict[str, Any]) -> None:
+            self.wfile.write(b"data: " + json.dumps({**base, **chunk}).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+        send({"choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for i in range(0, len(content), 16):
+            send({"choices": [{"index": 0, "delta": {"content": content[i:i + 16]}, "finish_reason": None}]})
+            if pause:
+                time.sleep(pause)
+        send({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if include_usage:
+            send({"choices": [], "usage": completion["usage"]})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_POST(self) -> None:
+        if self.path == "/v1/chat/completions":
+            return self._chat_completions()
+        if self.path == "/v1/files":
+            filename, data, purpose = _parse_multipart_file(self.headers.get("Content-Type", ""), self._read_body())
+            return self._send_json(self.state.add_file(data, filename, purpose))
+        if self.path == "/v1/batches":
+            return self._send_json(self.state.create_batch(json.loads(self._read_body())))
+        self._not_found()
+
+def _parse_multipart_file(content_type: str, body: bytes) -> Tuple[str, bytes, str]:
+    msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    filename, data, purpose = "upload.jsonl", b"", ""
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name == "file":
+            filename = part.get_filename() or filename
+            data = part.get_payload(decode=True) or b""
+        elif name == "purpose":
+            purpose = (part.get_payload(decode=True) or b"").decode()
+    return filename, data, purpose
+
+def start_mock_server(host: str = "127.0.0.1", port: int = 0, **state_options: Any) -> Tuple[ThreadingHTTPServer, str]:
+    # Serves in a daemon thread; returns the server (call .shutdown()) and its /v1 base URL
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(**state_options)})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI endpoints used by this tool.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of batch lines that fail")
+    parser.add_argument("--batch-delay", type=float, default=0.5, help="Seconds a batch takes to complete")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before a completion starts")
+    parser.add_argument("--tokens-per-second", type=float, default=None, help="Output speed of completions")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="429 beyond this many requests in flight")
+    parser.add_argument("--rpm", type=int, default=None, help="429 beyond this many requests per minute")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    args = parser.parse_args()
+    server, base_url = start_mock_server(args.host, args.port, fail_rate=args.fail_rate,
+                                         batch_delay=args.batch_delay, seed=args.seed, latency=args.latency,
+                                         tokens_per_second=args.tokens_per_second, max_concurrent=args.max_concurrent,
+                                         rpm=args.rpm, rate_limit_rate=args.rate_limit_rate)
+    print(f"Mock OpenAI server on {base_url} (Ctrl+C to stop)", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
-from typing import Any, Dict
+import hashlib
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 
 # JSON Schema for OpenAI Structured Outputs (Chat Completions).
 # Requirements:
@@ -237,7 +240,107 @@ def _schema_dict() -> Dict[str, Any]:
         ]
     }
 
+@lru_cache(maxsize=1)
+def compiled_schema() -> Dict[str, Any]:
+    # Built, serialized and hashed once per process. Every request, cache key and report
+    # shares these objects, so treat them as read-only.
+    schema = _schema_dict()
+    canonical = canonical_json(schema)
+    return {
+        "schema": schema,
+        "canonical": canonical,
+        "version": hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12],
+        "sections": {name: _section_schema(schema, name) for name in schema["required"]},
+        "leaves": leaf_specs(schema),
+    }
+
+def canonical_json(schema: Dict[str, Any]) -> str:
+    return json.dumps(schema, sort_keys=True, separators=(",", ":"))
+
+def section_names() -> List[str]:
+    return list(compiled_schema()["sections"])
+
+def _section_schema(full: Dict[str, Any], section: str) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "additionalProperties": False,
+        "properties": {section: full["properties"][section]},
+        "required": [section]
+    }
+
+def section_schema(section: str) -> Dict[str, Any]:
+    # Strict sub-schema holding a single top-level section, e.g.
+    # {"clinical_features": {...}} -> the model answers only that part of the document
+    return compiled_schema()["sections"][section]
+
+def schema_version(schema: Optional[Dict[str, Any]] = None) -> str:
+    # Short content hash of the schema; results record it so later schema edits can be diffed
+    compiled = compiled_schema()
+    if schema is None or schema is compiled["schema"]:
+        return compiled["version"]
+    return hashlib.sha256(canonical_json(schema).encode("utf-8")).hexdigest()[:12]
+
+def leaf_specs(schema: Optional[Dict[str, Any]] = None, prefix: str = "") -> Dict[str, Dict[str, Any]]:
+    # {"section.field": field spec} for every non-object property, in schema order
+    if schema is None:
+        return dict(compiled_schema()["leaves"])
+    out: Dict[str, Dict[str, Any]] = {}
+    for name, spec in schema.get("properties", {}).items():
+        if spec.get("type") == "object":
+            out.update(leaf_specs(spec, f"{prefix}{name}."))
+        else:
+            out[f"{prefix}{name}"] = spec
+    return out
+
+def schema_diff(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, List[str]]:
+    # Leaf-level structural diff: a field whose spec (type, description...) changed has to
+    # be asked again, exactly like a new one
+    old_leaves, new_leaves = leaf_specs(old), leaf_specs(new)
+    return {
+        "added": [p for p in new_leaves if p not in old_leaves],
+        "changed": [p for p in new_leaves if p in old_leaves and old_leaves[p] != new_leaves[p]],
+        "removed": [p for p in old_leaves if p not in new_leaves],
+    }
+
+def subschema(paths: List[str], schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Strict schema holding only the given leaves (and the objects that contain them)
+    schema = schema or compiled_schema()["schema"]
+    wanted: Dict[str, List[str]] = {}
+    for path in paths:
+        head, _, rest = path.partition(".")
+        wanted.setdefault(head, [])
+        if rest:
+            wanted[head].append(rest)
+    props = {}
+    for name, spec in schema["properties"].items():
+        if name not in wanted:
+            continue
+        props[name] = subschema(wanted[name], spec) if spec.get("type") == "object" and wanted[name] else spec
+    out = {k: v for k, v in schema.items() if k not in ("properties", "required")}
+    return {**out, "properties": props, "required": list(props)}
+
+def merge_documents(base: Dict[str, Any], update: Dict[str, Any], schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Answers in `update` override `base`; the result follows the schema's key order and
+    # drops fields the schema no longer has
+    schema = schema or compiled_schema()["schema"]
+    out: Dict[str, Any] = {}
+    for name, spec in schema.get("properties", {}).items():
+        old, new = base.get(name), update.get(name)
+        if spec.get("type") == "object":
+            merged = merge_documents(old if isinstance(old, dict) else {}, new if isinstance(new, dict) else {}, spec)
+            if merged or name in base or name in update:
+                out[name] = merged
+        elif name in update:
+            out[name] = new
+        elif name in base:
+            out[name] = old
+    return out
+
 class ExtractionSchema:
     @staticmethod
     def json_schema() -> Dict[str, Any]:
-        return _schema_dict()
+        return compiled_schema()["schema"]
+
+    @staticmethod
+    def section_schemas() -> Dict[str, Dict[str, Any]]:
+        return dict(compiled_schema()["sections"])
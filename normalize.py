@@ -0,0 +1,189 @@
+import math
+import re
+import time
+from collections import Counter
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from context import _DROP_HEADINGS, _HEADING
+from telemetry import current as current_telemetry
+from utils import estimate_tokens
+
+# Token-reducing clean-up of extracted PDF text, between parsing and chunking / packing.
+# Pages stream through a chain of line generators:
+#   1. running headers / footers and page numbers are dropped: edge lines that repeat
+#      (digits ignored) on at least half of the first HEADER_SAMPLE_PAGES pages; a bare
+#      number only where numbers recur at the same edge (top or bottom)
+#   2. ligatures and invisible characters are replaced, whitespace is collapsed
+#   3. words hyphenated across a line (or page) break are rejoined
+#   4. optionally, reference lists and acknowledgements are cut (up to the next
+#      section heading, so funding / conflict-of-interest statements stay)
+# Only HEADER_SAMPLE_PAGES pages are held at a time; everything after the sample streams.
+
+HEADER_SAMPLE_PAGES = 8
+EDGE_LINES = 3
+# Back-matter headings this early are more likely a table of contents than the real thing
+MIN_BODY_CHARS = 2000
+
+_CHAR_FIXES = str.maketrans({
+    # ff, fi, fl, ffi, ffl, st ligatures
+    "\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl", "\ufb05": "st", "\ufb06": "st",
+    # soft hyphen, zero-width characters, byte-order mark
+    "\u00ad": "", "\u200b": "", "\u200c": "", "\u200d": "", "\ufeff": "",
+    # non-breaking and thin spaces, tabs
+    "\u00a0": " ", "\u2002": " ", "\u2003": " ", "\u2009": " ", "\u202f": " ", "\t": " ",
+})
+_SPACES = re.compile(r" {2,}")
+_DIGITS = re.compile(r"\d+")
+_PAGE_NUMBER = re.compile(r"^(?:page\s*)?\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?$", re.IGNORECASE)
+_HYPHEN_END = re.compile(r"([A-Za-z]+)-$")
+_LEADING_WORD = re.compile(r"^([a-z]+)(.*)$")
+_HYPHENATED = re.compile(r"\b[A-Za-z]+-[A-Za-z]+\b")
+
+def _edge_key(line: str) -> str:
+    # Page numbers, dates and volume numbers vary from page to page; the rest of a
+    # running header does not
+    return _SPACES.sub(" ", _DIGITS.sub("#", line.strip().lower()))
+
+def _line_key(line: str, edge: str) -> str:
+    # A page number is keyed with its edge, so "12" opening a page is only dropped when
+    # the pages are numbered at the top
+    stripped = line.strip()
+    key = _edge_key(stripped)
+    return f"{edge}:{key}" if _PAGE_NUMBER.match(stripped) else key
+
+def _edges(lines: List[str]) -> Iterator[Tuple[str, List[int]]]:
+    # Indexes of the first EDGE_LINES non-blank lines of a page, and of the last ones
+    # (from the bottom up)
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    yield "top", filled[:EDGE_LINES]
+    yield "bottom", filled[::-1][:EDGE_LINES]
+
+def learn_boilerplate(pages: List[List[str]]) -> Set[str]:
+    # Edge-line keys seen on at least half of the pages (never on fewer than 3 pages)
+    if len(pages) < 3:
+        return set()
+    seen: Counter = Counter()
+    for lines in pages:
+        seen.update({_line_key(lines[i], edge) for edge, order in _edges(lines) for i in order})
+    needed = max(2, math.ceil(len(pages) / 2))
+    return {key for key, n in seen.items() if n >= needed and key.strip("# ")}
+
+def _strip_edges(lines: List[str], boilerplate: Set[str], stats: Dict[str, Any]) -> List[str]:
+    drop = set()
+    # From the top and from the bottom, stop at the first line that is real text
+    for edge, order in _edges(lines):
+        for i in order:
+            if _line_key(lines[i], edge) not in boilerplate:
+                break
+            drop.add(i)
+    stats["boilerplate_lines"] += len(drop)
+    return [line for i, line in enumerate(lines) if i not in drop]
+
+def _page_lines(pages: Iterable[str], stats: Dict[str, Any]) -> Iterator[str]:
+    pages = iter(pages)
+    sample = []
+    for page in islice(pages, HEADER_SAMPLE_PAGES):
+        stats["raw_tokens"] += estimate_tokens(page)
+        sample.append(page.splitlines())
+    boilerplate = learn_boilerplate(sample)
+    stats["pages"] = len(sample)
+    for lines in sample:
+        yield from _strip_edges(lines, boilerplate, stats)
+    del sample
+    for page in pages:
+        stats["raw_tokens"] += estimate_tokens(page)
+        stats["pages"] += 1
+        yield from _strip_edges(page.splitlines(), boilerplate, stats)
+
+def _clean_lines(lines: Iterable[str]) -> Iterator[str]:
+    # Ligatures / invisible characters, runs of spaces, and at most one blank line in a row
+    blank = True
+    for line in lines:
+        line = _SPACES.sub(" ", line.translate(_CHAR_FIXES)).strip()
+        if not line:
+            if not blank:
+                yield ""
+            blank = True
+            continue
+        blank = False
+        yield line
+
+def _dehyphenate(lines: Iterable[str], stats: Dict[str, Any]) -> Iterator[str]:
+    # "treat-" + "ment was..." -> "treatment was..."; the hyphen stays when the article
+    # itself spells the compound with one ("follow-up") and never without
+    compounds: Set[str] = set()
+    words: Set[str] = set()
+    pending: Optional[str] = None
+    for line in lines:
+        compounds.update(w.lower() for w in _HYPHENATED.findall(line))
+        if pending is not None:
+            head = _HYPHEN_END.search(pending)
+            nxt = _LEADING_WORD.match(line)
+            if head and nxt:
+                first, second = head.group(1), nxt.group(1)
+                joined = first + second
+                keep = f"{first}-{second}".lower() in compounds and joined.lower() not in words
+                line = pending[:head.start()] + (f"{first}-{second}" if keep else joined) + nxt.group(2)
+                stats["dehyphenated"] += int(not keep)
+            else:
+                yield pending
+        words.update(w.lower() for w in line.split())
+        if _HYPHEN_END.search(line):
+            pending = line
+            continue
+        pending = None
+        yield line
+    if pending is not None:
+        yield pending
+
+def _drop_back_matter(lines: Iterable[str], stats: Dict[str, Any]) -> Iterator[str]:
+    dropping = False
+    body_chars = 0
+    for line in lines:
+        m = _HEADING.match(line) if len(line) < 60 else None
+        if m:
+            dropping = bool(_DROP_HEADINGS.match(m.group(1))) and body_chars >= MIN_BODY_CHARS
+        if dropping:
+            stats["back_matter_tokens"] += estimate_tokens(line)
+            continue
+        body_chars += len(line) + 1
+        yield line
+
+def normalize_pages(pages: Iterable[str], strip_back_matter: bool = True) -> Tuple[str, Dict[str, Any]]:
+    # Page texts (in order, e.g. lazily from utils.iter_pdf_pages) -> cleaned article text
+    # and what the clean-up saved
+    stats: Dict[str, Any] = {"pages": 0, "raw_tokens": 0, "boilerplate_lines": 0, "dehyphenated": 0,
+                             "back_matter_tokens": 0}
+    t0 = time.perf_counter()
+    # Pages parsed lazily are parsed inside this call; their time is not clean-up time
+    upstream = {"s": 0.0}
+
+    def source() -> Iterator[str]:
+        it = iter(pages)
+        while True:
+            t = time.perf_counter()
+            page = next(it, None)
+            upstream["s"] += time.perf_counter() - t
+            if page is None:
+                return
+            yield page
+
+    lines: Iterable[str] = _dehyphenate(_clean_lines(_page_lines(source(), stats)), stats)
+    if strip_back_matter:
+        lines = _drop_back_matter(lines, stats)
+    text = "\n".join(lines).strip()
+
+    raw_tokens = stats["raw_tokens"]
+    saved = max(0, raw_tokens - estimate_tokens(text))
+    stats.update(tokens=raw_tokens - saved, saved_tokens=saved,
+                 saved_pct=round(100 * saved / raw_tokens, 1) if raw_tokens else 0.0)
+    tel = current_telemetry()
+    tel.observe_stage("normalize", time.perf_counter() - t0 - upstream["s"])
+    tel.incr("text_raw_tokens_total", raw_tokens)
+    tel.incr("text_saved_tokens_total", saved)
+    return text, stats
+
+def normalize_text(text: str, strip_back_matter: bool = True) -> Tuple[str, Dict[str, Any]]:
+    # Already-joined text (pasted, .txt files): form feeds, if any, separate the pages
+    return normalize_pages(text.split("\f"), strip_back_matter)
@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from batch import SCHEMAS_DIR, RunManifest, load_article_text, save_schema_snapshot, write_json_atomic
+from cache import DEFAULT_CACHE_PATH, ExtractionCache
+from evidence_store import EvidenceStore
+from extraction import run_field_extraction
+from models import ExtractionSchema, leaf_specs, merge_documents, schema_diff, schema_version
+from scheduler import get_scheduler
+from search_index import DEFAULT_SEARCH_PATH, SearchIndex
+from telemetry import Telemetry, current as current_telemetry, use_telemetry
+
+# Incremental re-extraction after schema edits. For every finished article of a batch.py
+# run whose result was extracted with an older schema version, only the added or changed
+# fields are asked for (strict sub-schema, passages of their sections only), and the
+# answers are merged into the stored result; removed fields are dropped.
+#
+#   python reextract.py ./run --dry-run        # what changed, how many articles, rough cost
+#   python reextract.py ./run -c 8
+#
+# Results from runs older than schema versioning have no recorded version; pass the
+# schema they were extracted with (--old-schema old_schema.json).
+
+DEFAULT_FIELD_BUDGET = 2000
+
+def load_schema(out_dir: Path, version: str) -> Optional[Dict[str, Any]]:
+    path = out_dir / SCHEMAS_DIR / f"{version}.json"
+    return json.loads(path.read_text(encoding="utf-8")) if path.exists() else None
+
+def plan_reextraction(out_dir: Path, old_schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # {old version: {"diff": ..., "articles": [ids]}} for finished articles not on the
+    # current schema; articles whose old schema is unknown are listed separately
+    current = schema_version()
+    manifest = RunManifest(out_dir)
+    legacy_version = save_schema_snapshot(out_dir, old_schema) if old_schema else None
+    plan: Dict[str, Any] = {"current": current, "versions": {}, "unknown": []}
+    for aid, entry in manifest.articles.items():
+        if entry.get("status") != "done":
+            continue
+        version = entry.get("schema_version") or legacy_version
+        if version == current:
+            continue
+        schema = load_schema(out_dir, version) if version else None
+        if schema is None:
+            plan["unknown"].append(aid)
+            continue
+        group = plan["versions"].setdefault(version, {"diff": schema_diff(schema, ExtractionSchema.json_schema()), "articles": []})
+        group["articles"].append(aid)
+    return plan
+
+def reextract_article(
+    scheduler,
+    out_dir: Path,
+    aid: str,
+    entry: Dict[str, Any],
+    paths: List[str],
+    options: Dict[str, Any],
+    cache: Optional[ExtractionCache] = None,
+    run_telemetry: Optional[Telemetry] = None,
+) -> Dict[str, Any]:
+    result_path = out_dir / entry["output"]
+    data = json.loads(result_path.read_text(encoding="utf-8"))
+    update: Dict[str, Any] = {}
+    with use_telemetry(Telemetry(parent=run_telemetry or current_telemetry(), article=aid)) as tel:
+        if paths:
+            text_path = out_dir / entry["text"] if entry.get("text") else None
+            if text_path is not None and text_path.exists():
+                text = text_path.read_text(encoding="utf-8")
+            else:
+                text = load_article_text(Path(entry["source"]))
+            update = run_field_extraction(scheduler, text, paths, cache=cache, **options)
+    write_json_atomic(result_path, merge_documents(data, update))
+    return {"schema_version": schema_version(), "reextracted_fields": paths, "reextract_telemetry": tel.summary()}
+
+def run_reextraction(
+    out_dir: str,
+    scheduler,
+    concurrency: int = 4,
+    old_schema: Optional[Dict[str, Any]] = None,
+    context_budget: Optional[int] = DEFAULT_FIELD_BUDGET,
+    model: Optional[str] = None,
+    cache: Optional[ExtractionCache] = None,
+    store: Optional[EvidenceStore] = None,
+    search: Optional[SearchIndex] = None,
+    progress=None,
+) -> Dict[str, Any]:
+    out = Path(out_dir)
+    plan = plan_reextraction(out, old_schema)
+    manifest = RunManifest(out)
+    run_options = manifest.data.get("options", {})
+    options = dict(
+        model=model or run_options.get("model", "gpt-4.1-mini"),
+        temperature=run_options.get("temperature", 0.2),
+        max_tokens=run_options.get("max_tokens", 5000),
+        force_english=run_options.get("force_english", True),
+        allow_unknown=run_options.get("allow_unknown", True),
+        # An explicit budget of 0 sends the full text, as in batch.py
+        context_budget=context_budget or None,
+    )
+    save_schema_snapshot(out)
+
+    counts = {"updated": 0, "failed": 0, "unknown_schema": len(plan["unknown"])}
+    run_telemetry = Telemetry(parent=current_telemetry())
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {}
+        for group in plan["versions"].values():
+            paths = group["diff"]["added"] + group["diff"]["changed"]
+            for aid in group["articles"]:
+                fut = pool.submit(reextract_article, scheduler, out, aid, manifest.articles[aid], paths, options,
+                                  cache, run_telemetry)
+                futures[fut] = aid
+        for fut in as_completed(futures):
+            aid = futures[fut]
+            try:
+                manifest.update(aid, reextract_error=None, reextracted_at=time.time(), **fut.result())
+                counts["updated"] += 1
+                entry = manifest.articles[aid]
+                if store is not None or search is not None:
+                    data = json.loads((out / entry["output"]).read_text(encoding="utf-8"))
+                if store is not None:
+                    store.add(aid, data, source=entry.get("source"), model=options["model"])
+                if search is not None:
+                    text_path = out / entry["text"] if entry.get("text") else None
+                    text = text_path.read_text(encoding="utf-8") if text_path and text_path.exists() else None
+                    search.add(aid, data, text=text, source=entry.get("source"), model=options["model"])
+            except Exception as e:
+                manifest.update(aid, reextract_error=str(e))
+                counts["failed"] += 1
+            if progress is not None:
+                progress(aid, manifest.articles[aid], counts)
+    manifest.compact()
+    if store is not None:
+        store.flush()
+    counts["telemetry"] = run_telemetry.summary()
+    return counts
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Re-extract only added/changed schema fields for a batch run.")
+    parser.add_argument("out", help="Output folder of a batch.py run")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--old-schema", help="Schema (JSON file) of results that have no recorded schema version")
+    parser.add_argument("--context-budget", type=int, default=DEFAULT_FIELD_BUDGET,
+                        help="Input tokens per article (passages of the affected sections); 0 = full text")
+    parser.add_argument("--model", default=None, help="Model for the new fields (default: the run's model)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Extraction cache (SQLite file)")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--store", help="Also update this evidence store folder")
+    parser.add_argument("--search-index", default=DEFAULT_SEARCH_PATH,
+                        help="Search index to re-index the updated articles in (SQLite file)")
+    parser.add_argument("--no-search-index", action="store_true", help="Do not update the search index")
+    parser.add_argument("--dry-run", action="store_true", help="Only show the schema diff and affected articles")
+    args = parser.parse_args(argv)
+
+    out = Path(args.out)
+    old_schema = json.loads(Path(args.old_schema).read_text(encoding="utf-8")) if args.old_schema else None
+    plan = plan_reextraction(out, old_schema)
+    total_leaves = len(leaf_specs())
+    for version, group in plan["versions"].items():
+        diff = group["diff"]
+        asked = len(diff["added"]) + len(diff["changed"])
+        print(f"schema {version} -> {plan['current']}: {len(group['articles'])} articles, "
+              f"{len(diff['added'])} added, {len(diff['changed'])} changed, {len(diff['removed'])} removed "
+              f"({asked}/{total_leaves} fields asked again)")
+        for kind in ("added", "changed", "removed"):
+            for path in diff[kind]:
+                print(f"  {kind:<8} {path}")
+    if plan["unknown"]:
+        print(f"{len(plan['unknown'])} articles have no recorded schema version; pass --old-schema to include them.")
+    if not plan["versions"]:
+        print("All results are on the current schema.")
+        return 0
+    if args.dry_run:
+        return 0
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        parser.error("OPENAI_API_KEY is not set")
+
+    def progress(aid: str, entry: Dict[str, Any], counts: Dict[str, int]) -> None:
+        status = f"failed ({entry['reextract_error']})" if entry.get("reextract_error") else "updated"
+        print(f"[{counts['updated'] + counts['failed']}] {status}: {aid}", flush=True)
+
+    counts = run_reextraction(
+        args.out,
+        get_scheduler(api_key, max_concurrency=args.concurrency),
+        concurrency=args.concurrency,
+        old_schema=old_schema,
+        context_budget=args.context_budget,
+        model=args.model,
+        cache=None if args.no_cache else ExtractionCache(args.cache),
+        store=EvidenceStore(args.store) if args.store else None,
+        search=None if args.no_search_index else SearchIndex(args.search_index),
+        progress=progress,
+    )
+    print(f"Done: {counts['updated']} updated, {counts['failed']} failed.")
+    print(f"Tokens: {counts['telemetry']['prompt_tokens']} in ({counts['telemetry']['cached_tokens']} from the prompt cache, "
+          f"{counts['telemetry']['prompt_cache_hit_rate']:.0%}) / {counts['telemetry']['completion_tokens']} out, "
+          f"~${counts['telemetry']['cost_usd']:.4f}.")
+    return 0 if counts["failed"] == 0 else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import openai
+from openai import OpenAI
+
+from telemetry import current as current_telemetry
+from utils import estimate_tokens
+
+# Rate-limit-aware request scheduler. Every chat completion (UI, batch runner, sectioned
+# and streamed extraction) goes through one RequestScheduler per API key and process:
+# - one OpenAI client with a pooled keep-alive HTTP connection pool, reused by all calls
+# - request-per-minute and token-per-minute budgets (token buckets)
+# - adaptive concurrency: halved on 429, grown back on success, and paused when the
+#   x-ratelimit-remaining-* response headers say the quota window is exhausted
+# - retries of transient errors (429, 5xx, timeouts, connection errors) with jittered
+#   exponential backoff, honouring Retry-After
+# - queue depth / in-flight counters for monitoring
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    # OpenAI reset headers look like "20ms", "1s", "6m0s", "1h2m3.5s"
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+class TokenBucket:
+    # Continuous-refill bucket holding at most `per_minute` units
+    def __init__(self, per_minute: Optional[float]):
+        self.per_minute = per_minute
+        self.level = float(per_minute or 0)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if self.per_minute:
+            self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if not self.per_minute:
+            return 0.0
+        self._refill(now)
+        # A single request larger than the whole budget only waits for a full bucket
+        amount = min(amount, self.per_minute)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60.0 / self.per_minute
+
+    def take(self, amount: float) -> None:
+        if self.per_minute:
+            self.level -= min(amount, self.per_minute)
+
+    def set_rate(self, per_minute: Optional[float]) -> None:
+        if per_minute and not self.per_minute:
+            self.level = float(per_minute)
+        self.per_minute = per_minute or None
+        self.level = min(self.level, float(per_minute or 0))
+
+    def clamp(self, remaining: float) -> None:
+        # The server's view of the window wins when it is stricter than ours
+        if self.per_minute:
+            self.level = min(self.level, remaining)
+
+class RequestScheduler:
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        timeout: float = 600.0,
+        client=None,
+    ):
+        # `client` can be injected (tests, stand-in servers); otherwise one pooled client is built
+        self.client = client or OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,  # retries are handled here, with the scheduler's backoff
+            http_client=openai.DefaultHttpxClient(),
+        )
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency = self.max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+        self._cond = threading.Condition()
+        self._paused_until = 0.0
+        self._successes = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.counters = {"requests": 0, "retries": 0, "rate_limited": 0, "errors": 0}
+        self.last_headers: Dict[str, str] = {}
+
+    # --- public API -------------------------------------------------------------
+
+    def create(self, **kwargs: Any):
+        # Drop-in for client.chat.completions.create(**kwargs). With stream=True the
+        # returned iterator holds its in-flight slot until it is exhausted or closed.
+        cost = self._estimate_cost(kwargs)
+        tel = current_telemetry()
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            self._acquire(cost)
+            t1 = time.perf_counter()
+            tel.observe_stage("queue_wait", t1 - t0)
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(**kwargs)
+                self._observe_headers(raw.headers)
+                result = raw.parse()
+            except RETRYABLE_ERRORS as e:
+                self._release(success=False, rate_limited=isinstance(e, openai.RateLimitError))
+                attempt += 1
+                if attempt > self.max_retries:
+                    with self._cond:
+                        self.counters["errors"] += 1
+                    raise
+                with self._cond:
+                    self.counters["retries"] += 1
+                time.sleep(self._backoff(attempt, e))
+                continue
+            except Exception:
+                self._release(success=False)
+                with self._cond:
+                    self.counters["errors"] += 1
+                raise
+            if kwargs.get("stream"):
+                return _ScheduledStream(result, self._release, tel, kwargs.get("model", ""), t1)
+            self._release(success=True)
+            tel.record_completion(kwargs.get("model", ""), getattr(result, "usage", None), time.perf_counter() - t1,
+                                  retries=attempt)
+            return result
+
+    def configure(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+    ) -> None:
+        with self._cond:
+            if requests_per_minute is not None:
+                self.requests.set_rate(requests_per_minute)
+            if tokens_per_minute is not None:
+                self.tokens.set_rate(tokens_per_minute)
+            if max_concurrency is not None:
+                self.max_concurrency = max(1, max_concurrency)
+                self.min_concurrency = min(self.min_concurrency, self.max_concurrency)
+                self.concurrency = min(self.concurrency, self.max_concurrency)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "concurrency": self.concurrency,
+                "paused_for": max(0.0, self._paused_until - time.monotonic()),
+                "remaining_requests": self.last_headers.get("x-ratelimit-remaining-requests"),
+                "remaining_tokens": self.last_headers.get("x-ratelimit-remaining-tokens"),
+                **self.counters,
+            }
+
+    # --- internals --------------------------------------------------------------
+
+    def _estimate_cost(self, kwargs: Dict[str, Any]) -> int:
+        # Providers count prompt tokens plus max_tokens against the TPM budget at request time
+        prompt = sum(estimate_tokens(m.get("content") or "") for m in kwargs.get("messages", []))
+        return prompt + int(kwargs.get("max_tokens") or 0)
+
+    def _acquire(self, cost: int) -> None:
+        with self._cond:
+            self.queued += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = max(
+                        self._paused_until - now,
+                        self.requests.wait_time(1, now),
+                        self.tokens.wait_time(cost, now),
+                    )
+                    if self.in_flight < self.concurrency and wait <= 0:
+                        break
+                    self._cond.wait(timeout=wait if wait > 0 else None)
+                self.requests.take(1)
+                self.tokens.take(cost)
+                self.in_flight += 1
+                self.counters["requests"] += 1
+            finally:
+                self.queued -= 1
+
+    def _release(self, success: bool, rate_limited: bool = False) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                # Multiplicative decrease on 429, additive increase after a run of successes
+                self.counters["rate_limited"] += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+                self._successes = 0
+            elif success:
+                self._successes += 1
+                if self._successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    def _observe_headers(self, headers) -> None:
+        remaining_requests = _to_float(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = _to_float(headers.get("x-ratelimit-remaining-tokens"))
+        with self._cond:
+            self.last_headers = {k: headers.get(k) for k in (
+                "x-ratelimit-limit-requests", "x-ratelimit-limit-tokens",
+                "x-ratelimit-remaining-requests", "x-ratelimit-remaining-tokens",
+                "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens",
+            ) if headers.get(k) is not None}
+            if remaining_requests is not None:
+                self.requests.clamp(remaining_requests)
+            if remaining_tokens is not None:
+                self.tokens.clamp(remaining_tokens)
+            # Window exhausted: hold new requests until the server says it resets
+            pause = 0.0
+            if remaining_requests is not None and remaining_requests < 1:
+                pause = max(pause, parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0.0)
+            if remaining_tokens is not None and remaining_tokens < 1:
+                pause = max(pause, parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0.0)
+            if pause:
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = parse_reset_duration(response.headers.get("retry-after"))
+        # Full jitter keeps many workers from retrying in lock-step
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        return max(delay, retry_after or 0.0)
+
+class _ScheduledStream:
+    # Iterator over a streamed completion that gives its in-flight slot back exactly once:
+    # when exhausted, on error, or when closed / garbage-collected early. Usage arrives in
+    # the last chunk (stream_options.include_usage) and is recorded on close.
+    def __init__(self, stream, release, tel, model: str, started: float):
+        self._it = iter(stream)
+        self._release = release
+        self._telemetry = tel
+        self._model = model
+        self._started = started
+        self._first_chunk: Optional[float] = None
+        self._usage = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._it)
+        except StopIteration:
+            self.close(success=True)
+            raise
+        except Exception:
+            self.close()
+            raise
+        if self._first_chunk is None:
+            self._first_chunk = time.perf_counter()
+        if getattr(chunk, "usage", None) is not None:
+            self._usage = chunk.usage
+        return chunk
+
+    def close(self, success: bool = False) -> None:
+        release, self._release = self._release, None
+        if release is None:
+            return
+        release(success=success)
+        ttft = None if self._first_chunk is None else round(self._first_chunk - self._started, 6)
+        self._telemetry.record_completion(self._model, self._usage, time.perf_counter() - self._started,
+                                          stream=True, time_to_first_chunk=ttft, completed=success)
+
+    def __del__(self):
+        self.close()
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+_schedulers: Dict[Tuple[Any, ...], RequestScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+    max_concurrency: Optional[int] = None,
+) -> RequestScheduler:
+    # One scheduler (and HTTP connection pool) per process and API key / endpoint.
+    # A new one takes its budgets from OPENAI_RPM / OPENAI_TPM (unset means "adapt from
+    # headers only"); an existing one is only changed by explicit arguments, so a caller
+    # passing just the key (e.g. a background job) keeps the budgets set in the app.
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    base_url = base_url or os.getenv("OPENAI_BASE_URL")
+    key = (api_key, base_url)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            # An explicit 0 removes a budget
+            rpm = requests_per_minute if requests_per_minute is not None else _to_float(os.getenv("OPENAI_RPM"))
+            tpm = tokens_per_minute if tokens_per_minute is not None else _to_float(os.getenv("OPENAI_TPM"))
+            scheduler = RequestScheduler(api_key=api_key, base_url=base_url, requests_per_minute=rpm,
+                                         tokens_per_minute=tpm, max_concurrency=max_concurrency or 8)
+            _schedulers[key] = scheduler
+        else:
+            scheduler.configure(requests_per_minute, tokens_per_minute, max_concurrency)
+        return scheduler
@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from evidence_store import _lookup, _to_int
+from models import leaf_specs
+
+# Local search over processed articles: SQLite FTS5 over the article text plus every
+# leaf answer of its extraction, and a plain table of the answers for structured filters.
+#
+#   python search_index.py ingest ./run                       # a batch.py output folder
+#   python search_index.py query "coenzyme q10" --field brain_mri="white matter" --where itt_analysis=yes
+#
+# - docs_fts ranks articles by BM25 over the article text and all answers together.
+# - field_fts holds one row per (article, leaf), so "brain_mri mentioning white matter"
+#   is a full-text match restricted to one field; rowid = doc id * LEAF_STRIDE + leaf.
+# - fields holds every answer normalized (lower-case, punctuation -> space) and, for
+#   numeric leaves, as an integer: "itt_analysis = yes" matches "Yes, ITT was used.".
+# Re-adding an article replaces its rows, so results can be indexed as they land.
+
+DEFAULT_SEARCH_PATH = os.getenv("SEARCH_INDEX_PATH", os.path.join(".cache", "search.sqlite"))
+LEAF_STRIDE = 1024
+TOKENIZER = "porter unicode61 remove_diacritics 2"
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)')
+_FILTER = re.compile(r"^\s*([A-Za-z0-9_.]+)\s*(>=|<=|!=|=|>|<)\s*(.*?)\s*$")
+_NUMERIC_OPS = {"=": "=", "!=": "!=", ">": ">", "<": "<", ">=": ">=", "<=": "<="}
+
+def normalize_answer(value: Any) -> str:
+    return _NON_ALNUM.sub(" ", str(value).lower()).strip()
+
+def fts_query(text: str) -> str:
+    # Free text -> FTS5 query: every word (or "quoted phrase") must occur; OR / NOT and
+    # a trailing * (prefix) are kept, anything else is quoted so punctuation can't
+    # produce a syntax error
+    parts = []
+    for phrase, word in _QUERY_TERM.findall(text):
+        if word in ("OR", "NOT", "AND"):
+            # "a OR OR b", "a NOT AND b": only the first of adjacent operators is kept
+            if not parts or parts[-1] not in ("OR", "NOT", "AND"):
+                parts.append(word)
+            continue
+        term = phrase or word
+        prefix = term.endswith("*") and not phrase
+        term = term.rstrip("*") if prefix else term
+        if term.strip():
+            parts.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    while parts and parts[-1] in ("OR", "NOT", "AND"):
+        parts.pop()
+    while parts and parts[0] in ("OR", "NOT", "AND"):
+        # A leading NOT has nothing to subtract from: drop it with its operand
+        parts = parts[2:] if parts[0] == "NOT" else parts[1:]
+    return " ".join(parts)
+
+def parse_filter(expr: str) -> Tuple[str, str, str]:
+    # "itt_analysis=yes" / "number_of_patients>=10" -> (field, op, value)
+    m = _FILTER.match(expr)
+    if not m:
+        raise ValueError(f"Cannot parse filter {expr!r}; use field=value, field>=number, ...")
+    return m.group(1), m.group(2), m.group(3).strip("\"'")
+
+class SearchIndex:
+    def __init__(self, path: str = DEFAULT_SEARCH_PATH):
+        self.path = path
+        self._leaves = list(leaf_specs().items())
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                article_id TEXT UNIQUE NOT NULL,
+                source TEXT,
+                model TEXT,
+                indexed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_docs_time ON docs(indexed_at)")
+        self._conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(body, answers, tokenize='{TOKENIZER}')")
+        self._conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS field_fts USING fts5(value, path UNINDEXED, tokenize='{TOKENIZER}')")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS fields (
+                doc_id INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                value TEXT,
+                norm TEXT,
+                num INTEGER
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fields_norm ON fields(path, norm)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fields_num ON fields(path, num)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fields_doc ON fields(doc_id)")
+
+    # --- writing ----------------------------------------------------------------
+
+    def add(self, article_id: str, data: Dict[str, Any], text: Optional[str] = None,
+            source: Optional[str] = None, model: Optional[str] = None) -> None:
+        # Indexes (or re-indexes) one article; without text only its answers are searchable
+        answers = []
+        for i, (path, _) in enumerate(self._leaves):
+            value = _lookup(data, path)
+            if value is None:
+                continue
+            value = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            answers.append((i, path, value))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                doc_id = self._delete(article_id, keep_doc=True)
+                if doc_id is None:
+                    doc_id = self._conn.execute(
+                        "INSERT INTO docs (article_id, source, model, indexed_at) VALUES (?, ?, ?, ?)",
+                        (article_id, source, model, time.time())).lastrowid
+                else:
+                    self._conn.execute("UPDATE docs SET source = ?, model = ?, indexed_at = ? WHERE id = ?",
+                                       (source, model, time.time(), doc_id))
+                self._conn.execute("INSERT INTO docs_fts (rowid, body, answers) VALUES (?, ?, ?)",
+                                   (doc_id, text or "", "\n".join(v for _, _, v in answers)))
+                self._conn.executemany("INSERT INTO field_fts (rowid, value, path) VALUES (?, ?, ?)",
+                                       [(doc_id * LEAF_STRIDE + i, v, p) for i, p, v in answers])
+                self._conn.executemany("INSERT INTO fields (doc_id, path, value, norm, num) VALUES (?, ?, ?, ?, ?)",
+                                       [(doc_id, p, v, normalize_answer(v), _to_int(v)) for _, p, v in answers])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _delete(self, article_id: str, keep_doc: bool) -> Optional[int]:
+        row = self._conn.execute("SELECT id FROM docs WHERE article_id = ?", (article_id,)).fetchone()
+        if row is None:
+            return None
+        doc_id = row[0]
+        self._conn.execute("DELETE FROM docs_fts WHERE rowid = ?", (doc_id,))
+        self._conn.execute("DELETE FROM field_fts WHERE rowid >= ? AND rowid < ?",
+                           (doc_id * LEAF_STRIDE, (doc_id + 1) * LEAF_STRIDE))
+        self._conn.execute("DELETE FROM fields WHERE doc_id = ?", (doc_id,))
+        if not keep_doc:
+            self._conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+        return doc_id
+
+    def ingest_run(self, out_dir: str) -> int:
+        # Finished articles of a batch.py output folder (results/ + texts/ via its manifest)
+        from batch import RunManifest
+
+        out = Path(out_dir)
+        manifest = RunManifest(out)
+        model = manifest.data.get("options", {}).get("model")
+        count = 0
+        for aid, entry in manifest.articles.items():
+            if entry.get("status") != "done" or not (out / entry.get("output", "")).is_file():
+                continue
+            data = json.loads((out / entry["output"]).read_text(encoding="utf-8"))
+            text_path = out / entry["text"] if entry.get("text") else None
+            text = text_path.read_text(encoding="utf-8") if text_path is not None and text_path.exists() else None
+            # An article whose cascade filled fields records the cascade model
+            self.add(aid, data, text=text, source=entry.get("source"), model=entry.get("model", model))
+            count += 1
+        return count
+
+    # --- searching --------------------------------------------------------------
+
+    def resolve_field(self, name: str) -> str:
+        # Full dotted path, or a leaf name that is unique ("brain_mri")
+        paths = [p for p, _ in self._leaves]
+        if name in paths:
+            return name
+        matches = [p for p in paths if p.endswith("." + name)]
+        if len(matches) != 1:
+            raise ValueError(f"Unknown field {name!r}" if not matches else f"Ambiguous field {name!r}: {matches}")
+        return matches[0]
+
+    def search(
+        self,
+        text: str = "",
+        fields: Optional[Dict[str, str]] = None,
+        where: Optional[Iterable[Tuple[str, str, str]]] = None,
+        limit: int = 20,
+    ) -> List[Dict[str, Any]]:
+        # Ranked articles: `text` over article text and answers, `fields` {field: text}
+        # full-text within single fields, `where` [(field, op, value)] structured filters
+        # (text: equal, or starting with the value as whole words; numbers: compared)
+        fields = {self.resolve_field(k): fts_query(v) for k, v in (fields or {}).items() if fts_query(v)}
+        where = [(self.resolve_field(f), op, v) for f, op, v in (where or [])]
+        conditions: List[str] = []
+        params: List[Any] = []
+        for path, query in fields.items():
+            conditions.append(f"d.id IN (SELECT rowid / {LEAF_STRIDE} FROM field_fts WHERE field_fts MATCH ? AND path = ?)")
+            params += [f"value : ({query})", path]
+        for path, op, value in where:
+            sql, args = self._filter_sql(path, op, value)
+            conditions.append(sql)
+            params += args
+        query = fts_query(text)
+        if query:
+            # Answers weigh twice the article text. Snippets are made afterwards, for the
+            # returned rows only (in the ranking query they'd be built for every match)
+            sql = ("SELECT d.id, d.article_id, d.source, bm25(docs_fts, 1.0, 2.0) AS score "
+                   "FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid WHERE docs_fts MATCH ?")
+            params = [query] + params
+        elif fields:
+            # Ranked by the first field query (bm25() can't sit inside an aggregate itself)
+            path, field_query = next(iter(fields.items()))
+            sql = (f"WITH hits AS MATERIALIZED (SELECT rowid / {LEAF_STRIDE} AS doc_id, bm25(field_fts) AS s "
+                   f"FROM field_fts WHERE field_fts MATCH ? AND path = ?) "
+                   f"SELECT d.id, d.article_id, d.source, r.score FROM docs d JOIN "
+                   f"(SELECT doc_id, MIN(s) AS score FROM hits GROUP BY doc_id) r ON r.doc_id = d.id WHERE 1")
+            params = [f"value : ({field_query})", path] + params
+        else:
+            sql = "SELECT d.id, d.article_id, d.source, 0.0 AS score FROM docs d WHERE 1"
+        sql += "".join(f" AND {c}" for c in conditions)
+        sql += " ORDER BY score, d.indexed_at DESC LIMIT ?" if (query or fields) else " ORDER BY d.indexed_at DESC LIMIT ?"
+        params.append(limit)
+        shown = list(dict.fromkeys([*fields, *(p for p, _, _ in where)]))
+        with self._lock:
+            try:
+                rows = self._conn.execute(sql, params).fetchall()
+                snippets: Dict[int, str] = {}
+                if query and rows:
+                    snippets = dict(self._conn.execute(
+                        f"SELECT rowid, snippet(docs_fts, -1, '[', ']', ' … ', 16) FROM docs_fts "
+                        f"WHERE docs_fts MATCH ? AND rowid IN ({','.join('?' * len(rows))})",
+                        [query, *(r[0] for r in rows)]).fetchall())
+            except sqlite3.OperationalError as e:
+                # A query FTS5 can't parse is the caller's input error, like a bad filter
+                raise ValueError(f"Cannot run search {text!r}: {e}") from e
+            results = []
+            for doc_id, article_id, source, score in rows:
+                answers = {}
+                if shown:
+                    answers = dict(self._conn.execute(
+                        f"SELECT path, value FROM fields WHERE doc_id = ? AND path IN ({','.join('?' * len(shown))})",
+                        [doc_id, *shown]).fetchall())
+                results.append({"article_id": article_id, "source": source, "score": round(-score, 3) or 0.0,
+                                "snippet": snippets.get(doc_id), "fields": {p: answers.get(p) for p in shown}})
+        return results
+
+    def _filter_sql(self, path: str, op: str, value: str) -> Tuple[str, List[Any]]:
+        number = _to_int(value)
+        if number is not None and op in _NUMERIC_OPS:
+            return f"d.id IN (SELECT doc_id FROM fields WHERE path = ? AND num {_NUMERIC_OPS[op]} ?)", [path, number]
+        if op not in ("=", "!="):
+            raise ValueError(f"{op} needs a number: {path} {op} {value!r}")
+        norm = normalize_answer(value)
+        # Equal, or the value followed by more words: an index range, not a LIKE scan
+        sql = "d.id IN (SELECT doc_id FROM fields WHERE path = ? AND (norm = ? OR (norm >= ? AND norm < ?)))"
+        args = [path, norm, norm + " ", norm + "!"]
+        return (sql if op == "=" else sql.replace("d.id IN", "d.id NOT IN", 1)), args
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"articles": len(self),
+                "size_mb": round(os.path.getsize(self.path) / 2**20, 1) if os.path.exists(self.path) else 0.0}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Full-text and field search over processed articles.")
+    parser.add_argument("--index", default=DEFAULT_SEARCH_PATH, help="Search index (SQLite file)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_ingest = sub.add_parser("ingest", help="Index the finished articles of batch.py output folders")
+    p_ingest.add_argument("runs", nargs="+")
+    p_query = sub.add_parser("query", help="Ranked search")
+    p_query.add_argument("text", nargs="?", default="", help="Words / \"phrases\" in the article text or answers")
+    p_query.add_argument("--field", action="append", default=[], metavar="FIELD=TEXT",
+                         help="Full-text match within one field, e.g. brain_mri=\"white matter\"")
+    p_query.add_argument("--where", action="append", default=[], metavar="FIELD=VALUE",
+                         help="Structured filter, e.g. itt_analysis=yes or number_of_patients>=10")
+    p_query.add_argument("-n", "--limit", type=int, default=20)
+    sub.add_parser("stats", help="Index size")
+    args = parser.parse_args(argv)
+
+    index = SearchIndex(args.index)
+    if args.command == "ingest":
+        for run in args.runs:
+            print(f"{run}: {index.ingest_run(run)} articles indexed")
+    elif args.command == "query":
+        fields = dict(f.split("=", 1) for f in args.field)
+        t0 = time.perf_counter()
+        try:
+            results = index.search(args.text, fields, [parse_filter(w) for w in args.where], args.limit)
+        except ValueError as e:
+            parser.error(str(e))
+        elapsed_ms = 1000 * (time.perf_counter() - t0)
+        for r in results:
+            extra = "  ".join(f"{p.split('.')[-1]}: {v}" for p, v in r["fields"].items())
+            print(f"{r['score']:>8}  {r['article_id']}  {extra}")
+            if r["snippet"]:
+                print(f"          {r['snippet']}")
+        print(f"{len(results)} results [{elapsed_ms:.1f} ms]")
+    elif args.command == "stats":
+        print(json.dumps(index.stats()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
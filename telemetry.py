@@ -0,0 +1,313 @@
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+# Per-call telemetry: stage timings (PDF parsing, chunking/context packing, model wait,
+# JSON parsing, rendering), token usage and cost.
+# - Every Telemetry keeps counters and latency histograms and can forward to a parent,
+#   so an article- or session-level collector also feeds the process-wide totals.
+# - Events are appended to a JSONL log when TELEMETRY_LOG names one (off by default),
+#   through one open handle; past TELEMETRY_LOG_MAX_MB it is rotated to <log>.1.
+# - prometheus_text() renders the process totals in the Prometheus text format.
+# The collector in use is held in a context variable: the Streamlit app installs one per
+# session, batch.py one per article.
+
+DEFAULT_EVENT_LOG = os.getenv("TELEMETRY_LOG", "")
+EVENT_LOG_MAX_BYTES = int(float(os.getenv("TELEMETRY_LOG_MAX_MB", "50")) * 2**20)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# USD per 1M tokens: (input, cached input, output). Matched by longest model-name prefix,
+# so dated snapshots ("gpt-4.1-mini-2025-04-14") use their family's price.
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "o4-mini": (1.10, 0.275, 4.40),
+    "o3": (2.00, 0.50, 8.00),
+}
+
+def model_price(model: str) -> Optional[Tuple[float, float, float]]:
+    best = None
+    for prefix in MODEL_PRICES:
+        if model.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return MODEL_PRICES[best] if best else None
+
+def usage_numbers(usage: Any) -> Dict[str, int]:
+    # Accepts the SDK usage object or its dict form (batch result files)
+    if usage is None:
+        return {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else dict(vars(usage))
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+        "completion_tokens": int(usage.get("completion_tokens") or 0),
+        "cached_tokens": int(details.get("cached_tokens") or 0),
+    }
+
+def _ratio(part: float, whole: float) -> float:
+    return round(part / whole, 4) if whole else 0.0
+
+def completion_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0,
+                    discount: float = 1.0) -> float:
+    price = model_price(model)
+    if price is None:
+        return 0.0
+    inp, cached, out = price
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return discount * (uncached * inp + cached_tokens * cached + completion_tokens * out) / 1_000_000
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+class Telemetry:
+    def __init__(self, parent: Optional["Telemetry"] = None, event_log: Optional[str] = None, **labels: Any):
+        self.parent = parent
+        self.event_log = event_log
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._log_fh: Optional[TextIO] = None
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    # --- recording --------------------------------------------------------------
+
+    @contextmanager
+    def stage(self, name: str, **fields: Any) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(name, time.perf_counter() - t0, **fields)
+
+    def observe_stage(self, name: str, seconds: float, **fields: Any) -> None:
+        self._observe(name, seconds)
+        self.event("stage", stage=name, seconds=round(seconds, 6), **fields)
+
+    def record_completion(
+        self,
+        model: str,
+        usage: Any,
+        seconds: Optional[float],
+        discount: float = 1.0,
+        **fields: Any,
+    ) -> Dict[str, Any]:
+        # seconds=None for calls without a meaningful latency (Batch API results)
+        numbers = usage_numbers(usage)
+        cost = completion_cost(model, discount=discount, **numbers)
+        if seconds is not None:
+            self._observe("model_wait", seconds)
+        self._count_completion(model, numbers, cost)
+        record = {"model": model, "seconds": None if seconds is None else round(seconds, 6),
+                  "cost_usd": round(cost, 6), **numbers, **fields}
+        self.event("completion", **record)
+        return record
+
+    def incr(self, name: str, value: float = 1.0, **labels: str) -> None:
+        self._add(name, value, labels)
+
+    def event(self, kind: str, **fields: Any) -> None:
+        node: Optional[Telemetry] = self
+        labels: Dict[str, Any] = {}
+        while node is not None:
+            labels = {**node.labels, **labels}
+            if node.event_log:
+                node._append({"ts": time.time(), "event": kind, **labels, **fields})
+                return
+            node = node.parent
+
+    # --- reading ----------------------------------------------------------------
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                name: {"count": h.count, "total_s": round(h.sum, 4), "mean_s": round(h.sum / h.count, 4) if h.count else 0.0,
+                       "p95_le_s": h.quantile(0.95)}
+                for name, h in self.stages.items()
+            }
+            totals: Dict[str, float] = {}
+            models: Dict[str, Dict[str, float]] = {}
+            for (name, labels), value in self.counters.items():
+                totals[name] = totals.get(name, 0.0) + value
+                model = dict(labels).get("model")
+                if model is not None and name.endswith("_total"):
+                    per_model = models.setdefault(model, {})
+                    per_model[name[:-len("_total")]] = per_model.get(name[:-len("_total")], 0.0) + value
+        return {
+            "stages": stages,
+            "requests": int(totals.get("completions_total", 0)),
+            "prompt_tokens": int(totals.get("prompt_tokens_total", 0)),
+            "completion_tokens": int(totals.get("completion_tokens_total", 0)),
+            "cached_tokens": int(totals.get("cached_tokens_total", 0)),
+            # Share of input tokens served from the provider's prompt cache
+            "prompt_cache_hit_rate": _ratio(totals.get("cached_tokens_total", 0), totals.get("prompt_tokens_total", 0)),
+            "cost_usd": round(totals.get("cost_usd_total", 0.0), 6),
+            "cache_hits": int(totals.get("cache_hits_total", 0)),
+            "text_raw_tokens": int(totals.get("text_raw_tokens_total", 0)),
+            "text_saved_tokens": int(totals.get("text_saved_tokens_total", 0)),
+            # Per-model split (e.g. the tiers of a model cascade)
+            "models": {
+                model: {"requests": int(v.get("completions", 0)), "prompt_tokens": int(v.get("prompt_tokens", 0)),
+                        "cached_tokens": int(v.get("cached_tokens", 0)), "completion_tokens": int(v.get("completion_tokens", 0)), "cost_usd": round(v.get("cost_usd", 0.0), 6)}
+                for model, v in models.items()
+            },
+        }
+
+    def prometheus_text(self, prefix: str = "sra") -> str:
+        lines = []
+        with self._lock:
+            lines += [f"# HELP {prefix}_stage_seconds Time spent per pipeline stage",
+                      f"# TYPE {prefix}_stage_seconds histogram"]
+            for name, h in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, c in zip(list(h.buckets) + [float("inf")], h.counts):
+                    cumulative += c
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {h.sum:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}_{name} counter")
+                    typed.add(name)
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value:g}" if label_text else f"{prefix}_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    # --- internals --------------------------------------------------------------
+
+    def _observe(self, name: str, seconds: float) -> None:
+        node: Optional[Telemetry] = self
+        while node is not None:
+            with node._lock:
+                node.stages.setdefault(name, Histogram()).observe(seconds)
+            node = node.parent
+
+    def _add(self, name: str, value: float, labels: Dict[str, str]) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        node: Optional[Telemetry] = self
+        while node is not None:
+            with node._lock:
+                node.counters[key] = node.counters.get(key, 0.0) + value
+            node = node.parent
+
+    def _count_completion(self, model: str, numbers: Dict[str, int], cost: float) -> None:
+        self._add("completions_total", 1, {"model": model})
+        self._add("prompt_tokens_total", numbers["prompt_tokens"], {"model": model})
+        self._add("completion_tokens_total", numbers["completion_tokens"], {"model": model})
+        self._add("cached_tokens_total", numbers["cached_tokens"], {"model": model})
+        self._add("cost_usd_total", cost, {"model": model})
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._log_fh is None:
+                if os.path.dirname(self.event_log):
+                    os.makedirs(os.path.dirname(self.event_log), exist_ok=True)
+                # Line-buffered: every event reaches the file as soon as it is written
+                self._log_fh = open(self.event_log, "a", encoding="utf-8", buffering=1)
+            self._log_fh.write(line)
+            if self._log_fh.tell() >= EVENT_LOG_MAX_BYTES:
+                # One previous file is kept; the next event opens a fresh log
+                self._log_fh.close()
+                self._log_fh = None
+                os.replace(self.event_log, self.event_log + ".1")
+
+# Process-wide collector (Prometheus totals + event log)
+PROCESS = Telemetry(event_log=DEFAULT_EVENT_LOG or None)
+
+_current: contextvars.ContextVar[Telemetry] = contextvars.ContextVar("telemetry", default=PROCESS)
+
+def current() -> Telemetry:
+    return _current.get()
+
+def set_current(telemetry: Telemetry) -> None:
+    _current.set(telemetry)
+
+@contextmanager
+def use_telemetry(telemetry: Telemetry) -> Iterator[Telemetry]:
+    token = _current.set(telemetry)
+    try:
+        yield telemetry
+    finally:
+        _current.reset(token)
+
+def timed(stage_name: str) -> Callable:
+    # Decorator: time every call of the function as `stage_name` in the current collector
+    def decorate(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with current().stage(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def timed_iter(stage_name: str, items: Iterable[Any]) -> Iterator[Any]:
+    # Generator counterpart of timed: only the time spent producing items counts (not the
+    # consumer's work in between), recorded once the iterator is exhausted or closed
+    telemetry = current()
+    it = iter(items)
+    spent = 0.0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                spent += time.perf_counter() - t0
+            yield item
+    finally:
+        telemetry.observe_stage(stage_name, spent)
+
+def start_metrics_server(port: int, host: str = "127.0.0.1", telemetry: Telemetry = PROCESS) -> ThreadingHTTPServer:
+    # GET /metrics -> Prometheus text of the process totals (for long batch runs)
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            body = telemetry.prometheus_text().encode("utf-8")
+            self.send_response(200 if self.path.rstrip("/") in ("", "/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
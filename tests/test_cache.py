@@ -0,0 +1,77 @@
+import itertools
+
+import pytest
+
+import cache as cache_module
+from cache import ExtractionCache, make_cache_key
+from extraction import build_messages, extraction_cache_key
+from models import compiled_schema, subschema
+
+TEXT = "Abstract\nA randomized trial of drug X in 40 patients."
+SCHEMA = compiled_schema()["schema"]
+
+def key(text=TEXT, model="gpt-4.1-mini", temperature=0.2, max_tokens=5000, schema=SCHEMA, **prompt):
+    return extraction_cache_key(build_messages(text, **prompt), model, temperature, max_tokens, schema)
+
+@pytest.fixture
+def clock(monkeypatch):
+    # One second per call, so access order is unambiguous
+    ticks = itertools.count(1_000_000)
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(ticks)))
+
+def test_whitespace_does_not_change_the_key():
+    assert key("Abstract\n A randomized  trial of drug X\tin 40 patients. ") == key()
+    assert make_cache_key(" a\n b ", model="m") == make_cache_key("a b", model="m")
+
+@pytest.mark.parametrize("changed", [
+    dict(text=TEXT + " Updated."),
+    dict(model="gpt-4.1"),
+    dict(temperature=0.0),
+    dict(max_tokens=8000),
+    dict(schema=subschema(["study_information"])),
+    dict(force_english=False),
+    dict(allow_unknown=False),
+])
+def test_key_changes_with_every_input(changed):
+    assert key(**changed) != key()
+
+def test_key_changes_with_the_schema_version():
+    edited = {**SCHEMA, "properties": {**SCHEMA["properties"], "new_field": {"type": "string"}}}
+    assert key(schema=edited) != key()
+    assert key(schema=dict(SCHEMA)) == key()
+
+def test_round_trip_counts_hits_and_misses(tmp_path):
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get(key()) is None
+    cache.put(key(), {"a": "é"}, model="gpt-4.1-mini")
+    assert cache.get(key()) == {"a": "é"}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+    for name in "abc":
+        cache.put(name, {"v": name})
+    cache.get("a")
+    cache.put("d", {"v": "d"})
+    assert cache.get("b") is None
+    assert [cache.get(name) is not None for name in "acd"] == [True, True, True]
+    assert cache.stats()["entries"] == 3
+
+def test_size_limit_evicts_until_under(tmp_path, clock):
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"), max_entries=None, max_bytes=250)
+    for name in "abc":
+        cache.put(name, {"v": name * 90})
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] <= 250 and cache.stats()["entries"] == 2
+
+def test_old_entries_expire(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    cache = ExtractionCache(str(tmp_path / "cache.sqlite"), max_age_days=1)
+    cache.put("a", {"v": 1})
+    now[0] += 86400 / 2
+    assert cache.get("a") == {"v": 1}
+    now[0] += 86400
+    assert cache.get("a") is None
+    cache.put("b", {"v": 2})
+    assert cache.stats()["entries"] == 1
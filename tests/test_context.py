@@ -0,0 +1,51 @@
+import pytest
+
+from context import OMISSION_MARK, pack_context, section_query
+from models import section_names
+from utils import estimate_tokens
+
+def paragraphs(topic, n):
+    return [f"{topic} paragraph {i}: " + " ".join(f"{topic}{j}" for j in range(60)) + "." for i in range(n)]
+
+ARTICLE = "\n\n".join([
+    "Coenzyme Q10 in ataxia: a randomized controlled trial",
+    "Abstract",
+    "We enrolled 40 patients in a randomized controlled trial of coenzyme Q10 at 30 mg/kg daily for 12 months.",
+    "Methods",
+    *paragraphs("filler", 20),
+    "Results",
+    "MRI showed fewer white matter lesions; ataxia scores improved from baseline (p = 0.01).",
+    *paragraphs("padding", 20),
+    "References",
+    *paragraphs("citation", 10),
+])
+
+def test_section_query_uses_the_schema_fields():
+    for section in section_names():
+        assert section_query(section)
+    assert "ataxia" in section_query("clinical_features")
+
+def test_short_article_is_sent_whole():
+    text, stats = pack_context("Abstract\n\nA short report.", token_budget=1000)
+    assert text == "Abstract\n\nA short report."
+    assert stats["passages_kept"] == stats["passages_total"]
+
+@pytest.mark.parametrize("budget", [200, 600, 1500, 3000])
+def test_token_budget_is_respected(budget):
+    text, stats = pack_context(ARTICLE, budget)
+    assert estimate_tokens(ARTICLE) > budget
+    assert 0 < stats["kept_tokens"] <= budget
+    # The packed text is the kept passages plus omission marks and separators
+    marks = text.count(OMISSION_MARK)
+    assert estimate_tokens(text) <= budget + marks * (estimate_tokens(OMISSION_MARK) + 1) + stats["passages_kept"]
+    assert "citation" not in text
+
+def test_budget_is_respected_per_section():
+    text, stats = pack_context(ARTICLE, 300, sections=["diagnostic_and_imaging_tests"])
+    assert stats["kept_tokens"] <= 300
+    assert "white matter lesions" in text
+
+def test_budget_smaller_than_any_passage_keeps_a_truncated_one():
+    text, stats = pack_context(ARTICLE, 10)
+    assert stats["passages_kept"] == 1 and stats["kept_tokens"] <= 10
+    assert text.strip(OMISSION_MARK + "\n")
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from dedup import DedupIndex
+from extraction import answering_model, reusable_models
+
+def article(seed, words=600):
+    rng = random.Random(seed)
+    vocabulary = [f"w{i}" for i in range(3000)]
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+def published_version(text):
+    # The published version of a preprint: a new title line, a few edited words, a footer
+    words = text.split()
+    for i in (50, 250, 450):
+        words[i] = "edited"
+    return "Journal of Trials 2020 " + " ".join(words) + " Received 2019 accepted 2020"
+
+ORIGINAL = article(1)
+PUBLISHED = published_version(ORIGINAL)
+
+@pytest.fixture
+def index(tmp_path):
+    return DedupIndex(str(tmp_path / "dedup.sqlite"))
+
+def test_near_duplicate_is_found(index):
+    assert index.check_and_add("preprint", ORIGINAL, source="preprint.pdf") is None
+    match = index.check_and_add("published", PUBLISHED, source="published.pdf")
+    assert match["doc_id"] == "preprint" and match["source"] == "preprint.pdf"
+    assert match["similarity"] >= index.threshold
+    assert index.stats()["flagged"] == 1
+
+def test_distinct_text_is_not_found(index):
+    index.add("preprint", ORIGINAL)
+    assert index.query(article(2)) == []
+    assert index.check_and_add("other", article(3)) is None
+    assert len(index) == 2 and index.stats()["flagged"] == 0
+
+def test_document_does_not_match_itself(index):
+    index.add("preprint", ORIGINAL)
+    assert index.check_and_add("preprint", ORIGINAL) is None
+    assert [m["doc_id"] for m in index.query(ORIGINAL)] == ["preprint"]
+
+def test_result_is_reused_only_with_the_same_model_and_schema(index):
+    index.add("preprint", ORIGINAL)
+    data = {"study_information": {"design": "RCT"}}
+    index.attach_result("preprint", data, model="gpt-4.1-mini", schema_version="v1")
+    match = index.query(PUBLISHED)[0]
+    assert match["has_result"] and match["model"] == "gpt-4.1-mini" and match["schema_version"] == "v1"
+
+    assert index.result("preprint", schema_version="v1", model="gpt-4.1-mini") == data
+    assert index.result("preprint", schema_version="v2", model="gpt-4.1-mini") is None
+    assert index.result("preprint", schema_version="v1", model="gpt-4.1") is None
+    assert index.stored_result("preprint") == {"data": data, "model": "gpt-4.1-mini", "schema_version": "v1"}
+
+def test_result_without_schema_version_is_not_reused(index):
+    # Indexes from before results carried their schema version
+    index.add("preprint", ORIGINAL)
+    index.attach_result("preprint", {"a": 1}, model="gpt-4.1-mini")
+    assert index.result("preprint", schema_version="v1", model="gpt-4.1-mini") is None
+
+def test_changed_text_drops_the_stored_result(index):
+    index.add("preprint", ORIGINAL)
+    index.attach_result("preprint", {"a": 1}, model="gpt-4.1-mini", schema_version="v1")
+    index.add("preprint", ORIGINAL)
+    assert index.result("preprint") == {"a": 1}
+    index.add("preprint", article(4))
+    assert index.result("preprint") is None
+
+def test_cascade_request_reuses_a_result_its_cascade_completed(index):
+    index.add("preprint", ORIGINAL)
+    index.attach_result("preprint", {"a": 1}, model="gpt-4.1", schema_version="v1")
+    options = {"model": "gpt-4.1-mini", "cascade_model": "gpt-4.1"}
+    assert reusable_models(options) == ("gpt-4.1-mini", "gpt-4.1")
+    assert index.result("preprint", schema_version="v1", model=reusable_models(options)) == {"a": 1}
+    assert index.result("preprint", schema_version="v1", model=reusable_models({"model": "gpt-4.1-mini"})) is None
+    # Recorded with the strongest model that answered a field
+    assert answering_model("gpt-4.1-mini", "gpt-4.1", ["study_information.design"]) == "gpt-4.1"
+    assert answering_model("gpt-4.1-mini", "gpt-4.1", []) == "gpt-4.1-mini"
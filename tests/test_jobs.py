@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+import jobs
+from jobs import COALESCE_EXTRAS, STALE_AFTER, JobQueue
+
+OPTIONS = {"model": "gpt-4.1-mini", "temperature": 0.2, "max_tokens": 5000}
+TEXT = "Abstract\nA trial of drug X in 40 patients."
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite"))
+
+def test_identical_requests_share_one_job(queue):
+    first, coalesced = queue.submit(TEXT, OPTIONS, owner="a", extras={"article_id": "x", "use_cache": True})
+    assert not coalesced
+    # The article id only labels the result, so it does not split the job
+    second, coalesced = queue.submit(TEXT, dict(OPTIONS), owner="b", extras={"article_id": "y", "use_cache": True})
+    assert coalesced and second == first
+    assert [j["id"] for j in queue.list_jobs("b")] == [first]
+
+@pytest.mark.parametrize("text, options, extras", [
+    (TEXT + " Updated.", OPTIONS, {}),
+    (TEXT, {**OPTIONS, "model": "gpt-4.1"}, {}),
+    (TEXT, {**OPTIONS, "max_tokens": 8000}, {}),
+    *[(TEXT, OPTIONS, {extra: "changed"}) for extra in COALESCE_EXTRAS],
+])
+def test_requests_that_differ_get_their_own_job(queue, text, options, extras):
+    first, _ = queue.submit(TEXT, OPTIONS, owner="a")
+    second, coalesced = queue.submit(text, options, owner="a", extras=extras)
+    assert not coalesced and second != first
+
+def test_finished_job_is_not_coalesced(queue):
+    first, _ = queue.submit(TEXT, OPTIONS, owner="a")
+    queue.finish(queue.claim()["id"], {"ok": True})
+    second, coalesced = queue.submit(TEXT, OPTIONS, owner="a")
+    assert not coalesced and second != first
+
+def test_two_claimers_never_get_the_same_job(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    submitted = {JobQueue(path).submit(f"{TEXT} {i}", OPTIONS, owner="a")[0] for i in range(40)}
+    # Two connections to the same table, as two worker processes would have
+    claimers = [JobQueue(path), JobQueue(path)]
+    claimed = [[], []]
+    start = threading.Barrier(2)
+
+    def drain(i):
+        start.wait()
+        while (job := claimers[i].claim()) is not None:
+            claimed[i].append(job["id"])
+
+    threads = [threading.Thread(target=drain, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    everything = claimed[0] + claimed[1]
+    assert sorted(everything) == sorted(submitted)
+    assert JobQueue(path).stats().get("running") == len(submitted)
+
+def test_stale_running_jobs_go_back_to_the_queue(queue, monkeypatch):
+    silent, _ = queue.submit(TEXT, OPTIONS, owner="a")
+    beating, _ = queue.submit(TEXT + " 2", OPTIONS, owner="a")
+    assert queue.claim()["id"] == silent
+    assert queue.claim()["id"] == beating
+    now = jobs.time.time()
+    monkeypatch.setattr(jobs.time, "time", lambda: now + STALE_AFTER / 2)
+    queue.touch([beating])
+    assert queue.requeue_stale() == 0
+
+    monkeypatch.setattr(jobs.time, "time", lambda: now + STALE_AFTER + 1)
+    assert queue.requeue_stale() == 1
+    assert queue.get(silent)["status"] == "queued"
+    assert queue.get(beating)["status"] == "running"
+    # Claimed again by the next worker, as a second attempt
+    job = queue.claim()
+    assert job["id"] == silent and job["attempts"] == 2
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from jsonstream import IncrementalJSONParser, TruncatedOutputError, parse_json_document
+
+DOCUMENT = {
+    "study": {"author": "Müller \"Jr.\"", "year": 2019, "path": "C:\\data\\n", "note": "line\nbreak \u00e9 \U0001f600"},
+    "arms": [{"n": 12, "dose": -0.5e-3}, {"n": 8, "dose": None}],
+    "flags": [True, False, []],
+    "empty": {},
+}
+RAW = json.dumps(DOCUMENT)
+
+def feed_all(chunks):
+    parser = IncrementalJSONParser()
+    completed = []
+    for chunk in chunks:
+        completed += parser.feed(chunk)
+    return parser, completed
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_any_chunking_gives_the_document(size):
+    parser, _ = feed_all(RAW[i:i + size] for i in range(0, len(RAW), size))
+    assert parser.close() == DOCUMENT
+
+@pytest.mark.parametrize("raw, split", [
+    ('{"a": "x\\"y"}', '{"a": "x\\'),          # backslash ends the chunk, escaped quote starts the next
+    ('{"a": "x\\\\"}', '{"a": "x\\'),          # escaped backslash split from its escape
+    (r'{"a": "\u00e9!"}', r'{"a": "\u00'),     # unicode escape split in the middle
+    (r'{"a": "\ud83d\ude00"}', r'{"a": "\ud83d'),  # surrogate pair split between its halves
+])
+def test_escape_split_across_chunks(raw, split):
+    assert raw.startswith(split)
+    parser, _ = feed_all([split, raw[len(split):]])
+    assert parser.close() == json.loads(raw)
+
+def test_literal_split_across_chunks():
+    parser, completed = feed_all(['{"n": 12', '34, "ok": tr', 'ue, "x": nu', "ll}"])
+    assert parser.close() == {"n": 1234, "ok": True, "x": None}
+    assert completed[:3] == [(("n",), 1234), (("ok",), True), (("x",), None)]
+
+def test_completed_values_reported_once_with_paths():
+    _, completed = feed_all([RAW])
+    assert (("study", "year"), 2019) in completed
+    assert (("arms", 1, "n"), 8) in completed
+    assert completed[-1] == ((), DOCUMENT)
+    assert len([p for p, _ in completed if p == ("arms",)]) == 1
+
+def test_fences_and_trailing_text_ignored():
+    assert parse_json_document('```json\n{"a": [1, 2]}\n```\nDone.') == {"a": [1, 2]}
+
+def test_truncated_output_keeps_partial_document():
+    cut = RAW[:RAW.index('"dose": -')]
+    parser, _ = feed_all([cut])
+    assert not parser.done
+    with pytest.raises(TruncatedOutputError) as exc:
+        parser.close()
+    partial = exc.value.partial
+    assert partial["study"] == DOCUMENT["study"]
+    assert partial["arms"] == [{"n": 12}]
+
+def test_truncated_inside_string_drops_the_open_value():
+    with pytest.raises(TruncatedOutputError) as exc:
+        parse_json_document('{"a": 1, "b": "unfinish')
+    assert exc.value.partial == {"a": 1}
+    assert isinstance(exc.value, ValueError)
+
+def test_no_json_at_all_is_truncated_with_nothing():
+    with pytest.raises(TruncatedOutputError) as exc:
+        parse_json_document("I cannot help with that.")
+    assert exc.value.partial is None
+
+def test_pending_key_follows_the_stream():
+    parser = IncrementalJSONParser()
+    parser.feed('{"study": {"author": "Sm')
+    assert parser.pending_key == ("study", "author")
+    parser.feed('ith"}, "arms": [')
+    assert parser.pending_key == ("arms", 0)
+
+def test_unexpected_character_raises():
+    with pytest.raises(ValueError):
+        parse_json_document('{"a": @}')
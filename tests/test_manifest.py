@@ -0,0 +1,43 @@
+import json
+
+from batch import JOURNAL_NAME, MANIFEST_NAME, RunManifest, article_id, article_root
+
+def test_updates_go_to_the_journal_until_compacted(tmp_path):
+    manifest = RunManifest(tmp_path)
+    manifest.set_run_info(options={"model": "a"})
+    manifest.update("x", status="pending", source="x.pdf")
+    manifest.update("x", status="done", output="results/x.json")
+    assert not (tmp_path / MANIFEST_NAME).exists()
+    assert len((tmp_path / JOURNAL_NAME).read_text(encoding="utf-8").splitlines()) == 3
+
+    manifest.compact()
+    assert not (tmp_path / JOURNAL_NAME).exists()
+    data = json.loads((tmp_path / MANIFEST_NAME).read_text(encoding="utf-8"))
+    assert data["options"] == {"model": "a"}
+    assert data["articles"]["x"] == {"status": "done", "source": "x.pdf", "output": "results/x.json"}
+
+def test_interrupted_run_is_replayed(tmp_path):
+    manifest = RunManifest(tmp_path)
+    manifest.update("x", status="done")
+    manifest.compact()
+    manifest = RunManifest(tmp_path)
+    manifest.update("y", status="done")
+    manifest.update("x", status="failed", error="boom")
+    # Killed mid-write: the last line is cut off
+    with open(tmp_path / JOURNAL_NAME, "a", encoding="utf-8") as fh:
+        fh.write('{"article": "z", "fie')
+
+    resumed = RunManifest(tmp_path)
+    assert resumed.articles == {"x": {"status": "failed", "error": "boom"}, "y": {"status": "done"}}
+
+def test_article_id_survives_moving_the_input_folder(tmp_path):
+    for folder in ("a", "b"):
+        (tmp_path / folder / "sub").mkdir(parents=True)
+    first = article_id(tmp_path / "a" / "sub" / "paper.pdf", article_root(str(tmp_path / "a")))
+    moved = article_id(tmp_path / "b" / "sub" / "paper.pdf", article_root(str(tmp_path / "b")))
+    assert first == moved and first.startswith("paper-")
+    assert article_id(tmp_path / "a" / "paper.pdf", tmp_path / "a") != first
+
+def test_article_root():
+    assert article_root(None, "lists/corpus.txt").as_posix() == "lists"
+    assert article_root(None, None) is None
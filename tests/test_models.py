@@ -0,0 +1,94 @@
+import copy
+
+from models import compiled_schema, leaf_specs, merge_documents, schema_diff, schema_version, subschema
+
+def text(description):
+    return {"type": "string", "description": description}
+
+SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {
+        "study_summary": text("One paragraph"),
+        "study_information": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {"study": text("Author, year"), "design": text("Design"), "country": text("Country")},
+            "required": ["study", "design", "country"],
+        },
+        "bias": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {"randomization": text("Randomization")},
+            "required": ["randomization"],
+        },
+    },
+    "required": ["study_summary", "study_information", "bias"],
+}
+
+def edited(schema=SCHEMA):
+    return copy.deepcopy(schema)
+
+def test_unchanged_schema_has_no_diff():
+    assert schema_diff(SCHEMA, edited()) == {"added": [], "changed": [], "removed": []}
+    assert schema_version(edited()) == schema_version(SCHEMA)
+
+def test_diff_reports_added_changed_and_removed_leaves():
+    new = edited()
+    info = new["properties"]["study_information"]
+    info["properties"]["blinding"] = text("Who was blinded")
+    info["properties"]["design"] = text("Design (RCT, cohort, ...)")
+    del info["properties"]["country"]
+    new["properties"]["bias"]["properties"]["randomization"]["type"] = ["string", "null"]
+    assert schema_diff(SCHEMA, new) == {
+        "added": ["study_information.blinding"],
+        "changed": ["study_information.design", "bias.randomization"],
+        "removed": ["study_information.country"],
+    }
+    assert schema_version(new) != schema_version(SCHEMA)
+
+def test_new_section_is_added_leaf_by_leaf():
+    new = edited()
+    new["properties"]["outcomes"] = {"type": "object", "properties": {"primary": text("Primary"), "secondary": text("Other")}}
+    assert schema_diff(SCHEMA, new)["added"] == ["outcomes.primary", "outcomes.secondary"]
+    assert schema_diff(new, SCHEMA)["removed"] == ["outcomes.primary", "outcomes.secondary"]
+
+def test_subschema_keeps_only_the_wanted_leaves():
+    sub = subschema(["study_information.design", "study_summary"], SCHEMA)
+    assert list(sub["properties"]) == ["study_summary", "study_information"]
+    assert sub["required"] == ["study_summary", "study_information"]
+    info = sub["properties"]["study_information"]
+    assert info["properties"] == {"design": text("Design")}
+    assert info["required"] == ["design"] and info["additionalProperties"] is False
+    assert list(leaf_specs(sub)) == ["study_summary", "study_information.design"]
+    # A whole section by name
+    assert subschema(["bias"], SCHEMA)["properties"]["bias"] == SCHEMA["properties"]["bias"]
+
+def test_subschema_of_the_compiled_schema():
+    paths = list(leaf_specs())[:3]
+    assert list(leaf_specs(subschema(paths))) == paths
+    assert list(leaf_specs(subschema(paths, compiled_schema()["schema"]))) == paths
+
+def test_merge_overrides_the_re_asked_fields_only():
+    base = {"study_summary": "S", "study_information": {"study": "Smith 2019", "design": "RCT", "country": "BR"}}
+    merged = merge_documents(base, {"study_information": {"design": "cluster RCT"}, "bias": {"randomization": "yes"}}, SCHEMA)
+    assert merged == {"study_summary": "S", "study_information": {"study": "Smith 2019", "design": "cluster RCT", "country": "BR"},
+                      "bias": {"randomization": "yes"}}
+
+def test_merge_fills_an_unknown_answer():
+    base = {"study_information": {"study": "unknown", "design": "RCT"}}
+    merged = merge_documents(base, {"study_information": {"study": "Smith 2019"}}, SCHEMA)
+    assert merged["study_information"] == {"study": "Smith 2019", "design": "RCT"}
+
+def test_merge_takes_an_unknown_answer_to_a_re_asked_field():
+    # A re-asked (changed) field gets the new answer even when it is "unknown": the old
+    # value answered a different question. The cascade drops unknowns before merging.
+    base = {"study_information": {"study": "Smith 2019", "design": "RCT"}}
+    merged = merge_documents(base, {"study_information": {"design": "unknown"}}, SCHEMA)
+    assert merged["study_information"] == {"study": "Smith 2019", "design": "unknown"}
+
+def test_merge_follows_the_schema_order_and_drops_removed_fields():
+    base = {"bias": {"randomization": "no"}, "study_information": {"country": "BR", "sponsor": "X"}, "old_section": {"a": 1}}
+    merged = merge_documents(base, {"study_summary": "S"}, SCHEMA)
+    assert list(merged) == ["study_summary", "study_information", "bias"]
+    assert merged["study_information"] == {"country": "BR"}
@@ -0,0 +1,60 @@
+from normalize import MIN_BODY_CHARS, learn_boilerplate, normalize_pages, normalize_text
+
+BODIES = [
+    "The alpha cohort was recruited in spring.",
+    "Baseline scores were similar in both arms.",
+    "Adverse events were mild and transient.",
+    "Two patients were lost to follow-up.",
+    "Plasma levels rose within four weeks.",
+    "No deaths occurred during the study.",
+]
+
+def test_lone_number_kept_without_page_numbering():
+    text, stats = normalize_text("12\nThe trial enrolled 12\npatients in total.")
+    assert text.splitlines()[0] == "12"
+    assert stats["boilerplate_lines"] == 0
+
+def test_running_header_and_page_numbers_learned():
+    pages = [f"J Rare Dis 2021;{i + 40}:1-9\n{body}\n{i + 1}" for i, body in enumerate(BODIES)]
+    text, stats = normalize_pages(pages)
+    assert text.splitlines() == BODIES
+    assert stats["boilerplate_lines"] == 2 * len(pages)
+
+def test_page_numbers_only_dropped_at_their_edge():
+    pages = [f"{body}\nPage {i + 1} of 6" for i, body in enumerate(BODIES)]
+    pages[2] = "12\n" + pages[2]
+    text, _ = normalize_pages(pages)
+    assert "12" in text.splitlines()
+    assert not any(line.startswith("Page ") for line in text.splitlines())
+
+def test_no_header_learning_from_two_pages():
+    pages = ["Header line\nFirst page text.", "Header line\nSecond page text."]
+    assert learn_boilerplate([p.splitlines() for p in pages]) == set()
+    assert normalize_pages(pages)[0].count("Header line") == 2
+
+def test_dehyphenation_joins_split_words():
+    text, stats = normalize_text("The treat-\nment was well tolerated.")
+    assert text == "The treatment was well tolerated."
+    assert stats["dehyphenated"] == 1
+
+def test_dehyphenation_keeps_hyphenated_compounds():
+    text, stats = normalize_text("Median follow-up was 2 years.\nDuring follow-\nup, three patients improved.")
+    assert "During follow-up, three patients improved." in text
+    assert stats["dehyphenated"] == 0
+
+def test_back_matter_cut_up_to_next_section():
+    body = "Results were consistent across centres. " * (MIN_BODY_CHARS // 30)
+    text, stats = normalize_text(f"Results\n{body}\nReferences\n1. Smith J. A study. 2001.\n"
+                                 f"2. Doe A. Another. 2003.\nFunding\nSupported by a grant.")
+    assert "Smith" not in text and "Doe" not in text
+    assert "Supported by a grant." in text
+    assert stats["back_matter_tokens"] > 0
+
+def test_early_references_heading_kept():
+    text, _ = normalize_text("Contents\nReferences\nIntroduction\nShort text.")
+    assert "References" in text
+
+def test_back_matter_kept_when_disabled():
+    body = "Results were consistent across centres. " * (MIN_BODY_CHARS // 30)
+    text, _ = normalize_text(f"{body}\nReferences\n1. Smith J. A study. 2001.", strip_back_matter=False)
+    assert "Smith" in text
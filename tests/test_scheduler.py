@@ -0,0 +1,174 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+import scheduler as scheduler_module
+from scheduler import RequestScheduler, TokenBucket, parse_reset_duration
+
+def rate_limit_error(retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    response = SimpleNamespace(request=None, status_code=429, headers=headers)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+class FakeClient:
+    # Stands in for OpenAI(): each call takes the next outcome (an exception to raise, or
+    # the response headers of a success)
+    def __init__(self, outcomes=()):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create)))
+
+    def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else {}
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(headers=outcome, parse=lambda: SimpleNamespace(usage=None, choices=[]))
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(scheduler_module.time, "sleep", slept.append)
+    return slept
+
+def request():
+    return {"model": "test", "messages": [{"role": "user", "content": "x" * 400}], "max_tokens": 100}
+
+@pytest.mark.parametrize("value, seconds", [
+    ("20ms", 0.02), ("1s", 1.0), ("6m0s", 360.0), ("1h2m3.5s", 3723.5), ("7", 7.0), ("", None), (None, None), ("soon", None),
+])
+def test_parse_reset_duration(value, seconds):
+    if seconds is None:
+        assert parse_reset_duration(value) is None
+    else:
+        assert parse_reset_duration(value) == pytest.approx(seconds)
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)  # one unit per second
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 1.0) == pytest.approx(0.0)
+    assert bucket.wait_time(30, now + 10.0) == pytest.approx(20.0)
+
+def test_token_bucket_caps_oversized_requests_and_clamps():
+    bucket = TokenBucket(100)
+    now = bucket.updated
+    bucket.take(1000)
+    assert bucket.level == 0
+    # A request larger than the budget only waits for a full bucket
+    assert bucket.wait_time(1000, now) == pytest.approx(60.0)
+    bucket = TokenBucket(100)
+    bucket.clamp(5)
+    assert bucket.wait_time(10, bucket.updated) == pytest.approx(3.0)
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(None)
+    bucket.take(10**9)
+    assert bucket.wait_time(10**9, time.monotonic()) == 0
+
+def test_aimd_halves_on_429_and_grows_after_successes():
+    sched = RequestScheduler(client=FakeClient(), max_concurrency=8)
+    for expected in (4, 2, 1, 1):
+        sched.in_flight += 1
+        sched._release(success=False, rate_limited=True)
+        assert sched.concurrency == expected
+    # Additive increase: one more slot after `concurrency` successes in a row
+    for expected in (2, 2, 3, 3, 3, 4):
+        sched.in_flight += 1
+        sched._release(success=True)
+        assert sched.concurrency == expected
+    assert sched.stats()["rate_limited"] == 4
+
+def test_concurrency_never_exceeds_max():
+    sched = RequestScheduler(client=FakeClient(), max_concurrency=2)
+    for _ in range(10):
+        sched.in_flight += 1
+        sched._release(success=True)
+    assert sched.concurrency == 2
+
+def test_retry_honours_retry_after(sleeps, monkeypatch):
+    monkeypatch.setattr(scheduler_module.random, "uniform", lambda a, b: 0.0)
+    client = FakeClient([rate_limit_error("3"), rate_limit_error("500ms"), {}])
+    sched = RequestScheduler(client=client, max_concurrency=4)
+    sched.create(**request())
+    assert client.calls == 3
+    assert sleeps == [3.0, 0.5]
+    stats = sched.stats()
+    assert (stats["retries"], stats["rate_limited"], stats["requests"], stats["in_flight"]) == (2, 2, 3, 0)
+    # Halved twice (4 -> 1), then one success at concurrency 1 adds a slot back
+    assert sched.concurrency == 2
+
+def test_backoff_is_jittered_and_capped(monkeypatch):
+    monkeypatch.setattr(scheduler_module.random, "uniform", lambda a, b: b)
+    sched = RequestScheduler(client=FakeClient(), backoff_base=1.0, backoff_max=10.0)
+    assert [sched._backoff(n, rate_limit_error()) for n in (1, 2, 3, 4)] == [2.0, 4.0, 8.0, 10.0]
+
+def test_gives_up_after_max_retries(sleeps):
+    client = FakeClient([rate_limit_error("1")] * 5)
+    sched = RequestScheduler(client=client, max_retries=2)
+    with pytest.raises(openai.RateLimitError):
+        sched.create(**request())
+    assert client.calls == 3
+    assert sched.stats()["errors"] == 1
+    assert sched.in_flight == 0
+
+def test_non_retryable_error_is_raised_at_once(sleeps):
+    client = FakeClient([KeyError("boom")])
+    sched = RequestScheduler(client=client)
+    with pytest.raises(KeyError):
+        sched.create(**request())
+    assert client.calls == 1 and not sleeps
+
+def test_exhausted_window_pauses_new_requests():
+    headers = {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s",
+               "x-ratelimit-remaining-tokens": "5000"}
+    sched = RequestScheduler(client=FakeClient([headers]))
+    sched.create(**request())
+    stats = sched.stats()
+    assert 1.5 < stats["paused_for"] <= 2.0
+    assert stats["remaining_requests"] == "0"
+
+def test_request_budget_spaces_requests():
+    sched = RequestScheduler(client=FakeClient(), requests_per_minute=60)
+    sched.requests.level = 0  # budget used up: the next request waits for one refill
+    t0 = time.monotonic()
+    sched.create(**request())
+    assert time.monotonic() - t0 >= 0.9
+
+def test_in_flight_limited_to_concurrency():
+    release = threading.Event()
+    peak = []
+
+    class SlowClient(FakeClient):
+        def create(self, **kwargs):
+            peak.append(sched.in_flight)
+            release.wait(5)
+            return super().create(**kwargs)
+
+    sched = RequestScheduler(client=SlowClient(), max_concurrency=2)
+    threads = [threading.Thread(target=sched.create, kwargs=request()) for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    assert sched.stats()["in_flight"] == 2 and sched.stats()["queued"] == 3
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert max(peak) == 2 and sched.in_flight == 0
+
+def test_shared_scheduler_keeps_budgets_set_by_the_app(monkeypatch):
+    monkeypatch.setenv("OPENAI_RPM", "100")
+    monkeypatch.setenv("OPENAI_TPM", "50000")
+    sched = scheduler_module.get_scheduler("test-key-budgets", base_url="http://127.0.0.1:9/v1")
+    assert (sched.requests.per_minute, sched.tokens.per_minute) == (100, 50000)
+    scheduler_module.get_scheduler("test-key-budgets", base_url="http://127.0.0.1:9/v1",
+                                   requests_per_minute=20, tokens_per_minute=0)
+    # A caller passing only the key (a background job) leaves the app's budgets alone
+    again = scheduler_module.get_scheduler("test-key-budgets", base_url="http://127.0.0.1:9/v1")
+    assert again is sched
+    assert (sched.requests.per_minute, sched.tokens.per_minute) == (20, None)
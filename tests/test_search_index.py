@@ -0,0 +1,49 @@
+import pytest
+
+import search_index
+from search_index import SearchIndex, fts_query
+
+NASTY = ["a OR", "NOT", '"white matter', "foo AND AND bar", "*", "-x", "a:b", "OR OR", "NOT NOT a", 'x" OR "']
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "search.sqlite"))
+    index.add("smith-2019", {"study_information": {"design": "Randomized controlled trial"}},
+              text="Coenzyme Q10 reduced white matter lesions in 40 patients.")
+    index.add("lee-2021", {"study_information": {"design": "Cohort"}}, text="Brain MRI follow-up of a cohort.")
+    return index
+
+@pytest.mark.parametrize("text, query", [
+    ("a OR", '"a"'),
+    ("NOT", ""),
+    ('"white matter', '"""white" "matter"'),
+    ("foo AND AND bar", '"foo" AND "bar"'),
+    ("*", ""),
+    ("-x", '"-x"'),
+    ("a:b", '"a:b"'),
+    ("NOT a b", '"b"'),
+    ("a NOT b", '"a" NOT "b"'),
+    ("coenz*", '"coenz"*'),
+    ('"white matter" OR lesion', '"white matter" OR "lesion"'),
+])
+def test_fts_query_sanitises(text, query):
+    assert fts_query(text) == query
+
+@pytest.mark.parametrize("text", NASTY)
+def test_sanitised_queries_run(index, text):
+    assert isinstance(index.search(text), list)
+    assert isinstance(index.search(fields={"design": text}), list)
+
+def test_search_ranks_text_and_fields(index):
+    assert [r["article_id"] for r in index.search("coenz* lesion")] == ["smith-2019"]
+    assert sorted(r["article_id"] for r in index.search("mri OR coenzyme")) == ["lee-2021", "smith-2019"]
+    assert [r["article_id"] for r in index.search(fields={"design": "cohort"})] == ["lee-2021"]
+    assert [r["article_id"] for r in index.search("brain NOT cohort")] == []
+
+def test_query_fts5_cannot_parse_is_a_value_error(index, monkeypatch):
+    # Unsanitised input reaching FTS5 is a caller error, not an OperationalError
+    monkeypatch.setattr(search_index, "fts_query", lambda text: text)
+    with pytest.raises(ValueError, match="Cannot run search"):
+        index.search('"white matter')
+    with pytest.raises(ValueError, match="Cannot run search"):
+        index.search("a OR")
@@ -1,37 +1,289 @@
-import io
-from typing import Dict, Any, List
+import os
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import BinaryIO, Dict, Any, Iterator, List, Optional, Tuple, Union
 from pypdf import PdfReader
 
-def extract_text_from_pdf(uploaded_file) -> str:
-    # uploaded_file is a BytesIO coming from Streamlit
-    reader = PdfReader(uploaded_file)
+from models import ExtractionSchema, leaf_specs
+from telemetry import timed, timed_iter
+
+# Below this many pages the process-pool start-up costs more than it saves
+PARALLEL_MIN_PAGES = 16
+# Ingestion limits per PDF (0 = no limit)
+MAX_PDF_BYTES = int(os.getenv("MAX_PDF_BYTES", str(256 * 1024 * 1024)))
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "3000"))
+# Pages handed to a worker process at a time (parallel parsing)
+PAGE_BATCH = 32
+_COPY_CHUNK = 1024 * 1024
+
+PdfSource = Union[str, os.PathLike, BinaryIO]
+
+class PdfLimitError(ValueError):
+    pass
+
+@contextmanager
+def _spooled_to_disk(stream: BinaryIO) -> Iterator[str]:
+    # Copies a stream to a temp file in fixed-size chunks, for page workers to open by path
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            stream.seek(0)
+            for chunk in iter(lambda: stream.read(_COPY_CHUNK), b""):
+                out.write(chunk)
+        yield path
+    finally:
+        os.unlink(path)
+
+def _extract_pages(reader: PdfReader, start: int, end: int) -> List[str]:
     texts = []
-    for page in reader.pages:
+    for i in range(start, end):
         try:
-            texts.append(page.extract_text() or "")
+            texts.append(reader.pages[i].extract_text() or "")
         except Exception:
             pass
-    return "\n".join(texts).strip()
+    return texts
+
+def _extract_page_range(path: str, start: int, end: int) -> List[str]:
+    # Runs in a worker process: each batch opens its own reader over the file (a file
+    # object, not the path: given a path pypdf reads the whole file into memory)
+    with open(path, "rb") as fh:
+        reader = PdfReader(fh)
+        texts = []
+        for i in range(start, end):
+            texts += _extract_pages(reader, i, i + 1)
+            reader.resolved_objects.clear()
+        return texts
+
+def _iter_parallel(path: str, n_pages: int, workers: int) -> Iterator[str]:
+    batches = iter([(i, min(i + PAGE_BATCH, n_pages)) for i in range(0, n_pages, PAGE_BATCH)])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Two batches per worker in flight keeps them busy; parsed pages wait in memory
+        # only until the consumer gets to them, and come out in page order
+        queued = deque(pool.submit(_extract_page_range, path, start, end)
+                       for start, end in islice(batches, 2 * workers))
+        while queued:
+            fut = queued.popleft()
+            nxt = next(batches, None)
+            if nxt is not None:
+                queued.append(pool.submit(_extract_page_range, path, *nxt))
+            try:
+                pages = fut.result()
+            except Exception:
+                continue
+            yield from pages
+
+def iter_pdf_pages(source: PdfSource, workers: Optional[int] = 1, max_pages: int = MAX_PDF_PAGES,
+                   max_bytes: int = MAX_PDF_BYTES) -> Iterator[str]:
+    # Page texts in page order, produced lazily: the PDF is read from the file as pages
+    # need it and pypdf's object cache is dropped after every page, so memory stays flat
+    # however long the document is. workers > 1 parses batches in a process pool (None
+    # uses every CPU). Pages that fail to parse are skipped.
+    return timed_iter("pdf_parse", _iter_pdf_pages(source, workers, max_pages, max_bytes))
+
+def _iter_pdf_pages(source: PdfSource, workers: Optional[int], max_pages: int, max_bytes: int) -> Iterator[str]:
+    is_path = isinstance(source, (str, os.PathLike))
+    size = os.path.getsize(source) if is_path else source.seek(0, os.SEEK_END)
+    if max_bytes and size > max_bytes:
+        raise PdfLimitError(f"The PDF is {size / 2**20:.0f} MB; the limit is {max_bytes / 2**20:.0f} MB (MAX_PDF_BYTES).")
+    fh = open(source, "rb") if is_path else source
+    fh.seek(0)
+    try:
+        reader = PdfReader(fh)
+        n_pages = len(reader.pages)
+        if max_pages and n_pages > max_pages:
+            raise PdfLimitError(f"The PDF has {n_pages} pages; the limit is {max_pages} (MAX_PDF_PAGES).")
+        workers = min(workers or os.cpu_count() or 1, -(-n_pages // PAGE_BATCH))
+        if workers > 1 and n_pages >= PARALLEL_MIN_PAGES:
+            if is_path:
+                yield from _iter_parallel(os.fspath(source), n_pages, workers)
+            else:
+                # Workers need a file to open, not a copy of the bytes each: spool once
+                with _spooled_to_disk(source) as path:
+                    yield from _iter_parallel(path, n_pages, workers)
+            return
+        for i in range(n_pages):
+            yield from _extract_pages(reader, i, i + 1)
+            # Parsed objects (content streams, images) would otherwise stay cached for the
+            # reader's lifetime
+            reader.resolved_objects.clear()
+    finally:
+        if is_path:
+            fh.close()
+
+def extract_pages_from_pdf(uploaded_file: PdfSource, workers: Optional[int] = 1) -> List[str]:
+    # uploaded_file is a BytesIO coming from Streamlit (or any binary file object, or a
+    # path). One text per page, in page order (normalize.py needs the page boundaries).
+    return list(iter_pdf_pages(uploaded_file, workers))
+
+def extract_text_from_pdf(uploaded_file: PdfSource, workers: Optional[int] = 1) -> str:
+    return "\n".join(extract_pages_from_pdf(uploaded_file, workers)).strip()
+
+def estimate_tokens(text: str) -> int:
+    # Rough count (~4 characters per token for English prose); good enough for budgeting
+    return (len(text) + 3) // 4
 
+@timed("chunk_text")
 def chunk_text(text: str, max_chars: int = 150_000) -> str:
     # Simple truncation for very long texts to avoid hitting context limits
     if len(text) > max_chars:
         return text[:max_chars]
     return text
 
-def build_system_prompt(force_english: bool = True, allow_unknown: bool = True) -> str:
-    base = """You are an expert in systematic reviews. Extract every requested field in a strictly structured JSON format.
+# Report headings and field labels by schema path. The report layout and the field guide
+# in the system prompt are both generated from the schema; a field missing here still
+# shows up, labelled from its name.
+REPORT_LABELS = {
+    "study_information": "Study Information",
+    "study_information.study": "Study (author, year)",
+    "study_information.design": "Design",
+    "study_information.number_of_patients": "Number of patients",
+    "study_information.number_of_controls": "Number of controls",
+    "study_information.country": "Country",
+    "patient_demographics": "Patient Demographics",
+    "patient_demographics.current_age": "Current age",
+    "patient_demographics.age_at_onset": "Age at onset",
+    "patient_demographics.age_at_treatment_initiation": "Age at treatment initiation",
+    "patient_demographics.sex": "Sex",
+    "patient_demographics.family_history": "Family History",
+    "patient_demographics.parental_consanguinity": "Parental consanguinity",
+    "intervention_and_duration": "Intervention and Duration",
+    "intervention_and_duration.intervention": "Intervention",
+    "intervention_and_duration.duration_or_replacement_time": "Duration / Replacement time",
+    "outcomes": "Outcomes",
+    "outcomes.motor_outcome": "Motor outcome",
+    "outcomes.is_primary_outcome": "Primary outcome?",
+    "outcomes.result_magnitude_significance": "Result (magnitude, significance)",
+    "diagnostic_and_imaging_tests": "Diagnostic and Imaging Tests",
+    "diagnostic_and_imaging_tests.molecular": "Molecular",
+    "diagnostic_and_imaging_tests.specific_biochemical_test": "Specific Biochemical test",
+    "diagnostic_and_imaging_tests.biochemical_test_after_treatment": "Biochemical test after treatment",
+    "diagnostic_and_imaging_tests.general_relevant_blood_test": "General relevant blood test",
+    "diagnostic_and_imaging_tests.brain_ct": "Brain CT",
+    "diagnostic_and_imaging_tests.brain_mri": "Brain MRI",
+    "diagnostic_and_imaging_tests.spinal_mri": "Spinal MRI",
+    "diagnostic_and_imaging_tests.electroneuromyography": "Electroneuromyography",
+    "diagnostic_and_imaging_tests.electroencephalogram": "Electroencephalogram",
+    "clinical_features": "Clinical Features",
+    "clinical_features.developmental_history": "Developmental History",
+    "clinical_features.cognitive_impairment": "Cognitive Impairment",
+    "clinical_features.neuropsychiatric": "Neuropsychiatric",
+    "clinical_features.epileptic_seizures": "Epileptic Seizures",
+    "clinical_features.movement_disorders": "Movement Disorders",
+    "clinical_features.cerebellar_ataxia": "Cerebellar Ataxia",
+    "clinical_features.sensory_ataxia": "Sensory Ataxia",
+    "clinical_features.muscle_strength": "Muscle Strength",
+    "clinical_features.pyramidal_signs": "Pyramidal Signs",
+    "clinical_features.sensory_symptoms": "Sensory Symptoms",
+    "clinical_features.static_balance": "Static Balance",
+    "clinical_features.gait": "Gait",
+    "clinical_features.wheelchair_bound": "Wheelchair-Bound",
+    "clinical_features.visual_disturbances": "Visual Disturbances",
+    "clinical_features.hearing_impairment": "Hearing Impairment",
+    "clinical_features.eye_movements": "Eye Movements",
+    "clinical_features.dysarthria": "Dysarthria",
+    "clinical_features.vertigo": "Vertigo",
+    "clinical_features.ovr": "OVR",
+    "clinical_features.dysphagia": "Dysphagia",
+    "clinical_features.skin": "Skin",
+    "clinical_features.gastrointestinal": "Gastrointestinal",
+    "clinical_features.endocrinological": "Endocrinological",
+    "clinical_features.cardiac": "Cardiac",
+    "clinical_features.genitourinary": "Genitourinary",
+    "clinical_features.orthopedic": "Orthopedic",
+    "clinical_features.other_important_information": "Other important information",
+    "methodological_quality": "Methodological Quality",
+    "methodological_quality.adherence_to_protocol": "Adherence to protocol?",
+    "methodological_quality.itt_analysis": "ITT analysis?",
+    "methodological_quality.missing_patient_data_over_10_20_percent": "Missing patient data (>10–20%)?",
+    "methodological_quality.randomization_bias": "Randomization bias",
+    "methodological_quality.protocol_deviations": "Protocol deviations",
+    "methodological_quality.missing_outcomes": "Missing outcomes",
+    "methodological_quality.measurement_bias": "Measurement bias",
+    "methodological_quality.selective_reporting_of_outcomes": "Selective reporting",
+    "methodological_quality.representative_population": "Representative population?",
+    "methodological_quality.representative_intervention": "Representative intervention?",
+    "methodological_quality.representative_outcomes": "Representative outcomes?",
+    "methodological_quality.conflicts_of_interest": "Conflicts of interest?",
+    "methodological_quality.risk_of_bias_and_limitations": "Risk of bias & limitations",
+    "methodological_quality.indirect_evidence": "Indirect evidence",
+    "methodological_quality.publication_bias": "Publication bias",
+    "methodological_quality.other_considerations": "Other considerations",
+    "evidence_frameworks": "Evidence Frameworks",
+    "evidence_frameworks.grade_system": "GRADE system",
+    "evidence_frameworks.pico": "PICO",
+    "evidence_frameworks.prisma_flow_or_criteria": "PRISMA (flow/criteria)",
+    "evidence_frameworks.cochrane_risk_of_bias": "Cochrane Risk of Bias",
+    "study_summary": "Study Summary",
+}
+
+def report_label(path: str) -> str:
+    return REPORT_LABELS.get(path) or path.rsplit(".", 1)[-1].replace("_", " ").capitalize()
+
+@lru_cache(maxsize=1)
+def _report_template() -> Tuple[str, Tuple[Tuple[str, Optional[str]], ...]]:
+    # The report as one format string with a slot per answer, and the (section, field)
+    # filling each slot; field None is a top-level text field rendered as a paragraph
+    # (study_summary)
+    def esc(text: str) -> str:
+        return text.replace("{", "{{").replace("}", "}}")
+
+    template = ["# Study Extraction\n"]
+    slots: List[Tuple[str, Optional[str]]] = []
+    for section, spec in ExtractionSchema.json_schema()["properties"].items():
+        template.append(f"\n## {esc(report_label(section))}\n")
+        if spec.get("type") != "object":
+            template.append("{}\n")
+            slots.append((section, None))
+            continue
+        for name in spec.get("properties", {}):
+            template.append(f"- **{esc(report_label(f'{section}.{name}'))}:** {{}}\n")
+            slots.append((section, name))
+    return "".join(template), tuple(slots)
+
+_STATIC_INSTRUCTIONS = """You are an expert in systematic reviews. Extract every requested field in a strictly structured JSON format.
 - Use established evidence frameworks (GRADE, PICO, PRISMA, Cochrane risk of bias) when applicable.
-- If the article does not report a field, {unknown_rule}.
 - Be precise and concise. Do not invent data.
 - Prefer quantitative values when available (effect sizes, confidence intervals, p-values).
 - Keep units.
 - Cite details exactly as written in the article when relevant.
 - The final answer MUST be valid JSON and match the provided schema exactly.
+- Answer only the fields the response schema asks for; the field guide below covers the full report.
+"""
+
+_ANSWER_EXAMPLES = """Answer style examples:
+- study_information.design: "Randomized, double-blind, placebo-controlled trial"
+- study_information.number_of_patients: 24 (an integer when the article gives a single count)
+- outcomes.result_magnitude_significance: "6MWT +35 m vs placebo at 12 months (95% CI 12 to 58; p=0.004)"
+- methodological_quality.itt_analysis: "Yes: all 24 randomized patients were analysed"
 """
+
+@lru_cache(maxsize=1)
+def field_guide() -> str:
+    # One line per schema field: path, report label and description
+    lines = ["Field guide (schema path: meaning):"]
+    for path, spec in leaf_specs().items():
+        description = spec.get("description")
+        lines.append(f"- {path}: {report_label(path)}" + (f" ({description})" if description else ""))
+    return "\n".join(lines) + "\n"
+
+@lru_cache(maxsize=None)
+def build_system_prompt(force_english: bool = True, allow_unknown: bool = True) -> str:
+    # Laid out for provider prompt caching: instructions, field guide and examples come
+    # first and are byte-identical for every article and request kind (whole document,
+    # one section, selected fields); the option-dependent rules come last
     unknown_rule = "write 'unknown'" if allow_unknown else "leave it blank"
     lang = "All output must be in English." if force_english else "Output language should follow the input."
-    return base.format(unknown_rule=unknown_rule) + "\n" + lang
+    return "\n".join([
+        _STATIC_INSTRUCTIONS,
+        field_guide(),
+        _ANSWER_EXAMPLES,
+        f"If the article does not report a field, {unknown_rule}.",
+        lang,
+    ])
 
 def build_user_prompt(article_text: str) -> str:
     # The user prompt contains the article text
@@ -42,113 +294,19 @@ def build_user_prompt(article_text: str) -> str:
 ---END ARTICLE TEXT---
 """
 
+def _answer(d: Dict[str, Any], key: str, default: str = "—") -> str:
+    v = d.get(key)
+    return v if (isinstance(v, str) and v.strip()) else (str(v) if v is not None else default)
+
+@timed("render")
 def render_markdown_report(data: Dict[str, Any]) -> str:
-    # Convert the structured dict into a readable markdown report
-    def g(d: Dict[str, Any], key: str, default: str = "—"):
-        v = d.get(key)
-        return v if (isinstance(v, str) and v.strip()) else (str(v) if v is not None else default)
-
-    si = data.get("study_information", {})
-    pd = data.get("patient_demographics", {})
-    idur = data.get("intervention_and_duration", {})
-    outc = data.get("outcomes", {})
-    tests = data.get("diagnostic_and_imaging_tests", {})
-    clin = data.get("clinical_features", {})
-    qual = data.get("methodological_quality", {})
-    frameworks = data.get("evidence_frameworks", {})
-    summary = data.get("study_summary", "—")
-
-    md = f"""# Study Extraction
-
-## Study Information
-- **Study (author, year):** {g(si, "study")}
-- **Design:** {g(si, "design")}
-- **Number of patients:** {g(si, "number_of_patients")}
-- **Number of controls:** {g(si, "number_of_controls")}
-- **Country:** {g(si, "country")}
-
-## Patient Demographics
-- **Current age:** {g(pd, "current_age")}
-- **Age at onset:** {g(pd, "age_at_onset")}
-- **Age at treatment initiation:** {g(pd, "age_at_treatment_initiation")}
-- **Sex:** {g(pd, "sex")}
-- **Family History:** {g(pd, "family_history")}
-- **Parental consanguinity:** {g(pd, "parental_consanguinity")}
-
-## Intervention and Duration
-- **Intervention:** {g(idur, "intervention")}
-- **Duration / Replacement time:** {g(idur, "duration_or_replacement_time")}
-
-## Outcomes
-- **Motor outcome:** {g(outc, "motor_outcome")}
-- **Primary outcome?:** {g(outc, "is_primary_outcome")}
-- **Result (magnitude, significance):** {g(outc, "result_magnitude_significance")}
-
-## Diagnostic and Imaging Tests
-- **Molecular:** {g(tests, "molecular")}
-- **Specific Biochemical test:** {g(tests, "specific_biochemical_test")}
-- **Biochemical test after treatment:** {g(tests, "biochemical_test_after_treatment")}
-- **General relevant blood test:** {g(tests, "general_relevant_blood_test")}
-- **Brain CT:** {g(tests, "brain_ct")}
-- **Brain MRI:** {g(tests, "brain_mri")}
-- **Spinal MRI:** {g(tests, "spinal_mri")}
-- **Electroneuromyography:** {g(tests, "electroneuromyography")}
-- **Electroencephalogram:** {g(tests, "electroencephalogram")}
-
-## Clinical Features
-- **Developmental History:** {g(clin, "developmental_history")}
-- **Cognitive Impairment:** {g(clin, "cognitive_impairment")}
-- **Neuropsychiatric:** {g(clin, "neuropsychiatric")}
-- **Epileptic Seizures:** {g(clin, "epileptic_seizures")}
-- **Movement Disorders:** {g(clin, "movement_disorders")}
-- **Cerebellar Ataxia:** {g(clin, "cerebellar_ataxia")}
-- **Sensory Ataxia:** {g(clin, "sensory_ataxia")}
-- **Muscle Strength:** {g(clin, "muscle_strength")}
-- **Pyramidal Signs:** {g(clin, "pyramidal_signs")}
-- **Sensory Symptoms:** {g(clin, "sensory_symptoms")}
-- **Static Balance:** {g(clin, "static_balance")}
-- **Gait:** {g(clin, "gait")}
-- **Wheelchair-Bound:** {g(clin, "wheelchair_bound")}
-- **Visual Disturbances:** {g(clin, "visual_disturbances")}
-- **Hearing Impairment:** {g(clin, "hearing_impairment")}
-- **Eye Movements:** {g(clin, "eye_movements")}
-- **Dysarthria:** {g(clin, "dysarthria")}
-- **Vertigo:** {g(clin, "vertigo")}
-- **OVR:** {g(clin, "ovr")}
-- **Dysphagia:** {g(clin, "dysphagia")}
-- **Skin:** {g(clin, "skin")}
-- **Gastrointestinal:** {g(clin, "gastrointestinal")}
-- **Endocrinological:** {g(clin, "endocrinological")}
-- **Cardiac:** {g(clin, "cardiac")}
-- **Genitourinary:** {g(clin, "genitourinary")}
-- **Orthopedic:** {g(clin, "orthopedic")}
-- **Other important information:** {g(clin, "other_important_information")}
-
-## Methodological Quality
-- **Adherence to protocol?:** {g(qual, "adherence_to_protocol")}
-- **ITT analysis?:** {g(qual, "itt_analysis")}
-- **Missing patient data (>10–20%)?:** {g(qual, "missing_patient_data_over_10_20_percent")}
-- **Randomization bias:** {g(qual, "randomization_bias")}
-- **Protocol deviations:** {g(qual, "protocol_deviations")}
-- **Missing outcomes:** {g(qual, "missing_outcomes")}
-- **Measurement bias:** {g(qual, "measurement_bias")}
-- **Selective reporting:** {g(qual, "selective_reporting_of_outcomes")}
-- **Representative population?:** {g(qual, "representative_population")}
-- **Representative intervention?:** {g(qual, "representative_intervention")}
-- **Representative outcomes?:** {g(qual, "representative_outcomes")}
-- **Conflicts of interest?:** {g(qual, "conflicts_of_interest")}
-- **Risk of bias & limitations:** {g(qual, "risk_of_bias_and_limitations")}
-- **Indirect evidence:** {g(qual, "indirect_evidence")}
-- **Publication bias:** {g(qual, "publication_bias")}
-- **Other considerations:** {g(qual, "other_considerations")}
-
-## Evidence Frameworks
-- **GRADE system:** {g(frameworks, "grade_system")}
-- **PICO:** {g(frameworks, "pico")}
-- **PRISMA (flow/criteria):** {g(frameworks, "prisma_flow_or_criteria")}
-- **Cochrane Risk of Bias:** {g(frameworks, "cochrane_risk_of_bias")}
-
-## Study Summary
-{summary}
-"""
-    return md
+    # Convert the structured dict into a readable markdown report, laid out from the schema
+    template, slots = _report_template()
+    answers = []
+    for section, name in slots:
+        if name is None:
+            answers.append(_answer(data, section))
+            continue
+        values = data.get(section)
+        answers.append(_answer(values, name) if isinstance(values, dict) else "—")
+    return template.format(*answers)